@@ -0,0 +1,337 @@
+"""Load tests and benchmarks for the rooms API, the panel and the SSE stream.
+
+The app is started with uvicorn in a separate process, against a fresh
+SQLite database (``sqlite+aiosqlite``) seeded with the sample data, and is
+driven over HTTP with httpx. Three things are measured:
+
+- ``crud``: throughput and latency of create, get, update and delete on
+  ``/room/``, with ``--concurrency`` requests in flight.
+- ``panel``: latency of ``/room/panel``, served from the caches (``warm``)
+  and rendered after a room update (``cold``).
+- ``fanout``: for each ``--subscribers`` count, the time between sending
+  ``PUT /room/{id}`` and every ``/room/stream`` subscriber receiving the
+  update.
+
+Results are written as JSON, with the commit they were measured on, so two
+runs can be compared::
+
+    python -m api.benchmark --out before.json
+    python -m api.benchmark --out after.json --compare before.json
+
+Run it from the directory that contains the ``api`` package. The SSE
+settings (``SSE_COALESCE_WINDOW``, ``SSE_QUEUE_SIZE``...) are passed on to
+the server from the environment.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+# environment the server runs with, on top of the current one
+# (no cap on the streams per customer and no admission limit: the fan-out
+# runs open hundreds of streams at once, and measure delivery, not admission;
+# a single worker, so the room cache can stay on with the memory broker)
+SERVER_ENV = {
+    "SSE_BROKER": "memory",
+    "ROOM_CACHE": "on",
+    "AUDIO_SYNTHESIZER": "fake",
+    "SSE_MAX_STREAMS": "0",
+    "SSE_ADMISSION_RATE": "0",
+}
+SETTINGS = ("SSE_COALESCE_WINDOW", "SSE_QUEUE_SIZE", "SSE_OVERFLOW", "ROOM_CACHE_SIZE", "DB_POOL_SIZE")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile, ``q`` between 0 and 100."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def summary(latencies: list[float], elapsed: Optional[float] = None) -> dict[str, Any]:
+    """Latency percentiles in milliseconds, and throughput if ``elapsed``."""
+    result: dict[str, Any] = {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+    }
+    if elapsed is not None:
+        result["ops_per_second"] = len(latencies) / elapsed if elapsed else 0.0
+    return result
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def seed(database_url: str) -> str:
+    """Create the schema and the sample data; returns a customer id."""
+    os.environ.update(SERVER_ENV, DATABASE_URL=database_url)
+    from api.database.database import async_engine, init_models
+    from api.services.loader import seed_sample_data
+
+    await init_models()
+    customer_ids = await seed_sample_data()
+    await async_engine.dispose()
+    return customer_ids[0]
+
+
+async def start_server(database_url: str, port: int) -> subprocess.Popen:
+    env = {**os.environ, **SERVER_ENV, "DATABASE_URL": database_url}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+    )
+    async with httpx.AsyncClient() as client:
+        for _ in range(200):
+            if server.poll() is not None:
+                raise RuntimeError("The server exited during startup")
+            try:
+                await client.get(f"http://127.0.0.1:{port}/docs")
+                return server
+            except httpx.TransportError:
+                await asyncio.sleep(0.05)
+    server.terminate()
+    raise RuntimeError("The server didn't start")
+
+
+async def bench_crud(client: httpx.AsyncClient, operations: int, concurrency: int) -> dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async def timed(method: str, url: str, **kwargs: Any) -> tuple[float, Optional[httpx.Response]]:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latency = time.perf_counter() - start
+        if response.status_code >= 400:
+            errors += 1
+            return latency, None
+        return latency, response
+
+    async def phase(calls: list[tuple[str, str, dict]]) -> tuple[list, dict[str, Any]]:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(timed(method, url, **kwargs) for method, url, kwargs in calls))
+        elapsed = time.perf_counter() - start
+        return [response for _, response in results], summary([latency for latency, _ in results], elapsed)
+
+    result: dict[str, Any] = {}
+    created, result["create"] = await phase([
+        ("POST", "/room/create/", {"json": {"name": f"B{i}", "capacity": 1, "doctor_name": "Dr. Bench"}})
+        for i in range(operations)
+    ])
+    ids = [response.json()["id"] for response in created if response is not None]
+    _, result["list"] = await phase([("GET", "/room/", {}) for _ in range(operations)])
+    _, result["get"] = await phase([("GET", f"/room/{id}", {}) for id in ids])
+    _, result["update"] = await phase([
+        ("PUT", f"/room/{id}", {"json": {"capacity": 2}}) for id in ids
+    ])
+    _, result["delete"] = await phase([("DELETE", f"/room/{id}", {}) for id in ids])
+    result["errors"] = errors
+    return result
+
+
+async def bench_panel(client: httpx.AsyncClient, requests: int) -> dict[str, Any]:
+    """``warm``: repeated panel requests, served from the panel caches.
+    ``cold``: a room is updated before each request (not timed), so every
+    request renders the panel again."""
+    room = (await client.post(
+        "/room/create/", json={"name": "Panel", "capacity": 1, "doctor_name": "-"}
+    )).json()
+    results = {}
+    for case in ("warm", "cold"):
+        latencies = []
+        errors = 0
+        for n in range(requests):
+            if case == "cold":
+                await client.put(f"/room/{room['id']}", json={"doctor_name": f"p{n}"})
+            start = time.perf_counter()
+            response = await client.get("/room/panel")
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+        results[case] = {**summary(latencies), "errors": errors}
+    await client.delete(f"/room/{room['id']}")
+    return results
+
+
+async def bench_fanout(
+    client: httpx.AsyncClient, subscribers: int, updates: int, timeout: float
+) -> dict[str, Any]:
+    """Time from sending an update to each subscriber receiving it."""
+    room = (await client.post(
+        "/room/create/", json={"name": "Fanout", "capacity": 1, "doctor_name": "-"}
+    )).json()
+    # marker -> {subscriber: arrival time}
+    arrivals: dict[str, dict[int, float]] = {}
+    connected = 0
+    all_connected = asyncio.Event()
+    refused: list[str] = []
+
+    async def subscriber(n: int) -> None:
+        nonlocal connected
+        async with client.stream("GET", "/room/stream", timeout=None) as response:
+            if response.status_code != 200:
+                refused.append(f"subscriber {n}: HTTP {response.status_code}")
+                all_connected.set()
+                return
+            connected += 1
+            if connected == subscribers:
+                all_connected.set()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[5:])
+                deltas = event["data"].get("events", [event]) if event.get("action") == "batch" else [event]
+                for delta in deltas:
+                    marker = (delta.get("data") or {}).get("doctor_name")
+                    if marker in arrivals:
+                        arrivals[marker].setdefault(n, time.perf_counter())
+
+    tasks = [asyncio.create_task(subscriber(n)) for n in range(subscribers)]
+    latencies: list[float] = []
+    missed = 0
+    try:
+        await asyncio.wait_for(all_connected.wait(), timeout)
+        if refused:
+            raise RuntimeError(f"{len(refused)} subscribers refused, first {refused[0]}")
+        # the response headers arrive before the broker registers the queue:
+        # wait until a first update reaches everyone
+        warmup = "warmup"
+        arrivals[warmup] = {}
+        await client.put(f"/room/{room['id']}", json={"doctor_name": warmup})
+        deadline = time.perf_counter() + timeout
+        while len(arrivals[warmup]) < subscribers and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+        for i in range(updates):
+            marker = f"u{i}"
+            arrivals[marker] = {}
+            start = time.perf_counter()
+            await client.put(f"/room/{room['id']}", json={"doctor_name": marker})
+            deadline = start + timeout
+            while len(arrivals[marker]) < subscribers and time.perf_counter() < deadline:
+                await asyncio.sleep(0.001)
+            latencies.extend(arrival - start for arrival in arrivals[marker].values())
+            missed += subscribers - len(arrivals[marker])
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.delete(f"/room/{room['id']}")
+    return {**summary(latencies), "subscribers": subscribers, "updates": updates, "missed": missed}
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict[str, Any], previous: dict[str, Any]) -> list[str]:
+    """One line per metric present in both runs, with the relative change."""
+    lines = []
+
+    def walk(now: Any, before: Any, path: str) -> None:
+        if isinstance(now, dict) and isinstance(before, dict):
+            for key in now:
+                if key in before:
+                    walk(now[key], before[key], f"{path}.{key}" if path else key)
+        elif isinstance(now, (int, float)) and isinstance(before, (int, float)) and before:
+            lines.append(f"{path}: {before:.2f} -> {now:.2f} ({(now - before) / before:+.1%})")
+
+    walk(current["results"], previous.get("results", {}), "")
+    return lines
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = args.database_url or f"sqlite+aiosqlite:///{tmp}/benchmark.db"
+        customer_id = await seed(database_url)
+        port = _free_port()
+        server = await start_server(database_url, port)
+        try:
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{port}",
+                cookies={"customer_id": customer_id},
+                limits=limits,
+                timeout=args.timeout,
+            ) as client:
+                results: dict[str, Any] = {
+                    "crud": await bench_crud(client, args.operations, args.concurrency),
+                    "panel": await bench_panel(client, args.panel_requests),
+                    "fanout": {},
+                }
+                for subscribers in args.subscribers:
+                    results["fanout"][str(subscribers)] = await bench_fanout(
+                        client, subscribers, args.updates, args.timeout
+                    )
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        "id": str(uuid.uuid4()),
+        "commit": _commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "operations": args.operations,
+            "concurrency": args.concurrency,
+            "panel_requests": args.panel_requests,
+            "subscribers": args.subscribers,
+            "updates": args.updates,
+            **{name: os.environ[name] for name in SETTINGS if name in os.environ},
+        },
+        "results": results,
+    }
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m api.benchmark")
+    parser.add_argument("--out", default="benchmark.json", help="where to write the results")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument("--database-url", help="defaults to a temporary SQLite file")
+    parser.add_argument("--operations", type=int, default=500, help="requests per CRUD operation")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--panel-requests", type=int, default=200)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--updates", type=int, default=20, help="updates per fan-out measure")
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    Path(args.out).write_text(json.dumps(report, indent=2))
+    print(json.dumps(report["results"], indent=2))
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text())
+        print(f"\nCompared with {previous.get('commit')}:")
+        print("\n".join(compare(report, previous)))
+
+
+if __name__ == "__main__":
+    main()
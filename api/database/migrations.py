@@ -0,0 +1,302 @@
+"""Versioned schema migrations.
+
+The schema is no longer created with ``Base.metadata.create_all`` on every
+boot. Each change is a numbered migration, and the versions already applied
+are recorded in the ``schema_migrations`` table, so bringing a database up
+to date only reads that table when there's nothing to do. Every migration
+runs in its own transaction and is written to be idempotent: it also works
+on databases created by the old ``create_all`` (which have the tables but
+no ``schema_migrations``).
+
+On PostgreSQL an advisory lock makes concurrent upgrades (several workers
+booting at once) wait for each other.
+
+Usage::
+
+    python -m api.database.migrations status
+    python -m api.database.migrations upgrade
+    python -m api.database.migrations upgrade --to 2
+"""
+
+import argparse
+import asyncio
+from collections.abc import Awaitable, Callable
+from typing import NamedTuple, Optional
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    func,
+    inspect,
+    text,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from api.database.models import Base
+
+# arbitrary key of the PostgreSQL advisory lock held while upgrading
+LOCK_KEY = 7213004
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+
+
+async def _columns(conn: AsyncConnection, table: str) -> dict[str, dict]:
+    columns = await conn.run_sync(lambda c: inspect(c).get_columns(table))
+    return {column["name"]: column for column in columns}
+
+
+def _base_columns() -> list[Column]:
+    return [
+        Column("customer_id", String(36), ForeignKey("customer.id"), nullable=False),
+        Column("id", String(36), primary_key=True),
+        Column("created_at", DateTime, server_default=func.now(), nullable=False),
+        Column("updated_at", DateTime, server_default=func.now(), nullable=False),
+    ]
+
+
+async def initial_schema(conn: AsyncConnection) -> None:
+    """The tables as they were before migrations existed."""
+    metadata = MetaData()
+    Table(
+        "customer", metadata, *_base_columns(),
+        Column("name", String(20), unique=True, nullable=False),
+        Column("cnpj", String(14), unique=True, nullable=False),
+        Column("enabled", Integer, nullable=False),
+    )
+    Table(
+        "ticket", metadata, *_base_columns(),
+        Column("ticket", String(5), nullable=False),
+        Column("type", String(20), nullable=False),
+    )
+    Table(
+        "pacient", metadata, *_base_columns(),
+        Column("name", String(20), nullable=False),
+        Column("age", Integer, nullable=False),
+        Column("gender", String(20), nullable=False),
+        Column("ticket_id", String(36), ForeignKey("ticket.id"), nullable=False),
+    )
+    Table(
+        "room", metadata, *_base_columns(),
+        Column("name", String(20), nullable=False),
+        Column("capacity", Integer, nullable=False),
+        Column("doctor_name", String(20), nullable=False),
+        Column("pacient_id", String(36), ForeignKey("pacient.id"), nullable=False),
+    )
+    await conn.run_sync(metadata.create_all, checkfirst=True)
+
+
+async def waiting_queue_columns(conn: AsyncConnection) -> None:
+    """Add pacient.queue_seq and let rooms be empty (nullable
+    room.pacient_id)."""
+    if "queue_seq" not in await _columns(conn, "pacient"):
+        await conn.execute(text("ALTER TABLE pacient ADD COLUMN queue_seq BIGINT"))
+    if (await _columns(conn, "room"))["pacient_id"]["nullable"]:
+        return
+    if conn.dialect.name != "sqlite":
+        await conn.execute(text("ALTER TABLE room ALTER COLUMN pacient_id DROP NOT NULL"))
+        return
+    # SQLite can't drop a NOT NULL constraint in place: copy the rows to a
+    # new table (no index on room exists yet at this version)
+    metadata = MetaData()
+    Table("customer", metadata, Column("id", String(36), primary_key=True))
+    Table("pacient", metadata, Column("id", String(36), primary_key=True))
+    room = Table(
+        "room_new", metadata, *_base_columns(),
+        Column("name", String(20), nullable=False),
+        Column("capacity", Integer, nullable=False),
+        Column("doctor_name", String(20), nullable=False),
+        Column("pacient_id", String(36), ForeignKey("pacient.id"), nullable=True),
+    )
+    await conn.run_sync(metadata.create_all, tables=[room])
+    columns = ", ".join(column.name for column in room.columns)
+    await conn.execute(text(f"INSERT INTO room_new ({columns}) SELECT {columns} FROM room"))
+    await conn.execute(text("DROP TABLE room"))
+    await conn.execute(text("ALTER TABLE room_new RENAME TO room"))
+
+
+async def _create_indexes(conn: AsyncConnection, names: list[str]) -> None:
+    """Create the indexes of the models (``__table_args__``) named."""
+    indexes = {index.name: index for table in Base.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        await conn.run_sync(indexes[name].create, checkfirst=True)
+
+
+TENANT_INDEXES = [
+    "ix_room_customer_id_id",
+    "ix_room_customer_id_name",
+    "ix_room_pacient_id",
+    "ix_pacient_customer_id_id",
+    "ix_pacient_customer_id_ticket_id",
+    "ix_pacient_ticket_id",
+    "ix_pacient_customer_id_queue_seq",
+    "ix_ticket_customer_id_id",
+    "ix_ticket_customer_id_ticket",
+]
+
+
+async def tenant_indexes(conn: AsyncConnection) -> None:
+    """Index the customer_id every query filters on, and the foreign keys."""
+    await _create_indexes(conn, TENANT_INDEXES)
+
+
+LISTING_INDEXES = [
+    "ix_room_customer_id_created_at_id",
+    "ix_pacient_customer_id_created_at_id",
+    "ix_ticket_customer_id_type",
+]
+
+
+async def listing_indexes(conn: AsyncConnection) -> None:
+    """Index the keyset order of the paginated listings, and the ticket type
+    they filter on (see ``api.database.queries``)."""
+    await _create_indexes(conn, LISTING_INDEXES)
+
+
+async def ticket_counters(conn: AsyncConnection) -> None:
+    """The counters ticket numbers are reserved from, per customer, type
+    prefix and day (see ``api.services.tickets``)."""
+    metadata = MetaData()
+    # only referenced by the foreign key
+    Table("customer", metadata, Column("id", String(36), primary_key=True))
+    counter = Table(
+        "ticket_counter", metadata, *_base_columns(),
+        Column("prefix", String(1), nullable=False),
+        Column("day", Date, nullable=False),
+        Column("last", Integer, nullable=False),
+        Index("ux_ticket_counter_customer_id_prefix_day", "customer_id", "prefix", "day", unique=True),
+    )
+    await conn.run_sync(metadata.create_all, tables=[counter], checkfirst=True)
+
+
+async def callout_analytics(conn: AsyncConnection) -> None:
+    """The call-out event log and the checkpoints of its aggregates (see
+    ``api.services.analytics``)."""
+    metadata = MetaData()
+    Table("customer", metadata, Column("id", String(36), primary_key=True))
+    tables = [
+        Table(
+            "callout_event", metadata, *_base_columns(),
+            Column("kind", String(20), nullable=False),
+            Column("pacient_id", String(36), nullable=False),
+            Column("room_id", String(36), nullable=True),
+            Column("ticket_type", String(20), nullable=True),
+            Column("value", Float, nullable=True),
+            Column("seq", BigInteger, nullable=False),
+            Index("ix_callout_event_customer_id_seq", "customer_id", "seq"),
+            Index("ix_callout_event_seq", "seq"),
+        ),
+        Table(
+            "analytics_checkpoint", metadata, *_base_columns(),
+            Column("through", BigInteger, nullable=False),
+            Column("state", Text, nullable=False),
+            Index("ux_analytics_checkpoint_customer_id", "customer_id", unique=True),
+        ),
+    ]
+    await conn.run_sync(metadata.create_all, tables=tables, checkfirst=True)
+
+
+MIGRATIONS = [
+    Migration(1, "initial schema", initial_schema),
+    Migration(2, "waiting queue columns", waiting_queue_columns),
+    Migration(3, "tenant indexes", tenant_indexes),
+    Migration(4, "listing indexes", listing_indexes),
+    Migration(5, "ticket counters", ticket_counters),
+    Migration(6, "call-out analytics", callout_analytics),
+]
+LATEST = MIGRATIONS[-1].version
+
+
+async def _ensure_table(conn: AsyncConnection) -> None:
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        " version INTEGER PRIMARY KEY,"
+        " name VARCHAR(100) NOT NULL,"
+        " applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    ))
+
+
+async def applied_versions(conn: AsyncConnection) -> set[int]:
+    result = await conn.execute(text("SELECT version FROM schema_migrations"))
+    return set(result.scalars().all())
+
+
+async def current_version(engine: AsyncEngine) -> int:
+    """The highest applied version, 0 for an empty database."""
+    async with engine.begin() as conn:
+        await _ensure_table(conn)
+        return max(await applied_versions(conn), default=0)
+
+
+async def upgrade(engine: AsyncEngine, to: Optional[int] = None) -> list[int]:
+    """Apply the pending migrations up to ``to`` (default: all of them).
+
+    Returns the versions applied, empty if the schema was up to date.
+    """
+    target = LATEST if to is None else to
+    done: list[int] = []
+    async with engine.connect() as conn:
+        locked = conn.dialect.name == "postgresql"
+        if locked:
+            await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": LOCK_KEY})
+            await conn.commit()
+        try:
+            async with conn.begin():
+                await _ensure_table(conn)
+                applied = await applied_versions(conn)
+            for migration in MIGRATIONS:
+                if migration.version in applied or migration.version > target:
+                    continue
+                async with conn.begin():
+                    await migration.apply(conn)
+                    await conn.execute(
+                        text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                        {"version": migration.version, "name": migration.name},
+                    )
+                done.append(migration.version)
+        finally:
+            if locked:
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+                await conn.commit()
+    return done
+
+
+async def main(argv: Optional[list[str]] = None) -> None:
+    from api.database.database import async_engine
+
+    parser = argparse.ArgumentParser(prog="python -m api.database.migrations")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="show the applied and pending migrations")
+    upgrade_parser = commands.add_parser("upgrade", help="apply the pending migrations")
+    upgrade_parser.add_argument("--to", type=int, help="stop at this version")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "status":
+            async with async_engine.begin() as conn:
+                await _ensure_table(conn)
+                applied = await applied_versions(conn)
+            for migration in MIGRATIONS:
+                state = "applied" if migration.version in applied else "pending"
+                print(f"{migration.version:4d}  {state:8s} {migration.name}")
+            return
+        print("Applied migrations:", await upgrade(async_engine, args.to))
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,8 @@
-from datetime import datetime
+from datetime import date, datetime
+from typing import Optional
 import uuid
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import DateTime, String, Integer, func, ForeignKey
+from sqlalchemy import BigInteger, Date, DateTime, Float, String, Integer, Text, func, ForeignKey, Index
 
 class Base(DeclarativeBase):
     __abstract__ = True
@@ -24,12 +25,18 @@ class Customer(Base):
 class Room(Base):
 
     __tablename__ = "room"
+    __table_args__ = (
+        Index("ix_room_customer_id_id", "customer_id", "id"),
+        Index("ix_room_customer_id_name", "customer_id", "name"),
+        Index("ix_room_pacient_id", "pacient_id"),
+        Index("ix_room_customer_id_created_at_id", "customer_id", "created_at", "id"),
+    )
     
     name: Mapped[str] = mapped_column(String(20), nullable=False)
     capacity: Mapped[int] = mapped_column(Integer, nullable=False)
     doctor_name: Mapped[str] = mapped_column(String(20), nullable=False)
-    pacient_id: Mapped[str] = mapped_column(ForeignKey("pacient.id"))
-    pacient = relationship("Pacient", back_populates="room", lazy="selectin") 
+    pacient_id: Mapped[Optional[str]] = mapped_column(ForeignKey("pacient.id"), nullable=True)
+    pacient = relationship("Pacient", back_populates="room", lazy="raise") 
 
     def __repr__(self) -> str:
         return f'Room({self.name}, - max_capacity: {self.capacity})'
@@ -37,13 +44,22 @@ class Room(Base):
 class Pacient(Base):
     
     __tablename__ = "pacient"
+    __table_args__ = (
+        Index("ix_pacient_customer_id_id", "customer_id", "id"),
+        Index("ix_pacient_customer_id_ticket_id", "customer_id", "ticket_id"),
+        Index("ix_pacient_ticket_id", "ticket_id"),
+        Index("ix_pacient_customer_id_queue_seq", "customer_id", "queue_seq"),
+        Index("ix_pacient_customer_id_created_at_id", "customer_id", "created_at", "id"),
+    )
 
     name: Mapped[str] = mapped_column(String(20), nullable=False)
     age: Mapped[int] = mapped_column(Integer, nullable=False)
     gender: Mapped[str] = mapped_column(String(20), nullable=False)
     ticket_id: Mapped[str] = mapped_column(ForeignKey("ticket.id"))
-    ticket = relationship("Ticket", back_populates="pacient", lazy="selectin")
-    room = relationship("Room", back_populates="pacient", lazy="selectin")
+    # position in the waiting queue, None once called (see api.services.waiting_queue)
+    queue_seq: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    ticket = relationship("Ticket", back_populates="pacient", lazy="raise")
+    room = relationship("Room", back_populates="pacient", lazy="raise")
     
     def __repr__(self) -> str:
         return self.name
@@ -51,10 +67,68 @@ class Pacient(Base):
 class Ticket(Base):
     
     __tablename__ = "ticket"
+    __table_args__ = (
+        Index("ix_ticket_customer_id_id", "customer_id", "id"),
+        Index("ix_ticket_customer_id_ticket", "customer_id", "ticket"),
+        Index("ix_ticket_customer_id_type", "customer_id", "type"),
+    )
     
     ticket: Mapped[str] = mapped_column(String(5), nullable=False)
     type: Mapped[str] = mapped_column(String(20), nullable=False) # Normal, Urgente, Emergencia ?
-    pacient = relationship("Pacient", back_populates="ticket", lazy="selectin")
+    pacient = relationship("Pacient", back_populates="ticket", lazy="raise")
     
     def __repr__(self) -> str:
-        return self.ticket
\ No newline at end of file
+        return self.ticket
+
+class TicketCounter(Base):
+    """Last ticket number reserved per type prefix and day (see
+    ``api.services.tickets``)."""
+
+    __tablename__ = "ticket_counter"
+    __table_args__ = (
+        Index("ux_ticket_counter_customer_id_prefix_day", "customer_id", "prefix", "day", unique=True),
+    )
+
+    prefix: Mapped[str] = mapped_column(String(1), nullable=False)
+    day: Mapped[date] = mapped_column(Date, nullable=False)
+    last: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"TicketCounter({self.prefix}, {self.day}: {self.last})"
+
+class CalloutEvent(Base):
+    """Append-only log of a pacient's way through the clinic: arrival,
+    called, room_assigned and finished (see ``api.services.analytics``).
+    Pacients and rooms aren't foreign keys: the log outlives them."""
+
+    __tablename__ = "callout_event"
+    __table_args__ = (
+        Index("ix_callout_event_customer_id_seq", "customer_id", "seq"),
+        Index("ix_callout_event_seq", "seq"),
+    )
+
+    kind: Mapped[str] = mapped_column(String(20), nullable=False)
+    pacient_id: Mapped[str] = mapped_column(String(36), nullable=False)
+    room_id: Mapped[Optional[str]] = mapped_column(String(36), nullable=True)
+    ticket_type: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
+    # seconds waited (called) or spent in the room (finished)
+    value: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    # when it happened, in microseconds since the epoch
+    seq: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"CalloutEvent({self.kind}, {self.pacient_id})"
+
+class AnalyticsCheckpoint(Base):
+    """The wait-time aggregates of a customer, up to the event ``through``."""
+
+    __tablename__ = "analytics_checkpoint"
+    __table_args__ = (
+        Index("ux_analytics_checkpoint_customer_id", "customer_id", unique=True),
+    )
+
+    through: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    state: Mapped[str] = mapped_column(Text, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"AnalyticsCheckpoint({self.through})"
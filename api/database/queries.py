@@ -0,0 +1,243 @@
+"""Query shapes used by the endpoints.
+
+The relationships between the models are declared with ``lazy="raise"``:
+nothing is loaded behind the endpoints' back, and every endpoint reads
+exactly the columns it returns. The rows are turned straight into dicts
+shaped like the response models (``RoomResponseModel``,
+``PacientResponseModel``), with no ORM objects and no identity map.
+
+Round trips per request:
+
+- ``GET /room/``, ``GET /room/{id}``, ``GET /room/panel``: one joined
+  query (room, pacient, ticket), none when the room cache has the snapshot.
+- ``POST /room/create/``: insert, then one joined query, for the event the
+  commit publishes and the response (see ``api.services.changes``).
+- ``PUT /room/{id}``: update, then one joined query for the event and the
+  response.
+- ``DELETE /room/{id}``: one delete.
+- ``POST /room/batch``: the ownership check, one statement per kind of
+  change, then one joined query for the event and the response.
+- ``GET /fila/``: one query (pacient, ticket).
+- ``GET /proximo/``: the room lookup, the conditional update of the
+  pacient (once per pacient already called by another worker), the room
+  update, then one joined query for the event and the response.
+- ``GET /pacient/all``, ``GET /pacient/{id}``: one query (pacient, ticket).
+
+Listings are paginated by keyset on ``(created_at, id)``: a page is one
+range scan of the ``(customer_id, created_at, id)`` index starting after the
+cursor, however deep it is, instead of an ``OFFSET`` that reads and drops
+every row before it. ``GET /room/`` without a cursor or filters is still
+served from the room cache when the whole list fits in a page.
+"""
+
+import base64
+import os
+from collections.abc import Iterable
+from datetime import datetime
+from typing import Any, NamedTuple, Optional
+
+from sqlalchemy import Row, Select, exists, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database.models import Pacient, Room, Ticket
+
+PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("API_MAX_PAGE_SIZE", "500"))
+
+ROOMS = (
+    select(
+        Room.id,
+        Room.name,
+        Room.capacity,
+        Room.doctor_name,
+        Room.pacient_id,
+        Pacient.name.label("pacient_name"),
+        Ticket.id.label("ticket_id"),
+        Ticket.ticket,
+        Ticket.type,
+    )
+    .outerjoin(Pacient, Room.pacient_id == Pacient.id)
+    .outerjoin(Ticket, Pacient.ticket_id == Ticket.id)
+)
+
+PACIENTS = (
+    select(
+        Pacient.id,
+        Pacient.name,
+        Ticket.id.label("ticket_id"),
+        Ticket.ticket,
+        Ticket.type,
+    )
+    .outerjoin(Ticket, Pacient.ticket_id == Ticket.id)
+)
+
+
+def _ticket(row: Row) -> Optional[dict[str, Any]]:
+    if row.ticket_id is None:
+        return None
+    return {"id": row.ticket_id, "ticket": row.ticket, "type": row.type}
+
+
+def room_from_row(row: Row) -> dict[str, Any]:
+    """A ``ROOMS`` row as a ``RoomResponseModel`` dict."""
+    pacient = None
+    if row.pacient_id is not None:
+        pacient = {"id": row.pacient_id, "name": row.pacient_name, "ticket": _ticket(row)}
+    return {
+        "id": row.id,
+        "name": row.name,
+        "capacity": row.capacity,
+        "doctor_name": row.doctor_name,
+        "pacient_id": row.pacient_id,
+        "pacient": pacient,
+    }
+
+
+def pacient_from_row(row: Row) -> dict[str, Any]:
+    """A ``PACIENTS`` row as a ``PacientResponseModel`` dict."""
+    return {"id": row.id, "name": row.name, "ticket": _ticket(row)}
+
+
+async def rooms(
+    session: AsyncSession,
+    customer_id: str,
+    ids: Optional[Iterable[str]] = None,
+    *,
+    pacient_ids: Iterable[str] = (),
+    ticket_ids: Iterable[str] = (),
+) -> list[dict[str, Any]]:
+    """The customer's rooms (or only the given ones), in one query.
+
+    ``pacient_ids`` and ``ticket_ids`` add the rooms showing those pacients
+    or tickets.
+    """
+    stmt = ROOMS.where(Room.customer_id == customer_id)
+    pacient_ids, ticket_ids = list(pacient_ids), list(ticket_ids)
+    if ids is not None or pacient_ids or ticket_ids:
+        stmt = stmt.where(or_(
+            Room.id.in_(list(ids or ())),
+            Pacient.id.in_(pacient_ids),
+            Ticket.id.in_(ticket_ids),
+        ))
+    # the order of the listing pages
+    result = await session.execute(stmt.order_by(Room.created_at, Room.id))
+    return [room_from_row(row) for row in result]
+
+
+async def room(session: AsyncSession, customer_id: str, room_id: str) -> Optional[dict[str, Any]]:
+    found = await rooms(session, customer_id, [room_id])
+    return found[0] if found else None
+
+
+async def pacients(
+    session: AsyncSession,
+    customer_id: str,
+    ids: Optional[Iterable[str]] = None,
+    *,
+    ticket_ids: Iterable[str] = (),
+) -> list[dict[str, Any]]:
+    """The customer's pacients (or only the given ones), in one query.
+
+    ``ticket_ids`` adds the pacients holding those tickets.
+    """
+    stmt = PACIENTS.where(Pacient.customer_id == customer_id)
+    ticket_ids = list(ticket_ids)
+    if ids is not None or ticket_ids:
+        stmt = stmt.where(or_(Pacient.id.in_(list(ids or ())), Ticket.id.in_(ticket_ids)))
+    result = await session.execute(stmt)
+    return [pacient_from_row(row) for row in result]
+
+
+class Cursor(NamedTuple):
+    """Position after the last row of a page."""
+
+    created_at: datetime
+    id: str
+
+    def encode(self) -> str:
+        raw = f"{self.created_at.isoformat()}|{self.id}".encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, cursor: str) -> "Cursor":
+        """Raises ValueError on a cursor that wasn't made by ``encode``."""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            created_at, id = raw.split("|", 1)
+            return cls(datetime.fromisoformat(created_at), id)
+        except (UnicodeDecodeError, ValueError) as exc:
+            raise ValueError(f"Invalid cursor: {cursor!r}") from exc
+
+
+class ListParams(NamedTuple):
+    """Page and filters of a listing."""
+
+    limit: int = PAGE_SIZE
+    after: Optional[Cursor] = None
+    ticket_type: Optional[str] = None
+    # rooms: showing a pacient; pacients: shown in a room
+    assigned: Optional[bool] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+
+    def filtered(self) -> bool:
+        return any(value is not None for value in self[2:])
+
+
+def _timestamp(session: AsyncSession, value: datetime) -> Any:
+    # SQLite keeps CURRENT_TIMESTAMP defaults as text without microseconds,
+    # compare with the same text for the keyset to hold on equal seconds
+    if session.bind.dialect.name == "sqlite" and not value.microsecond:
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def _page(session: AsyncSession, stmt: Select, model: type, params: ListParams) -> Select:
+    """Order by (created_at, id), start after the cursor, fetch one row more
+    than the page to know whether there is a next one."""
+    if params.after is not None:
+        stmt = stmt.where(
+            tuple_(model.created_at, model.id)
+            > tuple_(_timestamp(session, params.after.created_at), params.after.id)
+        )
+    if params.created_from is not None:
+        stmt = stmt.where(model.created_at >= _timestamp(session, params.created_from))
+    if params.created_to is not None:
+        stmt = stmt.where(model.created_at < _timestamp(session, params.created_to))
+    return stmt.order_by(model.created_at, model.id).limit(params.limit + 1)
+
+
+def _next(rows: list[Row], params: ListParams) -> Optional[Cursor]:
+    if len(rows) <= params.limit:
+        return None
+    last = rows[params.limit - 1]
+    return Cursor(last.created_at, last.id)
+
+
+async def room_page(
+    session: AsyncSession, customer_id: str, params: ListParams
+) -> tuple[list[dict[str, Any]], Optional[Cursor]]:
+    """A page of the customer's rooms, and the cursor of the next one."""
+    stmt = ROOMS.add_columns(Room.created_at).where(Room.customer_id == customer_id)
+    if params.ticket_type is not None:
+        stmt = stmt.where(Ticket.type == params.ticket_type)
+    if params.assigned is not None:
+        stmt = stmt.where(Room.pacient_id.is_not(None) if params.assigned else Room.pacient_id.is_(None))
+    rows = (await session.execute(_page(session, stmt, Room, params))).all()
+    return [room_from_row(row) for row in rows[:params.limit]], _next(rows, params)
+
+
+async def pacient_page(
+    session: AsyncSession, customer_id: str, params: ListParams
+) -> tuple[list[dict[str, Any]], Optional[Cursor]]:
+    """A page of the customer's pacients, and the cursor of the next one."""
+    stmt = PACIENTS.add_columns(Pacient.created_at).where(Pacient.customer_id == customer_id)
+    if params.ticket_type is not None:
+        stmt = stmt.where(Pacient.ticket_id.in_(
+            select(Ticket.id).where(Ticket.customer_id == customer_id, Ticket.type == params.ticket_type)
+        ))
+    if params.assigned is not None:
+        in_room = exists().where(Room.pacient_id == Pacient.id)
+        stmt = stmt.where(in_room if params.assigned else ~in_room)
+    rows = (await session.execute(_page(session, stmt, Pacient, params))).all()
+    return [pacient_from_row(row) for row in rows[:params.limit]], _next(rows, params)
@@ -1,5 +1,5 @@
 import uuid
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 from typing import Optional
     
 class TicketResponseModel(BaseModel):
@@ -7,16 +7,18 @@ class TicketResponseModel(BaseModel):
     ticket: str
     type: str
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+class TicketCreateModel(BaseModel):
+    """A ticket to issue: its number is given by the type."""
+    type: str = Field(..., min_length=1, max_length=20)
         
 class PacientResponseModel(BaseModel):
     id:  uuid.UUID
     name: str
     ticket: Optional[TicketResponseModel]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class RoomCreateModel(BaseModel):
     """Response model for creating the Room model.
@@ -39,5 +41,20 @@ class RoomResponseModel(RoomCreateModel):
     id: uuid.UUID
     pacient: Optional[PacientResponseModel]
 
-    class Config:
-        orm_mode = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+        
+class RoomBatchUpdateModel(RoomUpdateModel):
+    id: str
+
+class RoomBatchModel(BaseModel):
+    """Rooms to create, update and delete in a single transaction."""
+    create: list[RoomCreateModel] = []
+    update: list[RoomBatchUpdateModel] = []
+    delete: list[str] = []
+
+
+# built once: building an adapter compiles its validator and serializer
+ROOM = TypeAdapter(RoomResponseModel)
+ROOMS = TypeAdapter(list[RoomResponseModel])
+PACIENT = TypeAdapter(PacientResponseModel)
+PACIENTS = TypeAdapter(list[PacientResponseModel])
@@ -1,10 +1,18 @@
 from typing import Annotated
-from fastapi import Cookie, Depends, HTTPException
+from fastapi import Cookie, HTTPException, Request
 
-def get_customer_id(
-    customer_id: Annotated[str | None, Cookie()]  # pulls from request.cookies["customer_id"]
+from api.services.customers import customer_registry
+
+async def get_customer_id(
+    request: Request,
+    customer_id: Annotated[str | None, Cookie()] = None  # pulls from request.cookies["customer_id"]
 ) -> str:
-    print('customer_id', customer_id)
+    # already validated by CustomerIDMiddleware
+    resolved = getattr(request.state, "customer_id", None)
+    if resolved:
+        return resolved
     if not customer_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    return customer_id
\ No newline at end of file
+    if not await customer_registry.exists(customer_id):
+        raise HTTPException(status_code=404, detail="Customer not found")
+    return customer_id
@@ -0,0 +1,30 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import HTTPException, Query
+
+from api.database.queries import MAX_PAGE_SIZE, PAGE_SIZE, Cursor, ListParams
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # created_at is stored without a time zone, in UTC
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def list_params(
+    cursor: Optional[str] = Query(None, description="`next` cursor of the previous page"),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    ticket_type: Optional[str] = Query(None, description="Only rows with this ticket type"),
+    assigned: Optional[bool] = Query(None, description="Rooms showing a pacient / pacients in a room"),
+    created_from: Optional[datetime] = Query(None, description="Created at or after"),
+    created_to: Optional[datetime] = Query(None, description="Created before"),
+) -> ListParams:
+    try:
+        after = Cursor.decode(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from None
+    return ListParams(
+        limit, after, ticket_type, assigned, _naive_utc(created_from), _naive_utc(created_to)
+    )
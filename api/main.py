@@ -1,20 +1,74 @@
+import asyncio
+import signal
+import threading
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 from typing import Any
-import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from api.database.database import init_models
-from api.routers import room, cookie
+from api.database.database import async_session, init_models
+from api.services.analytics import analytics
+from api.services.broker import broker
+from api.services.search import search_index
+from api.services.waiting_queue import waiting_queue
+from api.routers import (
+    analytics as analytics_router,
+    audio,
+    bulk,
+    cookie,
+    fila,
+    metrics,
+    pacient,
+    proximo,
+    room,
+    stats,
+    ticket,
+)
 from api.middleware.customer import CustomerIDMiddleware
+from api.middleware.metrics import MetricsMiddleware
+
+
+def drain_on_exit() -> None:
+    """Drain the SSE streams as soon as the server is told to stop.
+
+    Uvicorn only runs the lifespan shutdown once every connection is
+    closed, which open streams never are by themselves: the drain has to
+    start from the exit signal. The server's own handler is still called.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(broker.drain)
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                signal.signal(signum, previous)
+                signal.raise_signal(signum)
+
+        signal.signal(sig, handler)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[Any, None]:
     """Run tasks before and after the server starts."""
     await init_models()
+    async with async_session() as session:
+        await waiting_queue.load(session)
+        await search_index.load(session)
+        await analytics.load(session)
+    await broker.start()
+    await analytics.start()
+    drain_on_exit()
     yield
+    # tell the streams still open to reconnect elsewhere, spread out
+    broker.drain()
+    await analytics.stop()
+    await broker.stop()
 
 app = FastAPI(
     lifespan=lifespan,
@@ -31,7 +85,16 @@ app = FastAPI(
 )
 
 app.include_router(room.router, tags=["room"])
+app.include_router(pacient.router, tags=["pacient"])
 app.include_router(cookie.router, tags=["cookie"])
+app.include_router(fila.router, tags=["fila"])
+app.include_router(ticket.router, tags=["ticket"])
+app.include_router(analytics_router.router, tags=["analytics"])
+app.include_router(proximo.router, tags=["proximo"])
+app.include_router(audio.router, tags=["audio"])
+app.include_router(bulk.router, tags=["import"])
+app.include_router(stats.router, tags=["stats"])
+app.include_router(metrics.router, tags=["metrics"])
 
 # Allow frontend to fetch from this API (adjust origins as needed)
 app.add_middleware(
@@ -42,5 +105,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-#app.add_middleware(CustomerIDMiddleware)
+app.add_middleware(CustomerIDMiddleware)
+# outermost, so the time and queries of the other middlewares are counted
+app.add_middleware(MetricsMiddleware)
 
@@ -1,25 +1,31 @@
-from fastapi import Request, Response
-from fastapi.responses import RedirectResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from urllib.parse import urlencode
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Receive, Scope, Send
 
-class CustomerIDMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if request.url.path == "/cookie/":
-            return await call_next(request)
-        if request.scope["type"] != "http":
-            return await call_next(request)
-        
-        customer_id = request.cookies.get("customer_id")
-        #token = request.query_params.get("token")
+from api.services.customers import customer_registry
 
-        if not customer_id:
-            return Response(
-                "Missing customer id in query params.",
-                status_code=400
-            )
 
-        # Inject the customer_id into request.state for later use
-        request.state.customer_id = customer_id
+class CustomerIDMiddleware:
+    """Resolve the tenant of each request from the ``customer_id`` cookie.
 
-        return await call_next(request)
+    Plain ASGI (no ``BaseHTTPMiddleware``), so streaming responses such as
+    ``/room/stream`` go straight through. A known customer id is injected
+    into ``request.state.customer_id``; rejecting requests without one is
+    left to the ``get_customer_id`` dependency, so public routes keep
+    working.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            customer_id = None
+            for name, value in scope["headers"]:
+                if name == b"cookie":
+                    customer_id = cookie_parser(value.decode("latin-1")).get("customer_id")
+                    break
+            if customer_id and await customer_registry.exists(customer_id):
+                # Inject the customer_id into request.state for later use
+                scope.setdefault("state", {})["customer_id"] = customer_id
+
+        await self.app(scope, receive, send)
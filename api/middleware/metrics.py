@@ -0,0 +1,50 @@
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api.services.metrics import (
+    RequestStats,
+    current_request,
+    request_latency,
+    request_sql_time,
+    request_statements,
+)
+
+
+class MetricsMiddleware:
+    """Time every request and count the SQL statements it runs.
+
+    Plain ASGI like ``CustomerIDMiddleware``. Requests are labelled with
+    the path template of the route that handled them (``/room/{id}``), so
+    the number of series stays bounded.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            request_latency.observe(elapsed, method, route, status)
+            request_statements.observe(stats.statements, method, route)
+            request_sql_time.observe(stats.sql_seconds, method, route)
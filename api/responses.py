@@ -0,0 +1,62 @@
+"""orjson encoding for list responses and SSE payloads.
+
+The rows of ``api.database.queries`` are plain dicts already shaped like the
+response models. The endpoints return them in an ``ORJSONResponse``, which
+FastAPI sends as is, skipping its ``jsonable_encoder`` pass. Given the
+prebuilt ``TypeAdapter`` of the response model (see
+``api.database.schemas``), the content is validated and serialized by it in
+pydantic-core, so the schema the routes declare in ``response_model`` is
+enforced; without one it is encoded with orjson as is.
+"""
+
+from typing import Any, Optional
+
+import orjson
+from pydantic import BaseModel, TypeAdapter
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import Response
+
+from api.database.queries import Cursor
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj: Any) -> str:
+    """Encode an SSE payload (or any JSON message) to a string."""
+    return orjson.dumps(obj, default=_default).decode()
+
+
+class ORJSONResponse(Response):
+    media_type = "application/json"
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[dict[str, str]] = None,
+        adapter: Optional[TypeAdapter] = None,
+        background: Optional[BackgroundTask] = None,
+    ) -> None:
+        self.adapter = adapter
+        super().__init__(content, status_code, headers, background=background)
+
+    def render(self, content: Any) -> bytes:
+        if self.adapter is not None:
+            return self.adapter.dump_json(self.adapter.validate_python(content))
+        return orjson.dumps(content, default=_default)
+
+
+def page_response(
+    request: Request, rows: list, next: Optional[Cursor], adapter: Optional[TypeAdapter] = None
+) -> ORJSONResponse:
+    """A page of a listing, with a ``Link: <...>; rel="next"`` header when
+    there are more rows."""
+    headers = {}
+    if next is not None:
+        url = request.url.include_query_params(cursor=next.encode())
+        headers["Link"] = f'<{url}>; rel="next"'
+    return ORJSONResponse(rows, headers=headers, adapter=adapter)
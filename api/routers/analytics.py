@@ -0,0 +1,28 @@
+from fastapi import APIRouter, Depends, Query
+
+from api.dependencies import customer
+from api.services.analytics import ANALYTICS_DAYS, analytics
+
+
+router = APIRouter(prefix="/analytics")
+
+@router.get("/wait")
+async def get_wait_times(
+    days: int = Query(1, ge=1, le=ANALYTICS_DAYS),
+    customer_id: str = Depends(customer.get_customer_id),
+):
+    """
+    Waiting times (arrival to call) per ticket type and per room, and time
+    spent in each room, in seconds, over the last ``days`` days (1: today).
+    Served from aggregates kept up to date in memory, not from the tables.
+    example:
+    {
+        "since": "2026-10-18",
+        "days": 1,
+        "events": {"arrival": 42, "called": 40, "room_assigned": 40, "finished": 37},
+        "wait_by_type": {"Normal": {"count": 30, "avg": 640.2, "p50": 590.1, "p90": 1210.4}},
+        "wait_by_room": {"1b1c...": {"count": 12, "avg": 600.0, "p50": 580.3, "p90": 1100.9}},
+        "time_in_room": {"1b1c...": {"count": 11, "avg": 420.5, "p50": 400.2, "p90": 700.8}}
+    }
+    """
+    return analytics.report(customer_id, days)
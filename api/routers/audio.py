@@ -1,36 +1,92 @@
-import requests
-import os
-from io import BytesIO
-from fastapi import APIRouter, HTTPException, Response
-from murf import Murf
+from typing import Optional
+from fastapi import APIRouter, Response
 from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from api.services.audio_cache import (
+    DEFAULT_FORMAT,
+    DEFAULT_VOICE,
+    MEDIA_TYPES,
+    AudioFormat,
+    audio_cache,
+    audio_key,
+)
+from api.services.phrases import VOCABULARY, phrase_engine
 
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 router = APIRouter(prefix="/audio")
 
-@router.get("/")
-async def get_audio(text: str=''):
-    client = Murf(api_key="ap2_985b0b72-d741-4bed-b735-187754fb7049")
 
-    response = client.text_to_speech.generate(
-        text = text,
-        voice_id = "pt-BR-eloa"
-    )
-    
-    audio_url = response.audio_file
+class WarmUpModel(BaseModel):
+    phrases: list[str]
+    voice_id: str = DEFAULT_VOICE
+    format: AudioFormat = DEFAULT_FORMAT
+
+
+class FragmentWarmUpModel(BaseModel):
+    words: list[str] = []
+    voice_id: str = DEFAULT_VOICE
+
+
+@router.get("/")
+async def get_audio(
+    text: str = '',
+    voice_id: str = DEFAULT_VOICE,
+    format: AudioFormat = DEFAULT_FORMAT,
+):
+    chunks = await audio_cache.stream(text, voice_id, format)
 
-    # Baixa o conteúdo da URL como bytes
-    audio_response = requests.get(audio_url)
-    if audio_response.status_code != 200:
+    # wait for the first chunk so a failed synthesis can still be reported
+    try:
+        first = await anext(chunks)
+    except Exception:
         return {"error": "Falha ao obter o áudio"}
 
-    audio_bytes = BytesIO(audio_response.content)
+    async def audio_bytes():
+        yield first
+        async for chunk in chunks:
+            yield chunk
 
+    # the content only depends on (text, voice_id, format)
     return StreamingResponse(
+        audio_bytes(),
+        media_type=MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": f"inline; filename=voz.{format}",
+            "Cache-Control": "public, max-age=86400",
+            "ETag": f'"{audio_key(text, voice_id, format)}"',
+        }
+    )
+
+@router.post("/warmup")
+async def warm_up(body: WarmUpModel):
+    """Pre-synthesize known call-out phrases so they're served from cache."""
+    synthesized = await audio_cache.warm_up(body.phrases, body.voice_id, body.format)
+    return {"synthesized": synthesized, "cached": len(body.phrases) - synthesized}
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    return audio_cache.stats()
+
+@router.get("/callout")
+async def get_callout(
+    ticket: str,
+    room: str,
+    doctor: Optional[str] = None,
+    voice_id: str = DEFAULT_VOICE,
+):
+    """Announce a ticket and room, assembled from pre-rendered fragments."""
+    audio_bytes = await phrase_engine.callout(ticket, room, doctor, voice_id)
+    return Response(
         audio_bytes,
         media_type="audio/wav",
         headers={
-            "Content-Disposition": "inline; filename=voz.wav",
-            "Cache-Control": "no-cache"
+            "Content-Disposition": "inline; filename=chamada.wav",
+            "Cache-Control": "public, max-age=86400",
         }
-    )
\ No newline at end of file
+    )
+
+@router.post("/callout/warmup")
+async def warm_up_callout(body: FragmentWarmUpModel):
+    """Render the base vocabulary plus the given words (room and doctor names)."""
+    rendered = await phrase_engine.warm_up([*VOCABULARY, *body.words], body.voice_id)
+    return {"rendered": rendered, **phrase_engine.stats()}
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+
+from api.dependencies import customer
+from api.services.loader import BATCH_SIZE, KINDS, READERS, BatchRejected, import_rows, lines_from_chunks
+
+
+router = APIRouter(prefix="/import")
+
+@router.post("/{kind}")
+async def bulk_import(
+    kind: str,
+    request: Request,
+    format: str = Query("csv"),
+    batch_size: int = Query(BATCH_SIZE, ge=1, le=10000),
+    customer_id: str = Depends(customer.get_customer_id),
+):
+    """
+    Streams a CSV (with a header line) or JSON Lines body into rooms, tickets
+    or pacients, inserting new rows and updating existing ones by natural key.
+    example:
+        curl -X POST --data-binary @rooms.csv "localhost:8000/import/rooms?format=csv"
+    """
+    if kind not in KINDS:
+        raise HTTPException(status_code=404, detail="Unknown kind")
+    if format not in READERS:
+        raise HTTPException(status_code=400, detail="Unknown format")
+    rows = READERS[format](lines_from_chunks(request.stream()))
+    try:
+        return await import_rows(kind, customer_id, rows, batch_size)
+    except BatchRejected as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid row: {e}") from e
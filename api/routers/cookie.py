@@ -1,7 +1,7 @@
-from fastapi import APIRouter, Response, Query, Depends, HTTPException
+from fastapi import APIRouter, Query, HTTPException
 from fastapi.responses import RedirectResponse
 
-from api.dependencies import customer
+from api.services.customers import customer_registry
 
 
 router = APIRouter(prefix="/cookie")
@@ -12,7 +12,7 @@ async def set_cookie(
     redirect_to: str = Query("/room/panel"),
 ):
 
-    if not customer_id:
+    if not customer_id or not await customer_registry.exists(customer_id):
         raise HTTPException(status_code=403, detail="Invalid customer_id")
     response = RedirectResponse(url=redirect_to, status_code=302)
     response.set_cookie(
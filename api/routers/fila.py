@@ -1,16 +1,66 @@
-from fastapi import APIRouter, HTTPException, Response
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from dax_api.database import database
+from api.database import queries
+from api.database.database import get_db, get_read_db
+from api.dependencies import customer
+from api.responses import ORJSONResponse
+from api.services.waiting_queue import waiting_queue
 
 
 router = APIRouter(prefix="/fila")
 
-@router.get("/")
-async def get_fila():
+
+class EnqueueModel(BaseModel):
+    pacient_id: str
+
+
+@router.get("/", response_class=ORJSONResponse)
+async def get_fila(
+    session: Annotated[AsyncSession, Depends(get_read_db)],
+    customer_id: str = Depends(customer.get_customer_id),
+):
     """
     Returns the list of waiting patients ordered according to their priority.
     example:
-    
-    
+    [
+        {
+            "ID": "1b1c...",
+            "NOME": "João da Silva",
+            "SENHA": "E104",
+            "PRIORIDADE": "Emergência"
+        }
+    ]
     """
-    return database.arrivals
+    waiting = waiting_queue.waiting(customer_id)
+    if not waiting:
+        return []
+    pacients = {
+        pacient["id"]: pacient
+        for pacient in await queries.pacients(session, customer_id, waiting)
+    }
+    return ORJSONResponse([
+        {
+            "ID": pacient["id"],
+            "NOME": pacient["name"],
+            "SENHA": (pacient["ticket"] or {}).get("ticket"),
+            "PRIORIDADE": (pacient["ticket"] or {}).get("type"),
+        }
+        for pacient in (pacients.get(pacient_id) for pacient_id in waiting)
+        if pacient is not None
+    ])
+
+
+@router.post("/")
+async def enqueue(
+    body: EnqueueModel,
+    session: Annotated[AsyncSession, Depends(get_db)],
+    customer_id: str = Depends(customer.get_customer_id),
+):
+    """Puts a patient in the waiting queue, after the ones of the same priority."""
+    entry = await waiting_queue.enqueue(session, customer_id, body.pacient_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Pacient not found")
+    return entry
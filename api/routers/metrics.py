@@ -0,0 +1,76 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from api.database.database import pool_stats
+from api.services import metrics
+from api.services.audio_cache import audio_cache
+from api.services.broker import broker
+from api.services.metrics import Collected
+from api.services.panel_cache import panel_cache
+from api.services.phrases import phrase_engine
+from api.services.room_cache import room_cache
+from api.services.waiting_queue import waiting_queue
+
+
+router = APIRouter()
+
+sse_listeners = Collected("sse_listeners", "Connected SSE streams.", ("customer",))
+sse_queue_depth = Collected("sse_queue_depth", "Events waiting in the SSE queues.", ("customer",))
+sse_queue_depth_max = Collected("sse_queue_depth_max", "Fullest SSE queue.", ("customer",))
+sse_overflows = Collected("sse_overflows_total", "Streams that fell behind.", ("policy",), "counter")
+waiting_queue_depth = Collected("waiting_queue_depth", "Pacients waiting to be called.", ("customer",))
+room_cache_lookups = Collected("room_cache_lookups_total", "Room cache lookups.", ("result",), "counter")
+room_cache_rooms = Collected("room_cache_rooms", "Rooms held by the room cache.")
+panel_cache_requests = Collected("panel_cache_requests_total", "Panels served from cache or rendered.", ("result",), "counter")
+audio_cache_lookups = Collected("audio_cache_lookups_total", "Audio cache lookups.", ("result",), "counter")
+audio_cache_bytes = Collected("audio_cache_bytes", "Size of the audio cache.", ("tier",))
+audio_in_flight = Collected("audio_synthesis_in_flight", "Phrases being synthesized.")
+audio_fragments = Collected("audio_callout_fragments", "Call-out fragments held in memory.")
+pool_connections = Collected("db_pool_connections", "Connections of the pool.", ("engine", "state"))
+pool_checkouts = Collected("db_pool_checkouts_total", "Connection checkouts.", ("engine",), "counter")
+pool_timeouts = Collected("db_pool_timeouts_total", "Checkouts that timed out.", ("engine",), "counter")
+pool_wait = Collected("db_pool_wait_seconds_total", "Time spent waiting for a connection.", ("engine",), "counter")
+
+
+def collect() -> list[tuple[Collected, dict[tuple, float]]]:
+    """Read the live values from their owners."""
+    queues = {customer_id: [q.qsize() for q in listeners] for customer_id, listeners in broker.listeners.items()}
+    room_stats = room_cache.stats()
+    panel_stats = panel_cache.stats()
+    audio_stats = audio_cache.stats()
+    pools = pool_stats()
+    return [
+        (sse_listeners, {(c,): len(sizes) for c, sizes in queues.items()}),
+        (sse_queue_depth, {(c,): sum(sizes) for c, sizes in queues.items()}),
+        (sse_queue_depth_max, {(c,): max(sizes, default=0) for c, sizes in queues.items()}),
+        (sse_overflows, {("resync",): broker.dropped, ("disconnect",): broker.disconnected}),
+        (waiting_queue_depth, {(c,): depth for c, depth in waiting_queue.depths().items()}),
+        (room_cache_lookups, {("hit",): room_stats["hits"], ("miss",): room_stats["misses"]}),
+        (room_cache_rooms, {(): room_stats["rooms"]}),
+        (panel_cache_requests, {("hit",): panel_stats["hits"], ("render",): panel_stats["renders"]}),
+        (audio_cache_lookups, {
+            ("memory_hit",): audio_stats["memory_hits"],
+            ("disk_hit",): audio_stats["disk_hits"],
+            ("miss",): audio_stats["misses"],
+            ("shared",): audio_stats["shared"],
+        }),
+        (audio_cache_bytes, {("memory",): audio_stats["memory_bytes"], ("disk",): audio_stats["disk_bytes"]}),
+        (audio_in_flight, {(): audio_stats["in_flight"]}),
+        (audio_fragments, {(): phrase_engine.stats()["fragments"]}),
+        (pool_connections, {
+            (engine, state): stats[state]
+            for engine, stats in pools.items()
+            for state in ("size", "checked_out", "overflow")
+        }),
+        (pool_checkouts, {(engine,): stats["checkouts"] for engine, stats in pools.items()}),
+        (pool_timeouts, {(engine,): stats["timeouts"] for engine, stats in pools.items()}),
+        (pool_wait, {(engine,): stats["wait_total_seconds"] for engine, stats in pools.items()}),
+    ]
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus text exposition of this worker's metrics."""
+    return PlainTextResponse(
+        metrics.render(collect()), media_type="text/plain; version=0.0.4"
+    )
@@ -1,108 +1,52 @@
-from fastapi import APIRouter, HTTPException, Request, Header
-from fastapi import Depends, Query
-import os
-from typing import Annotated, Optional
-from sqlalchemy import Sequence, select
-from sqlalchemy.orm import selectinload
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi import Depends
+from typing import Annotated
 from sqlalchemy.ext.asyncio import AsyncSession
-from uuid import UUID
-from api.database.schemas import RoomResponseModel, RoomCreateModel, RoomUpdateModel
-from api.database.models import Room, Pacient
-from api.database.database import get_db
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
+from api.database.schemas import PacientResponseModel
+from api.database import queries, schemas
+from api.database.database import get_db, get_read_db
+from api.database.queries import ListParams
+from api.dependencies import customer
+from api.dependencies.listing import list_params
+from api.responses import ORJSONResponse, page_response
+from api.services.search import search_index
 
 router = APIRouter(prefix="/pacient")
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "../templates"))
 
-
-@router.get("/panel", response_class=HTMLResponse)
-async def get_room_frontend(
+@router.get("/all", response_model=list[PacientResponseModel], response_class=ORJSONResponse)
+async def get_pacients(
     request: Request,
+    session: Annotated[AsyncSession, Depends(get_read_db)],
+    customer_id: str = Depends(customer.get_customer_id),
+    params: ListParams = Depends(list_params),
+) -> ORJSONResponse:
+    """The customer's pacients by creation date, a page at a time: the next
+    page is in the ``Link`` header."""
+    pacients, next = await queries.pacient_page(session, customer_id, params)
+    return page_response(request, pacients, next, schemas.PACIENTS)
+
+@router.get("/search", response_model=list[PacientResponseModel], response_class=ORJSONResponse)
+async def search_pacients(
+    # the primary: the index is only reloaded from it after a bulk import
     session: Annotated[AsyncSession, Depends(get_db)],
-):
-    customer_id = request.state.customer_id
-    stmt = select(Pacient).options(selectinload(Room.pacient)).where(Room.customer_id == customer_id)
-    result = await session.execute(stmt)
-    rooms = result.scalars().all()
-
-    print('ROOMS', [(room.name, room.doctor_name, room.pacient.name if room.pacient else None) for room in rooms])
-    return templates.TemplateResponse("rooms.html", {"request": request, "rooms": rooms})
-
-@router.get("/all", response_model=list[RoomResponseModel])
-async def get_rooms(
-    session: Annotated[AsyncSession, Depends(get_db)],
-    customer_id: str
-) -> list[Room]:
-    result = await session.execute(select(Room).where(Room.customer_id == customer_id))
-    return result.scalars().all()
-
-@router.post("/create", response_model=RoomResponseModel)
-async def create_room(
-    room: RoomCreateModel, 
-    session: Annotated[AsyncSession, Depends(get_db)],
-    customer_id: str
-    ) -> Room:
-    room_obj = Room(
-        customer_id=str(customer_id),
-        name=room.name,
-        capacity=room.capacity,
-        doctor_name=room.doctor_name
-    )
-    session.add(room_obj)
-    await session.commit()
-    await session.refresh(room_obj)
-    return room_obj
-
-@router.get("/{id}", response_model=RoomResponseModel)
-async def get_room(
-    id: str, 
-    customer_id: str,
-    session: AsyncSession = Depends(get_db),
-    ):
-    result = await session.execute(select(Room).where(Room.customer_id==customer_id, Room.id == str(id)))
-    room = result.scalar_one_or_none()
-    if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
-    return room
-
-@router.delete("/delete/{id}")
-async def delete_room(
-    id: str, 
-    customer_id: str,
-    session: AsyncSession = Depends(get_db),
-    ):
-    result = await session.execute(select(Room).where(customer_id==customer_id, Room.id == str(id)))
-    room = result.scalar_one_or_none()
-    if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
-    await session.delete(room)
-    await session.commit()
-    return {"detail": "Room deleted successfully"}
-
-@router.put("/{id}", response_model=RoomResponseModel)
-async def update_room(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+    customer_id: str = Depends(customer.get_customer_id),
+) -> ORJSONResponse:
+    """Pacients whose name or ticket match ``q``, for autocomplete: every word
+    of ``q``, accents and case aside, is found in a word of theirs. The ones
+    where they start a word come first."""
+    pacients = await search_index.search(session, customer_id, q, limit)
+    return ORJSONResponse(pacients, adapter=schemas.PACIENTS)
+
+@router.get("/{id}", response_model=PacientResponseModel, response_class=ORJSONResponse)
+async def get_pacient(
     id: str, 
-    update_data: RoomUpdateModel, 
-    customer_id: str = Header(..., alias="X-Customer-ID"),
-    session: AsyncSession = Depends(get_db)
+    customer_id: str = Depends(customer.get_customer_id),
+    session: AsyncSession = Depends(get_read_db),
     ):
-    stmt = select(Room).where(
-        Room.id == id,
-        Room.customer_id == customer_id
-    )
-    result = await session.execute(stmt)
-    room = result.scalar_one_or_none() 
-  
-    if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
-    update_fields = update_data.model_dump(exclude_unset=True)
-    for key, value in update_fields.items():
-        setattr(room, key, value)
-        
-    await session.commit()
-    await session.refresh(room)
-    return room
\ No newline at end of file
+    pacients = await queries.pacients(session, customer_id, [id])
+    if not pacients:
+        raise HTTPException(status_code=404, detail="Pacient not found")
+    return ORJSONResponse(pacients[0], adapter=schemas.PACIENT)
@@ -1,14 +1,26 @@
-from fastapi import APIRouter, HTTPException, Response
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from dax_api.database import database
+from api.database import queries
+from api.database.database import get_db
+from api.database.models import Room
+from api.dependencies import customer
+from api.services import changes
+from api.services.waiting_queue import waiting_queue
 
 
 router = APIRouter(prefix="/proximo")
 
 @router.get("/")
-async def get_proximo():
+async def get_proximo(
+    session: Annotated[AsyncSession, Depends(get_db)],
+    room_id: str = Query(...),
+    customer_id: str = Depends(customer.get_customer_id),
+):
     """
-    Returns the next patient to be called.
+    Calls the next patient into the given room and returns it.
     example:
     {
         "NOME": "João da Silva",
@@ -17,5 +29,24 @@ async def get_proximo():
         "PRIORIDADE": "Emergência"
     }
     """
-    paciente = database.get_next_patient()
-    return paciente
+    result = await session.execute(
+        select(Room).where(Room.customer_id == customer_id, Room.id == room_id)
+    )
+    room = result.scalar_one_or_none()
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+
+    pacient_id = await waiting_queue.call_next(session, customer_id, room)
+    if pacient_id is None:
+        raise HTTPException(status_code=404, detail="No patient waiting")
+
+    # the commit in call_next published the room with its new pacient
+    data = changes.loaded(session, Room, room_id) or await queries.room(session, customer_id, room_id)
+    paciente = data["pacient"]
+    ticket = paciente["ticket"] or {}
+    return {
+        "NOME": paciente["name"],
+        "SENHA": ticket.get("ticket"),
+        "DESTINO": data["name"],
+        "PRIORIDADE": ticket.get("type"),
+    }
@@ -1,24 +1,37 @@
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, Request, Header
-from fastapi import Depends, Query, Form
+from fastapi import APIRouter, HTTPException, Request, Header, Response
+from fastapi import Depends, Query
 import os
-from typing import Annotated, Optional
-from sqlalchemy import Sequence, select
-from sqlalchemy.orm import selectinload
+from typing import Annotated, Any, Optional, TypedDict
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from uuid import UUID
-from api.database.schemas import RoomResponseModel, RoomCreateModel, RoomUpdateModel
-from api.database.models import Customer, Room, Pacient
+from uuid import uuid4
+from api.database import schemas
+from api.database.schemas import RoomBatchModel, RoomResponseModel, RoomUpdateModel
+from api.database.models import Room
 from api.dependencies import customer
-from api.database.database import get_db
+from api.dependencies.listing import list_params
+from api.database import queries
+from api.database.queries import ListParams
+from api.database.database import DB_REPLICA_MAX_LAG, get_db, get_read_db
+from api.services.admission import admission
+from api.responses import ORJSONResponse, dumps, page_response
+from api.services import changes
+from api.services.analytics import analytics
+from api.services.broker import (
+    HEARTBEAT, MAX_STREAMS, RECONNECT_JITTER, RETRY, Stream, broker,
+)
+from api.services.panel_cache import (
+    etag, last_modified, not_modified, panel_cache, panel_version, rooms_version,
+)
+from api.services.room_cache import room_cache
 from fastapi.responses import HTMLResponse
 from fastapi.responses import StreamingResponse
-from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import json
-from pydantic import BaseModel
-from typing import Dict, Any
 import asyncio
+import orjson
+import random
 
 
 router = APIRouter(prefix="/room")
@@ -26,104 +39,230 @@ router = APIRouter(prefix="/room")
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "../templates"))
 
-# global map: customer_id -> list of queues
-sse_listeners: Dict[str, list[asyncio.Queue]] = {}
+# global map: customer_id -> list of queues (local to this worker process)
+sse_listeners: dict[str, list[Stream]] = broker.listeners
+# final event of a drained stream
+RECONNECT = dumps({"type": "server", "action": "reconnect"})
 
 @router.get("/panel", response_class=HTMLResponse)
 async def get_room_frontend(
     request: Request,
-    session: Annotated[AsyncSession, Depends(get_db)],
+    session: Annotated[AsyncSession, Depends(get_read_db)],
     customer_id: str = Depends(customer.get_customer_id),
+    if_none_match: Optional[str] = Header(None),
 ):
-    stmt = select(Room).options(selectinload(Room.pacient)).where(Room.customer_id == customer_id)
-    result = await session.execute(stmt)
-    rooms = result.scalars().all()
+    rooms = None
+    if room_cache.enabled:
+        version = await panel_version(session, customer_id)
+    else:
+        rooms = await load_rooms(session, customer_id)
+        version = rooms_version(rooms)
+    # a replica may not have caught up with a write that just happened:
+    # don't let the browser keep what we read under this version
+    lagging = session.info.get("replica") and room_cache.written_within(customer_id, DB_REPLICA_MAX_LAG)
+    headers = {"Vary": "Accept-Encoding, Cookie", "Cache-Control": "private, no-cache"}
+    if not lagging:
+        headers["ETag"] = etag(customer_id, version)
+        modified = room_cache.enabled and last_modified(version)
+        if modified:
+            headers["Last-Modified"] = modified
+        if not_modified(customer_id, version, if_none_match):
+            return Response(status_code=304, headers=headers)
+
+    panel = panel_cache.get(customer_id, version)
+    if panel is None:
+        if rooms is None:
+            rooms = await load_rooms(session, customer_id)
+        html = templates.get_template("rooms.html").render(request=request, rooms=rooms)
+        if lagging:
+            headers["Cache-Control"] = "no-store"
+            return HTMLResponse(html, headers=headers)
+        panel = panel_cache.put(customer_id, version, html)
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(panel.gzipped, media_type="text/html; charset=utf-8", headers=headers)
+    return Response(panel.body, media_type="text/html; charset=utf-8", headers=headers)
 
-    return templates.TemplateResponse("rooms.html", {"request": request, "rooms": rooms})
+def _refuse_if_draining() -> None:
+    if broker.draining:
+        raise HTTPException(
+            status_code=503,
+            detail="Shutting down",
+            headers={"Retry-After": str(int(RETRY + random.random() * RECONNECT_JITTER) or 1)},
+        )
+
+def _refuse_if_full(customer_id: str) -> None:
+    if MAX_STREAMS and len(sse_listeners.get(customer_id, [])) >= MAX_STREAMS:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many open streams for this customer",
+            headers={"Retry-After": str(int(HEARTBEAT) or 1)},
+        )
 
 @router.get("/stream")
 async def stream_updates(
-    session: AsyncSession = Depends(get_db),
+    request: Request,
     customer_id: str = Depends(customer.get_customer_id),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    since: Optional[str] = Query(None, description="Last event id seen, for a new EventSource"),
 ):
 
-    # 1) Validate customer exists, else 404
-    stmt = select(Customer).where(Customer.id == customer_id)
-    if not (await session.execute(stmt)).scalar_one_or_none():
-        raise HTTPException(status_code=404, detail="Customer not found")
-
-    # 2) Create this client’s queue and register it
-    queue: asyncio.Queue[str] = asyncio.Queue()
-    sse_listeners.setdefault(customer_id, []).append(queue)
+    # 1) The customer was validated against the registry by get_customer_id
+    # 2) A worker shutting down takes no new streams
+    _refuse_if_draining()
+    # 3) Refuse the stream if the customer already has too many on this
+    #    worker, before it takes an admission slot
+    _refuse_if_full(customer_id)
+    # 4) Let the stream in at the admission rate, so that a reconnect storm
+    #    (e.g. after a deploy) doesn't hit the DB and the panel all at once
+    delay = admission.reserve()
+    if delay is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many streams connecting, try again later",
+            headers={"Retry-After": str(int(admission.max_wait * random.uniform(0.5, 1.5)) or 1)},
+        )
+    if delay:
+        await asyncio.sleep(delay)
+        # the worker may have started shutting down, or the customer opened
+        # other streams, while this one waited: then give the slot back
+        try:
+            _refuse_if_draining()
+            _refuse_if_full(customer_id)
+        except HTTPException:
+            admission.release()
+            raise
+    # 5) Create this client’s queue and register it, replaying whatever it
+    #    missed since the last event id the browser saw
+    last_event_id = last_event_id or since
+    since_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    client = f"{request.client.host}:{request.client.port}" if request.client else None
+    queue: Stream = broker.subscribe(customer_id, since_id, client)
 
     async def event_generator():
+        getter = None
         try:
+            # restore the reconnection delay a previous drain may have raised
+            yield f"retry: {int(RETRY * 1000)}\n\n"
             while True:
-                # block until a new message arrives
-                raw = await queue.get()
-                # SSE-delivery: "data: <payload>\n\n"
-                yield f"data: {raw}\n\n"
+                # wait for a new message, but no longer than a heartbeat
+                if getter is None:
+                    getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({getter}, timeout=HEARTBEAT)
+                if not done:
+                    if await request.is_disconnected():
+                        break
+                    # a comment: ignored by EventSource, but writing it fails
+                    # on a dead connection, which ends this generator
+                    yield ": ping\n\n"
+                    continue
+                event_id, raw = getter.result()
+                getter = None
+                if raw is None:
+                    if queue.retry is not None:
+                        # drained on shutdown: come back after a random delay
+                        yield f"retry: {queue.retry}\ndata: {RECONNECT}\n\n"
+                    # else dropped by the broker for falling behind
+                    break
+                # SSE-delivery: "id: <event id>\ndata: <payload>\n\n"
+                if event_id is None:
+                    yield f"data: {raw}\n\n"
+                else:
+                    queue.last_event_id = event_id
+                    yield f"id: {event_id}\ndata: {raw}\n\n"
+                queue.sent += 1
         finally:
             # cleanup on disconnect
-            sse_listeners[customer_id].remove(queue)
-            if not sse_listeners[customer_id]:
-                del sse_listeners[customer_id]
+            if getter is not None:
+                getter.cancel()
+            broker.unsubscribe(customer_id, queue)
 
     return StreamingResponse(event_generator(),
                              media_type="text/event-stream")
 
-class SSEMessage(BaseModel):
+class SSEMessage(TypedDict):
     type: str  # "room_update", "patient_update", etc.
-    data: Dict[str, Any]
+    action: str  # "create", "update", "delete" or "refresh"
+    data: dict[str, Any]
+    changed: list[str]
     timestamp: str
-    
-# Notify clients (call this from your DB update logic)
+
+
+async def _query_rooms(session: AsyncSession, customer_id: str) -> list[dict[str, Any]]:
+    version = room_cache.version(customer_id)
+    rooms = await queries.rooms(session, customer_id)
+    # a replica may not have caught up with a write that just happened
+    if not (session.info.get("replica") and room_cache.written_within(customer_id, DB_REPLICA_MAX_LAG)):
+        room_cache.put(customer_id, rooms, version)
+    return rooms
+
+
+async def load_rooms(session: AsyncSession, customer_id: str) -> list[dict[str, Any]]:
+    """Return the customer's rooms from the snapshot cache, or the DB on a miss."""
+    rooms = room_cache.get_all(customer_id)
+    if rooms is None:
+        rooms = await _query_rooms(session, customer_id)
+    return rooms
+
+# Notify clients of something other than a row change
 async def notify_clients(
     message_type: str,
     customer_id: str,
+    action: str = "refresh",
+    data: Optional[dict[str, Any]] = None,
+    changed: Optional[list[str]] = None,
 ):
     """
     Call this from your business logic whenever you want to push an update.
     If customer_id is given, only that customer's streams will get it;
     otherwise everyone gets it.
-    """
-   # just signal the client to refresh
-    msg = json.dumps({"type": message_type, "action": "refresh"})
-    
-    targets = (
-        [customer_id] if customer_id else list(sse_listeners.keys())
-    )
-    for cid in targets:
-        queues = sse_listeners.get(cid, [])
-        for q in queues:
-            # schedule putting into the queue without blocking
-            asyncio.create_task(q.put(msg))
 
+    The message goes through the broker, so streams connected to other
+    worker processes get it as well. Pass the changed row in ``data`` so the
+    panels can patch it in place; with no data they reload the whole page.
+    Committed room, pacient and ticket changes are published on their own
+    (see ``api.services.changes``), don't call this for them.
+    """
+    msg = dumps(SSEMessage(
+        type=message_type,
+        action=action,
+        data=data or {},
+        changed=changed or [],
+        timestamp=datetime.now().isoformat(),
+    ))
+    targets = await broker.publish(customer_id, msg)
     return {"dispatched_to": targets}
         
-@router.get("/", response_model=list[RoomResponseModel])
+@router.get("/", response_model=list[RoomResponseModel], response_class=ORJSONResponse)
 async def get_rooms(
     request: Request,
-    session: Annotated[AsyncSession, Depends(get_db)],
+    session: Annotated[AsyncSession, Depends(get_read_db)],
     customer_id: str = Depends(customer.get_customer_id),
-) -> list[Room]:
-    stmt = (
-        select(Room)
-        .options(selectinload(Room.pacient))
-        .where(Room.customer_id == customer_id)
-    )
-    
-    result = await session.execute(stmt)
-    return result.scalars().all()
+    params: ListParams = Depends(list_params),
+) -> ORJSONResponse:
+    """The customer's rooms by creation date, a page at a time: the next
+    page is in the ``Link`` header."""
+    if params.after is None and not params.filtered():
+        # usually a single page: served from the room cache
+        rooms = await load_rooms(session, customer_id)
+        if len(rooms) <= params.limit:
+            return ORJSONResponse(rooms, adapter=schemas.ROOMS)
+    rooms, next = await queries.room_page(session, customer_id, params)
+    return page_response(request, rooms, next, schemas.ROOMS)
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """Hit and miss counters of this worker's room snapshot and panel caches."""
+    return {**room_cache.stats(), "panel": panel_cache.stats()}
 
-@router.post("/create/", response_model=RoomResponseModel)
+@router.post("/create/", response_model=RoomResponseModel, response_class=ORJSONResponse)
 async def create_room(
     request: Request,
     session: Annotated[AsyncSession, Depends(get_db)],
     customer_id: str = Depends(customer.get_customer_id),
-    ) -> Room:
-    body = await request.body()
-    room = json.loads(body.decode('utf-8'))
+    ) -> ORJSONResponse:
+    room = orjson.loads(await request.body())
     room_obj = Room(
         customer_id=customer_id,
         name=room.get('name'),
@@ -131,25 +270,93 @@ async def create_room(
         doctor_name=room.get('doctor_name')
     )
     session.add(room_obj)
+    # the commit publishes the new room (see api.services.changes)
     await session.commit()
-    await session.refresh(room_obj)
-    await notify_clients(
-        message_type="room_update",
-        customer_id=customer_id
-    )
-    return room_obj
+    room = changes.loaded(session, Room, room_obj.id) or await queries.room(session, customer_id, room_obj.id)
+    return ORJSONResponse(room, adapter=schemas.ROOM)
+
+@router.post("/batch", response_class=ORJSONResponse)
+async def batch_rooms(
+    batch: RoomBatchModel,
+    customer_id: str = Depends(customer.get_customer_id),
+    session: AsyncSession = Depends(get_db),
+    ):
+    """Create, update and delete rooms in one transaction.
+
+    Updates run as one executemany UPDATE by primary key, deletes as one
+    DELETE. Nothing is applied if a room doesn't belong to the customer.
+    The panels get a single "batch" event, after the commit (see
+    ``api.services.changes``).
+    """
+    update_ids = [room.id for room in batch.update]
+    touched = set(update_ids) | set(batch.delete)
+    if len(touched) != len(update_ids) + len(batch.delete):
+        raise HTTPException(status_code=400, detail="A room can only appear once per batch")
+    if touched:
+        result = await session.execute(
+            select(Room.id).where(Room.customer_id == customer_id, Room.id.in_(touched))
+        )
+        missing = touched - set(result.scalars().all())
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Rooms not found: {sorted(missing)}")
+
+    created_ids = [str(uuid4()) for _ in batch.create]
+    try:
+        if batch.create:
+            await session.execute(insert(Room), [
+                {**room.model_dump(), "id": id, "customer_id": customer_id}
+                for id, room in zip(created_ids, batch.create)
+            ])
+        values = [room.model_dump(exclude_unset=True) for room in batch.update]
+        values = [change for change in values if len(change) > 1]
+        if values:
+            await session.execute(
+                update(Room).where(Room.customer_id == customer_id)
+                .execution_options(synchronize_session=None),
+                values,
+            )
+        if batch.delete:
+            await session.execute(
+                delete(Room).where(Room.customer_id == customer_id, Room.id.in_(batch.delete))
+            )
+        # pacients put in or taken out of rooms
+        events = []
+        for id, room in zip(created_ids, batch.create):
+            if room.pacient_id:
+                events += analytics.assign(session, customer_id, id, room.pacient_id)
+        for change in values:
+            if "pacient_id" in change:
+                events += analytics.assign(session, customer_id, change["id"], change["pacient_id"])
+        for id in batch.delete:
+            events += analytics.assign(session, customer_id, id, None)
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=400, detail="Invalid batch") from None
+    await analytics.publish(customer_id, events)
+
+    ids = [*created_ids, *update_ids]
+    rooms = {id: changes.loaded(session, Room, id) for id in ids}
+    missing = [id for id, room in rooms.items() if room is None]
+    if missing:
+        rooms.update((room["id"], room) for room in await queries.rooms(session, customer_id, missing))
+    created = [rooms[id] for id in created_ids]
+    updated = [rooms[id] for id in update_ids]
+    return ORJSONResponse({"created": created, "updated": updated, "deleted": batch.delete})
 
-@router.get("/{id}", response_model=RoomResponseModel)
+@router.get("/{id}", response_model=RoomResponseModel, response_class=ORJSONResponse)
 async def get_room(
     id: str, 
     customer_id: str = Depends(customer.get_customer_id),
-    session: AsyncSession = Depends(get_db),
+    session: AsyncSession = Depends(get_read_db),
     ):
-    result = await session.execute(select(Room).where(Room.customer_id==customer_id, Room.id == str(id)))
-    room = result.scalar_one_or_none()
+    room = room_cache.get(customer_id, str(id))
+    if room is None:
+        rooms = await _query_rooms(session, customer_id)
+        room = next((r for r in rooms if r["id"] == str(id)), None)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    return room
+    return ORJSONResponse(room, adapter=schemas.ROOM)
 
 @router.delete("/{id}")
 async def delete_room(
@@ -157,43 +364,34 @@ async def delete_room(
     customer_id: str = Depends(customer.get_customer_id),
     session: AsyncSession = Depends(get_db),
     ):
-    result = await session.execute(select(Room).where(customer_id==customer_id, Room.id == str(id)))
-    room = result.scalar_one_or_none()
-    if not room:
+    result = await session.execute(delete(Room).where(Room.customer_id==customer_id, Room.id == str(id)))
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Room not found")
-    await session.delete(room)
+    events = analytics.assign(session, customer_id, str(id), None)
     await session.commit()
-
-    await notify_clients(
-        message_type="room_update",
-        customer_id=customer_id
-    )
+    await analytics.publish(customer_id, events)
     return {"detail": "Room deleted successfully"}
 
-@router.put("/{id}", response_model=RoomResponseModel)
+@router.put("/{id}", response_model=RoomResponseModel, response_class=ORJSONResponse)
 async def update_room(
     id: str, 
     update_data: RoomUpdateModel, 
     customer_id: str = Depends(customer.get_customer_id),
     session: AsyncSession = Depends(get_db)
     ):
-    stmt = select(Room).where(
-        Room.id == id,
-        Room.customer_id == customer_id
-    )
-    result = await session.execute(stmt)
-    room = result.scalar_one_or_none() 
-  
+    update_fields = update_data.model_dump(exclude_unset=True)
+    events = []
+    if update_fields:
+        stmt = update(Room).where(
+            Room.id == id,
+            Room.customer_id == customer_id
+        ).values(**update_fields)
+        result = await session.execute(stmt)
+        if result.rowcount and "pacient_id" in update_fields:
+            events = analytics.assign(session, customer_id, id, update_fields["pacient_id"])
+        await session.commit()
+        await analytics.publish(customer_id, events)
+    room = changes.loaded(session, Room, id) or await queries.room(session, customer_id, id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    update_fields = update_data.model_dump(exclude_unset=True)
-    for key, value in update_fields.items():
-        setattr(room, key, value)
-    await session.commit()
-    await session.refresh(room)
-     # Notify WebSocket clients about the update
-    await notify_clients(
-        message_type="room_update",
-        customer_id=customer_id
-    )
-    return room
\ No newline at end of file
+    return ORJSONResponse(room, adapter=schemas.ROOM)
\ No newline at end of file
@@ -0,0 +1,40 @@
+from fastapi import APIRouter
+
+from api.database.database import pool_stats
+from api.services.admission import admission
+from api.services.broker import MAX_STREAMS, broker
+from api.services.search import search_index
+from api.services.tickets import ticket_issuer
+
+
+router = APIRouter(prefix="/stats")
+
+@router.get("/db")
+async def get_db_stats():
+    """Connection pool usage: checkouts, overflow and time spent waiting."""
+    return pool_stats()
+
+@router.get("/search")
+async def get_search_stats():
+    """Size of this worker's pacient search index."""
+    return search_index.stats()
+
+@router.get("/tickets")
+async def get_ticket_stats():
+    """Ticket numbers issued by this worker today, and blocks reserved."""
+    return ticket_issuer.stats()
+
+@router.get("/streams")
+async def get_streams():
+    """SSE streams connected to this worker, with their age and backlog."""
+    streams = broker.streams()
+    per_customer: dict[str, int] = {}
+    for stream in streams:
+        per_customer[stream["customer_id"]] = per_customer.get(stream["customer_id"], 0) + 1
+    return {
+        "max_per_customer": MAX_STREAMS,
+        "draining": broker.draining,
+        "admission": admission.stats(),
+        "per_customer": per_customer,
+        "streams": streams,
+    }
@@ -0,0 +1,36 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database.database import get_db
+from api.database.models import Ticket
+from api.database.schemas import TicketCreateModel, TicketResponseModel
+from api.dependencies import customer
+from api.services.tickets import TicketsExhausted, ticket_issuer
+
+
+router = APIRouter(prefix="/ticket")
+
+@router.post("/", response_model=TicketResponseModel)
+async def create_ticket(
+    body: TicketCreateModel,
+    session: Annotated[AsyncSession, Depends(get_db)],
+    customer_id: str = Depends(customer.get_customer_id),
+):
+    """
+    Issues the next ticket of the type for today.
+    example:
+    {
+        "id": "1b1c...",
+        "ticket": "E004",
+        "type": "Emergência"
+    }
+    """
+    try:
+        number = await ticket_issuer.issue(customer_id, body.type)
+    except TicketsExhausted as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    ticket = Ticket(customer_id=customer_id, ticket=number, type=body.type)
+    session.add(ticket)
+    await session.commit()
+    return {"id": ticket.id, "ticket": number, "type": body.type}
@@ -0,0 +1,75 @@
+"""Gradual admission of new SSE streams.
+
+After a deploy every panel reconnects at once, and each new stream may
+trigger a panel reload. New streams are let in at ``SSE_ADMISSION_RATE``
+per second per worker (with bursts of ``SSE_ADMISSION_BURST``): the others
+wait their turn before being subscribed, which spreads the reloads over
+time. A stream that would wait more than ``SSE_ADMISSION_MAX_WAIT`` seconds
+is refused instead. ``SSE_ADMISSION_RATE=0`` turns it off.
+
+The limiter is a GCRA (a token bucket kept as a single timestamp): a
+reservation is O(1) and holds no task or lock while waiting.
+"""
+
+import os
+import time
+from typing import Optional
+
+ADMISSION_RATE = float(os.getenv("SSE_ADMISSION_RATE", "20"))
+ADMISSION_BURST = int(os.getenv("SSE_ADMISSION_BURST", "20"))
+ADMISSION_MAX_WAIT = float(os.getenv("SSE_ADMISSION_MAX_WAIT", "30"))
+
+
+class Admission:
+
+    def __init__(
+        self,
+        rate: float = ADMISSION_RATE,
+        burst: int = ADMISSION_BURST,
+        max_wait: float = ADMISSION_MAX_WAIT,
+    ) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        # theoretical arrival time of the next stream
+        self._tat = time.monotonic()
+        self.admitted = 0
+        self.delayed = 0
+        self.refused = 0
+
+    def reserve(self) -> Optional[float]:
+        """Reserve a slot; returns how long to wait for it, None if refused."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        interval = 1 / self.rate
+        tat = max(self._tat, now)
+        delay = max(0.0, tat - (self.burst - 1) * interval - now)
+        if delay > self.max_wait:
+            self.refused += 1
+            return None
+        self._tat = tat + interval
+        self.admitted += 1
+        if delay:
+            self.delayed += 1
+        return delay
+
+    def release(self) -> None:
+        """Give back a slot reserved by a stream that was then refused."""
+        if self.rate <= 0:
+            return
+        self._tat = max(self._tat - 1 / self.rate, time.monotonic())
+        self.admitted -= 1
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "refused": self.refused,
+            "backlog_seconds": max(0.0, self._tat - time.monotonic()),
+        }
+
+
+admission = Admission()
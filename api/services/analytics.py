@@ -0,0 +1,397 @@
+"""Wait-time analytics from an append-only call-out event log.
+
+The write paths append ``CalloutEvent`` rows in their own transaction:
+
+- "arrival" when a pacient enters the waiting queue,
+- "called" when the queue calls it into a room, with the seconds waited,
+- "room_assigned" when a room gets a pacient, by the queue or by hand,
+- "finished" when it leaves the room (another pacient or none), with the
+  seconds spent there.
+
+Once committed, the events are published on the broker as internal events
+(seen by the observers only, not the client streams), and every worker
+adds them to per-customer aggregates kept in memory for each of the last
+``ANALYTICS_DAYS`` days (in the clinics' ``TICKET_TIMEZONE``): event counts,
+and quantile sketches of the waits per ticket type and per room and of the
+time spent per room. ``report`` answers from them, merging at most that
+many days, whatever the number of pacients.
+
+The aggregates are checkpointed every ``ANALYTICS_CHECKPOINT_INTERVAL``
+seconds (and on shutdown) to ``analytics_checkpoint``, with the last event
+they include; at startup ``load`` reads the checkpoints and replays the
+events logged after them, in one query each.
+"""
+
+import asyncio
+import math
+import os
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Optional
+from zoneinfo import ZoneInfo
+
+import orjson
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database.database import async_session
+from api.database.models import AnalyticsCheckpoint, CalloutEvent
+from api.responses import dumps
+from api.services.broker import broker
+from api.services.tickets import TIMEZONE
+
+ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", "7"))
+CHECKPOINT_INTERVAL = float(os.getenv("ANALYTICS_CHECKPOINT_INTERVAL", "60"))
+# relative accuracy of the quantiles
+SKETCH_ACCURACY = 0.01
+GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+UNKNOWN = "?"
+# metric -> event kind it's taken from, and the group it's split by
+METRICS = {
+    "wait_by_type": ("called", "ticket_type"),
+    "wait_by_room": ("called", "room_id"),
+    "time_in_room": ("finished", "room_id"),
+}
+
+
+class Sketch:
+    """Mergeable quantile sketch (DDSketch): values are counted in buckets
+    growing by ``GAMMA``, so a quantile is within ``SKETCH_ACCURACY`` of the
+    exact one, in a few hundred buckets at most for waits of a second to a
+    day."""
+
+    __slots__ = ("bins", "zeros", "count", "total")
+
+    def __init__(self) -> None:
+        self.bins: dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        if value < 1e-3:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / LOG_GAMMA)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other: "Sketch") -> None:
+        for key, n in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return 2 * GAMMA ** key / (GAMMA + 1)
+        return 2 * GAMMA ** max(self.bins) / (GAMMA + 1)
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 1) if self.count else None,
+            "p50": round(self.quantile(0.5), 1) if self.count else None,
+            "p90": round(self.quantile(0.9), 1) if self.count else None,
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "bins": {str(key): n for key, n in self.bins.items()},
+            "zeros": self.zeros,
+            "count": self.count,
+            "total": self.total,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "Sketch":
+        sketch = cls()
+        sketch.bins = {int(key): n for key, n in data["bins"].items()}
+        sketch.zeros = data["zeros"]
+        sketch.count = data["count"]
+        sketch.total = data["total"]
+        return sketch
+
+
+class CustomerStats:
+    """The aggregates of one customer."""
+
+    def __init__(self) -> None:
+        # day -> event kind -> count
+        self.counts: dict[str, dict[str, int]] = {}
+        # day -> metric -> group -> sketch
+        self.sketches: dict[str, dict[str, dict[str, Sketch]]] = {}
+        # room_id -> (pacient_id, seq it was assigned at)
+        self.rooms: dict[str, tuple[str, int]] = {}
+        # seq of the last event applied
+        self.through = 0
+
+    def apply(self, event: dict[str, Any], day: str) -> None:
+        counts = self.counts.setdefault(day, {})
+        counts[event["kind"]] = counts.get(event["kind"], 0) + 1
+        if event.get("value") is not None:
+            sketches = self.sketches.setdefault(day, {})
+            for metric, (kind, group) in METRICS.items():
+                if event["kind"] == kind:
+                    groups = sketches.setdefault(metric, {})
+                    key = event.get(group) or UNKNOWN
+                    groups.setdefault(key, Sketch()).add(event["value"])
+        room_id = event.get("room_id")
+        if event["kind"] == "room_assigned" and room_id:
+            self.rooms[room_id] = (event["pacient_id"], event["seq"])
+        elif event["kind"] == "finished" and room_id in self.rooms:
+            if self.rooms[room_id][0] == event["pacient_id"]:
+                del self.rooms[room_id]
+        self.through = max(self.through, event["seq"])
+
+    def prune(self, oldest: str) -> None:
+        for days in (self.counts, self.sketches):
+            for day in [day for day in days if day < oldest]:
+                del days[day]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "counts": self.counts,
+            "sketches": {
+                day: {
+                    metric: {key: sketch.to_dict() for key, sketch in groups.items()}
+                    for metric, groups in metrics.items()
+                }
+                for day, metrics in self.sketches.items()
+            },
+            "rooms": self.rooms,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any], through: int) -> "CustomerStats":
+        stats = cls()
+        stats.counts = data["counts"]
+        stats.sketches = {
+            day: {
+                metric: {key: Sketch.from_dict(sketch) for key, sketch in groups.items()}
+                for metric, groups in metrics.items()
+            }
+            for day, metrics in data["sketches"].items()
+        }
+        stats.rooms = {room_id: tuple(entry) for room_id, entry in data["rooms"].items()}
+        stats.through = through
+        return stats
+
+
+class Analytics:
+
+    def __init__(self, days: int = ANALYTICS_DAYS) -> None:
+        self.days = max(days, 1)
+        self._timezone = ZoneInfo(TIMEZONE) if TIMEZONE else None
+        self._customers: dict[str, CustomerStats] = {}
+        # customers changed since their last checkpoint
+        self._dirty: set[str] = set()
+        self._last_seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _next_seq(self) -> int:
+        self._last_seq = max(self._last_seq + 1, time.time_ns() // 1000)
+        return self._last_seq
+
+    def _day(self, seq: int) -> date:
+        return datetime.fromtimestamp(seq / 1e6, self._timezone).date()
+
+    def _oldest(self) -> date:
+        """The first day kept."""
+        return datetime.now(self._timezone).date() - timedelta(days=self.days - 1)
+
+    def record(
+        self,
+        session: AsyncSession,
+        customer_id: str,
+        kind: str,
+        pacient_id: str,
+        room_id: Optional[str] = None,
+        ticket_type: Optional[str] = None,
+        since: Optional[int] = None,
+    ) -> dict[str, Any]:
+        """Append an event to the log, in the session's transaction.
+
+        ``since`` is the seq (microseconds) the event's duration counts from.
+        Publish the events returned once committed (see ``publish``).
+        """
+        seq = self._next_seq()
+        event = {
+            "kind": kind,
+            "pacient_id": pacient_id,
+            "room_id": room_id,
+            "ticket_type": ticket_type,
+            "value": max(0.0, (seq - since) / 1e6) if since is not None else None,
+            "seq": seq,
+        }
+        session.add(CalloutEvent(customer_id=customer_id, **event))
+        return event
+
+    def assign(
+        self,
+        session: AsyncSession,
+        customer_id: str,
+        room_id: str,
+        pacient_id: Optional[str],
+        ticket_type: Optional[str] = None,
+    ) -> list[dict[str, Any]]:
+        """Record a room getting a pacient, or none: the one in it, if any,
+        finished."""
+        stats = self._customers.get(customer_id)
+        current = stats.rooms.get(room_id) if stats else None
+        if current is not None and current[0] == pacient_id:
+            return []
+        events = []
+        if current is not None:
+            events.append(self.record(session, customer_id, "finished", current[0], room_id, since=current[1]))
+        if pacient_id:
+            events.append(self.record(session, customer_id, "room_assigned", pacient_id, room_id, ticket_type))
+        return events
+
+    async def publish(self, customer_id: str, events: list[dict[str, Any]]) -> None:
+        """Let every worker aggregate committed events."""
+        if events:
+            msg = dumps({"type": "callout", "action": "append", "data": {"events": events}})
+            await broker.publish(customer_id, msg, internal=True)
+
+    def _apply(self, customer_id: str, events: list[dict[str, Any]]) -> None:
+        stats = self._customers.setdefault(customer_id, CustomerStats())
+        for event in events:
+            stats.apply(event, self._day(event["seq"]).isoformat())
+        stats.prune(self._oldest().isoformat())
+        self._dirty.add(customer_id)
+
+    def on_event(self, customer_id: Optional[str], event_id: int, msg: str) -> None:
+        """Aggregate the events logged by any worker (broker observer)."""
+        event = orjson.loads(msg)
+        if customer_id is None or event.get("type") != "callout":
+            return
+        self._apply(customer_id, (event.get("data") or {}).get("events", []))
+
+    def report(self, customer_id: str, days: int = 1) -> dict[str, Any]:
+        """Counts, average and quantiles of the last ``days`` days."""
+        days = min(max(days, 1), self.days)
+        since = datetime.now(self._timezone).date() - timedelta(days=days - 1)
+        stats = self._customers.get(customer_id) or CustomerStats()
+        counts: dict[str, int] = {}
+        merged: dict[str, dict[str, Sketch]] = {metric: {} for metric in METRICS}
+        for n in range(days):
+            day = (since + timedelta(days=n)).isoformat()
+            for kind, count in stats.counts.get(day, {}).items():
+                counts[kind] = counts.get(kind, 0) + count
+            for metric, groups in stats.sketches.get(day, {}).items():
+                for key, sketch in groups.items():
+                    merged[metric].setdefault(key, Sketch()).merge(sketch)
+        return {
+            "since": since.isoformat(),
+            "days": days,
+            "events": counts,
+            **{
+                metric: {key: sketch.summary() for key, sketch in sorted(groups.items())}
+                for metric, groups in merged.items()
+            },
+        }
+
+    async def load(self, session: AsyncSession) -> None:
+        """Restore the aggregates from the checkpoints and the events logged
+        after them."""
+        self._customers.clear()
+        for customer_id, through, state in await session.execute(
+            select(AnalyticsCheckpoint.customer_id, AnalyticsCheckpoint.through, AnalyticsCheckpoint.state)
+        ):
+            self._customers[customer_id] = CustomerStats.from_dict(orjson.loads(state), through)
+        oldest = datetime.combine(self._oldest(), datetime.min.time(), self._timezone)
+        stmt = (
+            select(
+                CalloutEvent.customer_id,
+                CalloutEvent.kind,
+                CalloutEvent.pacient_id,
+                CalloutEvent.room_id,
+                CalloutEvent.ticket_type,
+                CalloutEvent.value,
+                CalloutEvent.seq,
+            )
+            .outerjoin(AnalyticsCheckpoint, AnalyticsCheckpoint.customer_id == CalloutEvent.customer_id)
+            .where(
+                CalloutEvent.seq > func.coalesce(AnalyticsCheckpoint.through, 0),
+                CalloutEvent.seq >= int(oldest.timestamp() * 1e6),
+            )
+            .order_by(CalloutEvent.seq)
+        )
+        events: dict[str, list[dict[str, Any]]] = {}
+        for row in await session.execute(stmt):
+            event = row._asdict()
+            events.setdefault(event.pop("customer_id"), []).append(event)
+            self._last_seq = max(self._last_seq, row.seq)
+        for customer_id, customer_events in events.items():
+            self._apply(customer_id, customer_events)
+
+    async def checkpoint(self) -> int:
+        """Save the aggregates changed since the last checkpoint; returns how
+        many customers were saved."""
+        dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return 0
+        try:
+            async with async_session(info={"capture_changes": False}) as session:
+                for customer_id in dirty:
+                    stats = self._customers[customer_id]
+                    state = dumps(stats.to_dict())
+                    # the other workers save the same aggregates: keep the newest
+                    result = await session.execute(
+                        update(AnalyticsCheckpoint)
+                        .where(
+                            AnalyticsCheckpoint.customer_id == customer_id,
+                            AnalyticsCheckpoint.through < stats.through,
+                        )
+                        .values(through=stats.through, state=state)
+                        .execution_options(synchronize_session=False)
+                    )
+                    if result.rowcount == 0:
+                        try:
+                            async with session.begin_nested():
+                                session.add(AnalyticsCheckpoint(
+                                    customer_id=customer_id, through=stats.through, state=state
+                                ))
+                        except IntegrityError:
+                            # saved already, by us or a newer one
+                            pass
+                await session.commit()
+        except Exception:
+            self._dirty |= dirty
+            raise
+        return len(dirty)
+
+    async def _checkpoints(self) -> None:
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            try:
+                await self.checkpoint()
+            except Exception:
+                # retried at the next interval
+                pass
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._checkpoints())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.checkpoint()
+
+
+analytics = Analytics()
+broker.add_observer(analytics.on_event)
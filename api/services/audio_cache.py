@@ -0,0 +1,359 @@
+"""Content-addressed cache for the text-to-speech call-outs.
+
+Audio is keyed by the SHA-256 of (text, voice_id, format), so the same
+phrase is only ever synthesized once. There are two tiers:
+
+- memory: the most recently used clips, up to ``AUDIO_MEMORY_CACHE_BYTES``;
+- disk: every clip under ``AUDIO_CACHE_DIR``, up to
+  ``AUDIO_DISK_CACHE_BYTES``. The least recently used files (by mtime,
+  touched on every hit) are removed first.
+
+The synthesizer is pluggable: ``AUDIO_SYNTHESIZER=murf`` calls the Murf API
+with the key in ``MURF_API_KEY``, ``AUDIO_SYNTHESIZER=fake`` renders a short
+tone locally, which keeps the cache usable offline and in tests. Without a
+``MURF_API_KEY`` the fake one is used, with a warning.
+
+Synthesizers are blocking, so they run on a dedicated executor of
+``AUDIO_SYNTH_WORKERS`` threads (disk I/O too), never on the event loop.
+Their output is streamed to the client chunk by chunk as it arrives, and
+concurrent requests for the same clip share a single in-flight synthesis.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import math
+import os
+import threading
+import time
+import wave
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+
+import requests
+
+from api.services.metrics import audio_synthesis
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(BASE_DIR, ".audio_cache"))
+AUDIO_MEMORY_CACHE_BYTES = int(os.getenv("AUDIO_MEMORY_CACHE_BYTES", str(32 * 1024 * 1024)))
+AUDIO_DISK_CACHE_BYTES = int(os.getenv("AUDIO_DISK_CACHE_BYTES", str(512 * 1024 * 1024)))
+AUDIO_SYNTHESIZER = os.getenv("AUDIO_SYNTHESIZER", "murf")
+AUDIO_SYNTH_WORKERS = int(os.getenv("AUDIO_SYNTH_WORKERS", "4"))
+CHUNK_SIZE = 64 * 1024
+MURF_API_KEY = os.getenv("MURF_API_KEY")
+DEFAULT_VOICE = "pt-BR-eloa"
+DEFAULT_FORMAT = "wav"
+
+AudioFormat = Literal["wav", "mp3"]
+MEDIA_TYPES = {"wav": "audio/wav", "mp3": "audio/mpeg"}
+
+logger = logging.getLogger(__name__)
+
+
+class Synthesizer:
+    """Turns text into audio bytes.
+
+    Implement ``synthesize``, or ``stream`` when the audio can be handed out
+    before it is complete. Both are called from a worker thread.
+    """
+
+    def synthesize(self, text: str, voice_id: str, format: str) -> bytes:
+        return b"".join(self.stream(text, voice_id, format))
+
+    def stream(self, text: str, voice_id: str, format: str) -> Iterator[bytes]:
+        yield self.synthesize(text, voice_id, format)
+
+
+class MurfSynthesizer(Synthesizer):
+
+    def __init__(self, api_key: Optional[str] = MURF_API_KEY) -> None:
+        if not api_key:
+            raise ValueError("MURF_API_KEY is not set")
+        from murf import Murf
+
+        self.client = Murf(api_key=api_key)
+
+    def stream(self, text: str, voice_id: str, format: str) -> Iterator[bytes]:
+        response = self.client.text_to_speech.generate(
+            text=text,
+            voice_id=voice_id,
+            format=format.upper(),
+        )
+        # Baixa o conteúdo da URL aos pedaços, à medida que chega
+        with requests.get(response.audio_file, stream=True, timeout=30) as audio_response:
+            audio_response.raise_for_status()
+            yield from audio_response.iter_content(CHUNK_SIZE)
+
+
+class FakeSynthesizer(Synthesizer):
+    """Offline stand-in: a tone whose pitch and length depend on the text."""
+
+    sample_rate = 8000
+
+    def synthesize(self, text: str, voice_id: str, format: str) -> bytes:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:2], "big")
+        frequency = 300 + seed % 500
+        frames = self.sample_rate * max(1, len(text)) // 20
+        samples = bytearray()
+        for i in range(frames):
+            value = int(8000 * math.sin(2 * math.pi * frequency * i / self.sample_rate))
+            samples += value.to_bytes(2, "little", signed=True)
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(bytes(samples))
+        return buffer.getvalue()
+
+
+SYNTHESIZERS = {
+    "murf": MurfSynthesizer,
+    "fake": FakeSynthesizer,
+}
+
+
+class InFlight:
+    """A synthesis in progress, readable by any number of requests."""
+
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def feed(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._wake()
+
+    async def reader(self) -> AsyncIterator[bytes]:
+        """Yield every chunk from the start, then the new ones as they come."""
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+async def _single_chunk(audio: bytes) -> AsyncIterator[bytes]:
+    yield audio
+
+
+def audio_key(text: str, voice_id: str, format: str) -> str:
+    return hashlib.sha256(f"{voice_id}\0{format}\0{text}".encode()).hexdigest()
+
+
+class AudioCache:
+
+    def __init__(
+        self,
+        synthesizer: Synthesizer,
+        directory: str = AUDIO_CACHE_DIR,
+        memory_bytes: int = AUDIO_MEMORY_CACHE_BYTES,
+        disk_bytes: int = AUDIO_DISK_CACHE_BYTES,
+        workers: int = AUDIO_SYNTH_WORKERS,
+    ) -> None:
+        self.synthesizer = synthesizer
+        self.directory = os.path.realpath(directory)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="tts")
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        # path -> size of the files on disk, loaded lazily
+        self._disk: Optional[dict[str, int]] = None
+        self._disk_lock = threading.Lock()
+        # key -> synthesis in progress
+        self._inflight: dict[str, InFlight] = {}
+        # the running syntheses, referenced until they are done
+        self._tasks: set[asyncio.Task] = set()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def _path(self, key: str, format: str) -> str:
+        """The cache file of a clip, refusing anything outside the directory."""
+        if format not in MEDIA_TYPES:
+            raise ValueError(f"Unknown audio format: {format}")
+        path = os.path.realpath(os.path.join(self.directory, key[:2], f"{key}.{format}"))
+        if os.path.commonpath([self.directory, path]) != self.directory:
+            raise ValueError(f"Audio cache path outside {self.directory}: {path}")
+        return path
+
+    def _disk_index(self) -> dict[str, int]:
+        if self._disk is None:
+            self._disk = {}
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    self._disk[path] = os.path.getsize(path)
+        return self._disk
+
+    def _remember(self, key: str, audio: bytes) -> None:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = audio
+        self._memory_size += len(audio)
+        while self._memory_size > self.memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    @staticmethod
+    def _read_file(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return audio
+
+    def _write_file(self, path: str, audio: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(audio)
+        os.replace(tmp, path)
+        with self._disk_lock:
+            index = self._disk_index()
+            index[path] = len(audio)
+            if sum(index.values()) > self.disk_bytes:
+                self._evict_disk(index)
+
+    def _evict_disk(self, index: dict[str, int]) -> None:
+        total = sum(index.values())
+        by_age = sorted(index, key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for path in by_age:
+            if total <= self.disk_bytes:
+                break
+            total -= index.pop(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _disk_size(self) -> int:
+        with self._disk_lock:
+            return sum((self._disk or {}).values())
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def lookup(self, text: str, voice_id: str = DEFAULT_VOICE, format: str = DEFAULT_FORMAT) -> Optional[bytes]:
+        """Return the cached audio, from memory or disk, without synthesizing."""
+        key = audio_key(text, voice_id, format)
+        audio = self._memory.get(key)
+        if audio is not None:
+            self.memory_hits += 1
+            self._memory.move_to_end(key)
+            return audio
+        audio = await self._run(self._read_file, self._path(key, format))
+        if audio is not None:
+            self.disk_hits += 1
+            self._remember(key, audio)
+        return audio
+
+    async def stream(self, text: str, voice_id: str = DEFAULT_VOICE, format: str = DEFAULT_FORMAT) -> AsyncIterator[bytes]:
+        """Return the audio for ``text`` as chunks, synthesizing it on a miss."""
+        audio = await self.lookup(text, voice_id, format)
+        if audio is not None:
+            return _single_chunk(audio)
+        key = audio_key(text, voice_id, format)
+        flight = self._inflight.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = self._inflight[key] = InFlight()
+            task = asyncio.create_task(self._synthesize(key, text, voice_id, format, flight))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+        else:
+            self.shared += 1
+        return flight.reader()
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Audio synthesis failed", exc_info=task.exception())
+
+    async def _synthesize(self, key: str, text: str, voice_id: str, format: str, flight: InFlight) -> None:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        first_chunk: list[float] = []
+
+        def produce() -> None:
+            for chunk in self.synthesizer.stream(text, voice_id, format):
+                if not first_chunk:
+                    first_chunk.append(time.perf_counter() - start)
+                loop.call_soon_threadsafe(flight.feed, chunk)
+
+        try:
+            await self._run(produce)
+        except Exception as exc:
+            self._inflight.pop(key, None)
+            flight.finish(exc)
+            return
+        audio_synthesis.observe(time.perf_counter() - start, "total")
+        if first_chunk:
+            audio_synthesis.observe(first_chunk[0], "first_chunk")
+        audio = b"".join(flight.chunks)
+        self._remember(key, audio)
+        self._inflight.pop(key, None)
+        flight.finish()
+        await self._run(self._write_file, self._path(key, format), audio)
+
+    async def get(self, text: str, voice_id: str = DEFAULT_VOICE, format: str = DEFAULT_FORMAT) -> bytes:
+        """Return the whole audio for ``text``."""
+        return b"".join([chunk async for chunk in await self.stream(text, voice_id, format)])
+
+    async def warm_up(self, phrases: Iterable[str], voice_id: str = DEFAULT_VOICE, format: str = DEFAULT_FORMAT) -> int:
+        """Synthesize the phrases not cached yet; returns how many were."""
+        synthesized = 0
+        for text in phrases:
+            if await self.lookup(text, voice_id, format) is None:
+                await self.get(text, voice_id, format)
+                synthesized += 1
+        return synthesized
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "in_flight": len(self._inflight),
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self._disk_size(),
+        }
+
+
+def get_synthesizer(name: str = AUDIO_SYNTHESIZER) -> Synthesizer:
+    if name == "murf" and not MURF_API_KEY:
+        logger.warning("MURF_API_KEY is not set, using the fake audio synthesizer")
+        name = "fake"
+    try:
+        return SYNTHESIZERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown audio synthesizer: {name}") from None
+
+
+audio_cache = AudioCache(get_synthesizer())
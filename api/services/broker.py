@@ -0,0 +1,477 @@
+"""Publish/subscribe broker behind the room SSE streams.
+
+Each worker process keeps its own map of connected SSE clients. The broker
+decides how a message published on one worker reaches the clients connected
+to the others:
+
+- ``memory``: single process only, messages are delivered locally.
+- ``postgres``: messages go through Postgres LISTEN/NOTIFY. Every process
+  holds one shared listener connection and fans the notifications out to
+  its local clients.
+
+The backend is picked with the ``SSE_BROKER`` environment variable.
+
+Every event gets a monotonically increasing id (microseconds since the
+epoch, bumped past the last id seen by this process), which is sent as the
+SSE ``id:`` field. The last events of each customer are kept in a bounded
+ring buffer so a reconnecting client sending ``Last-Event-ID`` only gets the
+events it missed.
+
+Client queues are bounded and filled synchronously with ``put_nowait``.
+When a client falls ``SSE_QUEUE_SIZE`` events behind, ``SSE_OVERFLOW``
+decides what happens: ``resync`` drops its backlog for a single "refresh"
+marker, ``disconnect`` closes the stream (the browser reconnects and
+replays from the ring buffer). Events for the same customer arriving within
+``SSE_COALESCE_WINDOW`` seconds are merged into one "batch" event.
+
+Idle streams get a comment line every ``SSE_HEARTBEAT`` seconds, which
+keeps proxies from closing them and makes dead connections fail (and be
+unsubscribed) promptly. A worker accepts at most ``SSE_MAX_STREAMS``
+concurrent streams per customer (0 for no limit).
+
+Messages published with ``internal=True`` (workers keeping their in-memory
+state in sync, e.g. the waiting queue) only reach the observers of every
+process: never the client streams nor the replay buffer.
+
+On shutdown ``drain`` closes every stream with a final ``retry:`` field,
+a random delay between ``SSE_RETRY`` and ``SSE_RETRY`` +
+``SSE_RECONNECT_JITTER`` seconds, so the clients come back to the new
+workers spread out instead of all at once.
+
+If the listener connection of the ``postgres`` backend is lost, it
+reconnects, waiting ``SSE_LISTEN_RECONNECT_DELAY`` seconds and doubling the
+wait after each failure, up to ``SSE_LISTEN_RECONNECT_MAX_DELAY``. The
+notifications sent in between are lost, so the local clients and caches
+then get a "refresh".
+"""
+
+import abc
+import asyncio
+import os
+import random
+import time
+import uuid
+from collections import deque
+from typing import Any, Callable, Optional
+
+import orjson
+
+from api.database.database import async_engine
+from api.responses import dumps
+
+SSE_BROKER = os.getenv("SSE_BROKER", "memory")
+NOTIFY_CHANNEL = "room_events"
+NOTIFY_MAX_BYTES = 7999
+EVENT_BUFFER_SIZE = int(os.getenv("SSE_EVENT_BUFFER_SIZE", "256"))
+QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "64"))
+OVERFLOW = os.getenv("SSE_OVERFLOW", "resync")  # or "disconnect"
+COALESCE_WINDOW = float(os.getenv("SSE_COALESCE_WINDOW", "0.05"))
+HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "50"))
+RETRY = float(os.getenv("SSE_RETRY", "3"))
+RECONNECT_JITTER = float(os.getenv("SSE_RECONNECT_JITTER", "10"))
+LISTEN_RECONNECT_DELAY = float(os.getenv("SSE_LISTEN_RECONNECT_DELAY", "1"))
+LISTEN_RECONNECT_MAX_DELAY = float(os.getenv("SSE_LISTEN_RECONNECT_MAX_DELAY", "30"))
+
+# Queue item telling the stream it can't be caught up and must reload.
+RESYNC = (None, dumps({"type": "room_update", "action": "refresh"}))
+# Queue item telling the stream to close.
+DISCONNECT = (None, None)
+
+
+def coalesce(events: list[tuple[int, str]]) -> tuple[int, str]:
+    """Merge consecutive events of a customer into a single one.
+
+    Deltas touching the same row are folded together (a create followed by
+    updates stays a create, anything followed by a delete is a delete), and
+    the result carries the id of the last event.
+    """
+    if len(events) == 1:
+        return events[0]
+    event_id = events[-1][0]
+    merged: dict[tuple[str, Any], dict[str, Any]] = {}
+    for _, msg in events:
+        event = orjson.loads(msg)
+        if event.get("action") == "refresh":
+            return event_id, msg
+        parts = (
+            event["data"]["events"] if event.get("action") == "batch"
+            else [event]
+        )
+        for part in parts:
+            key = (part.get("type"), part.get("data", {}).get("id"))
+            previous = merged.pop(key, None)
+            if previous and part.get("action") == "update":
+                part["changed"] = sorted(
+                    set(previous.get("changed", [])) | set(part.get("changed", []))
+                )
+                if previous.get("action") == "create":
+                    part["action"] = "create"
+            merged[key] = part
+    parts = list(merged.values())
+    return event_id, dumps({
+        "type": parts[-1].get("type", "room_update") if parts else "room_update",
+        "action": "batch",
+        "data": {"events": parts},
+        "changed": [],
+        "timestamp": parts[-1].get("timestamp") if parts else None,
+    })
+
+
+class Stream(asyncio.Queue):
+    """Queue of one connected SSE client, with a few facts about it."""
+
+    def __init__(self, customer_id: str, maxsize: int, client: Optional[str] = None) -> None:
+        super().__init__(maxsize)
+        self.customer_id = customer_id
+        self.client = client
+        self.connected_at = time.time()
+        self.sent = 0
+        self.last_event_id: Optional[int] = None
+        # reconnection delay (ms) sent with the final event when draining
+        self.retry: Optional[int] = None
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "customer_id": self.customer_id,
+            "client": self.client,
+            "age_seconds": time.time() - self.connected_at,
+            "backlog": self.qsize(),
+            "sent": self.sent,
+            "last_event_id": self.last_event_id,
+        }
+
+
+class Broker(abc.ABC):
+    """Local fan-out shared by every backend.
+
+    Subclasses only decide how ``publish`` reaches the other processes, and
+    what ``start`` and ``stop`` set up for it.
+    """
+
+    # whether the messages published by every process reach this one
+    shared = False
+
+    def __init__(
+        self,
+        buffer_size: int = EVENT_BUFFER_SIZE,
+        queue_size: int = QUEUE_SIZE,
+        overflow: str = OVERFLOW,
+        coalesce_window: float = COALESCE_WINDOW,
+    ) -> None:
+        # customer_id -> list of queues, one per connected SSE client
+        self.listeners: dict[str, list[Stream]] = {}
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.coalesce_window = coalesce_window
+        # customer_id -> events waiting for the end of the coalescing window
+        self._pending: dict[str, list[tuple[int, str]]] = {}
+        self.dropped = 0
+        self.disconnected = 0
+        # customer_id -> last (event_id, message) pairs, oldest first
+        self.history: dict[str, deque[tuple[int, str]]] = {}
+        # customer_id -> id of the newest event pushed out of the history
+        self.evicted: dict[str, int] = {}
+        self.buffer_size = buffer_size
+        # called with (customer_id, event_id, message) for every event,
+        # customer_id is None for broadcasts
+        self.observers: list[Callable[[Optional[str], int, str], None]] = []
+        self.last_id = 0
+        # events older than this were never seen by this process
+        self.started_at = self.next_id()
+        # set once the process is shutting down, no new streams then
+        self.draining = False
+
+    def next_id(self) -> int:
+        self.last_id = max(self.last_id + 1, time.time_ns() // 1000)
+        return self.last_id
+
+    def subscribe(
+        self,
+        customer_id: str,
+        last_event_id: Optional[int] = None,
+        client: Optional[str] = None,
+    ) -> Stream:
+        """Register a client queue, prefilled with the events it missed."""
+        queue = Stream(customer_id, self.queue_size, client)
+        if last_event_id is not None:
+            missed = self.replay(customer_id, last_event_id)
+            if missed is None or len(missed) > self.queue_size:
+                missed = [RESYNC]
+            for item in missed:
+                queue.put_nowait(item)
+        self.listeners.setdefault(customer_id, []).append(queue)
+        return queue
+
+    def drain(self, retry: float = RETRY, jitter: float = RECONNECT_JITTER) -> int:
+        """Close every stream, each client told to reconnect after a random delay.
+
+        Returns the number of streams closed. Can be called more than once.
+        """
+        self.draining = True
+        closed = 0
+        for customer_id, queues in list(self.listeners.items()):
+            for queue in list(queues):
+                queue.retry = int((retry + random.random() * jitter) * 1000)
+                try:
+                    queue.put_nowait(DISCONNECT)
+                except asyncio.QueueFull:
+                    # its backlog is lost anyway, the client resyncs on reconnect
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(DISCONNECT)
+                self.unsubscribe(customer_id, queue)
+                closed += 1
+        return closed
+
+    def streams(self) -> list[dict[str, Any]]:
+        """The streams connected to this process, oldest first."""
+        streams = [queue.info() for queues in self.listeners.values() for queue in queues]
+        return sorted(streams, key=lambda stream: -stream["age_seconds"])
+
+    def replay(
+        self, customer_id: str, last_event_id: int
+    ) -> Optional[list[tuple[int, str]]]:
+        """Return the events after ``last_event_id``.
+
+        Returns None when some of them are no longer buffered, in which case
+        the client has to reload everything.
+        """
+        if last_event_id < max(
+            self.started_at, self.evicted.get(customer_id, 0)
+        ):
+            return None
+        return [
+            (event_id, msg)
+            for event_id, msg in self.history.get(customer_id, ())
+            if event_id > last_event_id
+        ]
+
+    def add_observer(
+        self, observer: Callable[[Optional[str], int, str], None]
+    ) -> None:
+        """Get every event delivered to this process, e.g. to update a cache."""
+        self.observers.append(observer)
+
+    def _remember(self, customer_id: str, event_id: int, msg: str) -> None:
+        history = self.history.setdefault(
+            customer_id, deque(maxlen=self.buffer_size)
+        )
+        if len(history) == history.maxlen:
+            self.evicted[customer_id] = history[0][0]
+        history.append((event_id, msg))
+
+    def unsubscribe(self, customer_id: str, queue: asyncio.Queue) -> None:
+        queues = self.listeners.get(customer_id, [])
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            self.listeners.pop(customer_id, None)
+
+    def fan_out(
+        self, customer_id: Optional[str], msg: str, event_id: int, internal: bool = False
+    ) -> list[str]:
+        """Deliver an event to the clients connected to this process.
+
+        Internal events only go to the observers.
+        """
+        self.last_id = max(self.last_id, event_id)
+        for observer in self.observers:
+            observer(customer_id, event_id, msg)
+        if internal:
+            return []
+        targets = [customer_id] if customer_id else list(self.listeners.keys())
+        for cid in targets:
+            self._remember(cid, event_id, msg)
+            if self.coalesce_window <= 0:
+                self._deliver(cid, (event_id, msg))
+                continue
+            pending = self._pending.setdefault(cid, [])
+            if not pending:
+                asyncio.get_running_loop().call_later(
+                    self.coalesce_window, self._flush, cid
+                )
+            pending.append((event_id, msg))
+        return targets
+
+    def _flush(self, customer_id: str) -> None:
+        pending = self._pending.pop(customer_id, None)
+        if pending:
+            self._deliver(customer_id, coalesce(pending))
+
+    def _deliver(
+        self, customer_id: str, item: tuple[Optional[int], Optional[str]]
+    ) -> None:
+        for q in list(self.listeners.get(customer_id, [])):
+            try:
+                q.put_nowait(item)
+            except asyncio.QueueFull:
+                self._overflow(customer_id, q)
+
+    def _overflow(self, customer_id: str, queue: asyncio.Queue) -> None:
+        """Deal with a client that stopped keeping up."""
+        self.dropped += queue.qsize()
+        while not queue.empty():
+            queue.get_nowait()
+        if self.overflow == "disconnect":
+            self.disconnected += 1
+            self.unsubscribe(customer_id, queue)
+            queue.put_nowait(DISCONNECT)
+        else:
+            queue.put_nowait(RESYNC)
+
+    @abc.abstractmethod
+    async def publish(
+        self, customer_id: Optional[str], msg: str, internal: bool = False
+    ) -> list[str]:
+        """Deliver an event to every process, returns the local targets."""
+
+    @abc.abstractmethod
+    async def start(self) -> None:
+        """Called once at startup."""
+
+    @abc.abstractmethod
+    async def stop(self) -> None:
+        """Called once at shutdown."""
+
+
+class MemoryBroker(Broker):
+    """Deliver messages to the clients of the current process only."""
+
+    async def publish(
+        self, customer_id: Optional[str], msg: str, internal: bool = False
+    ) -> list[str]:
+        return self.fan_out(customer_id, msg, self.next_id(), internal)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class PostgresBroker(Broker):
+    """Deliver messages to every process through LISTEN/NOTIFY.
+
+    Notifications are sent on the regular engine pool, while a single
+    connection per process stays checked out to LISTEN on the channel.
+    Events are delivered to the publishing process right away; its own
+    notifications are recognized by their origin and skipped.
+    Postgres limits a NOTIFY payload to 8000 bytes: the other processes get
+    a "refresh" in place of a bigger message.
+    """
+
+    shared = True
+
+    def __init__(self, channel: str = NOTIFY_CHANNEL, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self._conn = None
+        self._raw = None
+        self._reconnecting: Optional[asyncio.Task] = None
+        self._stopped = False
+        self.reconnects = 0
+
+    def _on_notify(self, connection: Any, pid: int, channel: str, payload: str) -> None:
+        data = orjson.loads(payload)
+        if data.get("origin") == self.origin:
+            return
+        self.fan_out(data.get("customer_id"), data["message"], data["id"], data.get("internal", False))
+
+    async def _listen(self) -> None:
+        self._conn = await async_engine.connect()
+        fairy = await self._conn.get_raw_connection()
+        self._raw = fairy.driver_connection
+        await self._raw.add_listener(self.channel, self._on_notify)
+        self._raw.add_termination_listener(self._on_terminate)
+
+    def _on_terminate(self, connection: Any) -> None:
+        """The listener connection was closed: get a new one."""
+        if self._stopped or connection is not self._raw:
+            return
+        self._raw = None
+        self._reconnecting = asyncio.create_task(self._reconnect())
+
+    async def _discard(self) -> None:
+        """Drop the listener connection without returning it to the pool."""
+        if self._conn is not None:
+            try:
+                await self._conn.invalidate()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _reconnect(self) -> None:
+        await self._discard()
+        delay = LISTEN_RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._listen()
+                break
+            except Exception:
+                self._raw = None
+                await self._discard()
+                delay = min(delay * 2, LISTEN_RECONNECT_MAX_DELAY)
+        self.reconnects += 1
+        # the notifications sent while disconnected are lost
+        self.fan_out(None, dumps({"type": "room_update", "action": "refresh"}), self.next_id())
+
+    async def start(self) -> None:
+        await self._listen()
+
+    async def stop(self) -> None:
+        self._stopped = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            self._reconnecting = None
+        if self._raw is not None:
+            await self._raw.remove_listener(self.channel, self._on_notify)
+            self._raw = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def publish(
+        self, customer_id: Optional[str], msg: str, internal: bool = False
+    ) -> list[str]:
+        event_id = self.next_id()
+        payload = dumps({
+            "id": event_id,
+            "origin": self.origin,
+            "customer_id": customer_id,
+            "message": msg,
+            "internal": internal,
+        })
+        if len(payload.encode()) > NOTIFY_MAX_BYTES:
+            # too big for NOTIFY (e.g. a large batch): the other processes
+            # get a refresh instead
+            refresh = {"type": orjson.loads(msg).get("type", "room_update"), "action": "refresh"}
+            payload = dumps({
+                "id": event_id,
+                "origin": self.origin,
+                "customer_id": customer_id,
+                "message": dumps(refresh),
+                "internal": internal,
+            })
+        async with async_engine.connect() as conn:
+            raw = (await conn.get_raw_connection()).driver_connection
+            await raw.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+        return self.fan_out(customer_id, msg, event_id, internal)
+
+
+BROKERS = {
+    "memory": MemoryBroker,
+    "postgres": PostgresBroker,
+}
+
+
+def get_broker(name: str = SSE_BROKER) -> Broker:
+    try:
+        return BROKERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown SSE broker backend: {name}") from None
+
+
+broker = get_broker()
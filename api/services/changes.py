@@ -0,0 +1,294 @@
+"""Change capture: room, pacient and ticket writes published after commit.
+
+The write sessions (``api.database.database.async_session``) record every
+``Room``, ``Pacient`` and ``Ticket`` row a transaction inserts, updates or
+deletes, whether through the unit of work (``session.add``, attribute
+changes, ``session.delete``) or through ORM-enabled ``insert``/``update``/
+``delete`` statements. Once the commit succeeded, each customer touched gets
+one event on the broker: the changed rows, read back with the rooms and
+pacients showing them, as a plain event for a single change or a "batch"
+of deltas otherwise. A rolled back transaction publishes nothing.
+
+Statements are attributed to a customer through their parameters or their
+WHERE clause (``Room.customer_id == ...``, ``Room.id == ...`` or
+``Room.id.in_(...)``); a statement whose rows can't be told gets the
+customer's panels a "refresh", or every panel when not even the customer
+can be. Transactions touching more than ``CHANGE_CAPTURE_MAX_ROWS`` rows
+also publish a "refresh". Publishing happens on ``session.commit()`` as well
+as at the end of an ``async with session.begin():`` block. Sessions opened with
+``info={"capture_changes": False}`` publish nothing (the bulk loader sends
+its own refresh).
+"""
+
+import os
+from datetime import datetime
+from typing import Any, Optional
+
+from sqlalchemy import event, inspect
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncSessionTransaction, async_sessionmaker
+from sqlalchemy.orm import ORMExecuteState, Session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+from api.database import queries
+from api.database.database import async_session
+from api.database.models import Pacient, Room, Ticket
+from api.responses import dumps
+from api.services.broker import broker
+
+MAX_ROWS = int(os.getenv("CHANGE_CAPTURE_MAX_ROWS", "500"))
+TRACKED = {Room: "room", Pacient: "pacient", Ticket: "ticket"}
+EVENT_TYPES = {"room": "room_update", "pacient": "patient_update"}
+# columns no panel shows: updates of only these publish nothing (the
+# waiting queue has events of its own)
+UNSHOWN = {"queue_seq", "updated_at"}
+
+# session.info keys
+ENABLED = "capture_changes"
+PENDING = "changes.pending"
+COMMITTED = "changes.committed"
+LOADED = "changes.loaded"
+
+
+class Changes:
+    """Rows changed by one transaction, per customer."""
+
+    def __init__(self) -> None:
+        # customer_id -> {(kind, id): [action, changed columns]}
+        self.rows: dict[Optional[str], dict[tuple[str, str], list[Any]]] = {}
+        # customers whose changes can't be told row by row
+        self.refresh: set[Optional[str]] = set()
+
+    def add(self, customer_id: Optional[str], kind: str, id: str, action: str, changed=()) -> None:
+        if action == "update" and changed and UNSHOWN.issuperset(changed):
+            return
+        rows = self.rows.setdefault(customer_id, {})
+        previous = rows.get((kind, id))
+        if previous is None or action == "delete":
+            rows[(kind, id)] = [action, set(changed)]
+        elif previous[0] != "delete":
+            # a create followed by updates stays a create
+            previous[1].update(changed)
+        else:
+            rows[(kind, id)] = ["create", set()]
+
+    def customers(self) -> set[Optional[str]]:
+        return set(self.rows) | self.refresh
+
+
+def _pending(session: Session) -> Optional[Changes]:
+    if not session.info.get(ENABLED, True):
+        return None
+    changes = session.info.get(PENDING)
+    if changes is None:
+        changes = session.info[PENDING] = Changes()
+    return changes
+
+
+def _criteria(statement: Any) -> dict[str, list[Any]]:
+    """Column -> values of the ``==`` and ``IN`` terms of a WHERE clause."""
+    clause = getattr(statement, "whereclause", None)
+    if clause is None:
+        return {}
+    terms = (
+        clause.clauses
+        if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_
+        else [clause]
+    )
+    found: dict[str, list[Any]] = {}
+    for term in terms:
+        if not isinstance(term, BinaryExpression) or not isinstance(term.right, BindParameter):
+            continue
+        key = getattr(term.left, "key", None)
+        if term.operator is operators.eq:
+            found[key] = [term.right.effective_value]
+        elif term.operator is operators.in_op:
+            found[key] = list(term.right.effective_value)
+    return found
+
+
+def _on_flush(session: Session, flush_context: Any) -> None:
+    changes = _pending(session)
+    if changes is None:
+        return
+    for obj in session.new:
+        kind = TRACKED.get(type(obj))
+        if kind:
+            changes.add(obj.customer_id, kind, obj.id, "create")
+    for obj in session.dirty:
+        kind = TRACKED.get(type(obj))
+        if kind and session.is_modified(obj, include_collections=False):
+            changed = [attr.key for attr in inspect(obj).attrs if attr.history.has_changes()]
+            changes.add(obj.customer_id, kind, obj.id, "update", changed)
+    for obj in session.deleted:
+        kind = TRACKED.get(type(obj))
+        if kind:
+            changes.add(obj.customer_id, kind, obj.id, "delete")
+
+
+def _on_execute(state: ORMExecuteState) -> Any:
+    if not (state.is_insert or state.is_update or state.is_delete):
+        return None
+    changes = _pending(state.session)
+    if changes is None:
+        return None
+    statement = state.statement
+    kind = TRACKED.get(statement.entity_description.get("entity"))
+    if kind is None:
+        return None
+    result = state.invoke_statement()
+    if not state.is_insert and getattr(result, "rowcount", -1) == 0:
+        return result
+
+    params = state.parameters
+    rows = params if isinstance(params, list) else [params] if params else []
+    criteria = _criteria(statement)
+    customers = criteria.get("customer_id") or [None]
+    action = "create" if state.is_insert else "update" if state.is_update else "delete"
+    if rows and (state.is_insert or "id" not in criteria):
+        # one set of parameters per row
+        for row in rows:
+            customer_id = row.get("customer_id", customers[0])
+            if row.get("id") is None:
+                changes.refresh.add(customer_id)
+            else:
+                changed = set(row) - {"id"} if state.is_update else ()
+                changes.add(customer_id, kind, row["id"], action, changed)
+    elif "id" in criteria:
+        changed = ()
+        if state.is_update:
+            columns = statement.table.c
+            changed = [key for key in statement.compile().params if key in columns and key != "id"]
+        for id in criteria["id"]:
+            changes.add(customers[0], kind, id, action, changed)
+    else:
+        changes.refresh.add(customers[0])
+    return result
+
+
+def _on_commit(session: Session) -> None:
+    changes = session.info.pop(PENDING, None)
+    if changes is not None and changes.customers():
+        session.info.setdefault(COMMITTED, []).append(changes)
+
+
+def _on_rollback(session: Session) -> None:
+    session.info.pop(PENDING, None)
+
+
+class CapturingSession(Session):
+    """Sync session of the write sessions, records the changes."""
+
+
+event.listen(CapturingSession, "after_flush", _on_flush)
+event.listen(CapturingSession, "do_orm_execute", _on_execute)
+event.listen(CapturingSession, "after_commit", _on_commit)
+event.listen(CapturingSession, "after_rollback", _on_rollback)
+
+
+def _event(event_type: str, action: str, data: dict[str, Any], changed=(), timestamp: str = "") -> dict[str, Any]:
+    return {"type": event_type, "action": action, "data": data, "changed": sorted(changed), "timestamp": timestamp}
+
+
+async def _message(session: AsyncSession, customer_id: str, rows: dict[tuple[str, str], list[Any]]) -> Optional[str]:
+    """The event for the rows a customer got changed, loading them back;
+    None when no panel shows them."""
+    timestamp = datetime.now().isoformat()
+    ids: dict[str, list[str]] = {"room": [], "pacient": [], "ticket": []}
+    for (kind, id), (action, _) in rows.items():
+        # a new ticket is only shown by rows changed along with it
+        if action != "delete" and not (kind == "ticket" and action == "create"):
+            ids[kind].append(id)
+    loaded: dict[tuple[str, str], dict[str, Any]] = {}
+    if any(ids.values()):
+        for room in await queries.rooms(
+            session, customer_id, ids["room"], pacient_ids=ids["pacient"], ticket_ids=ids["ticket"]
+        ):
+            loaded[("room", room["id"])] = room
+    if ids["pacient"] or ids["ticket"]:
+        for pacient in await queries.pacients(session, customer_id, ids["pacient"], ticket_ids=ids["ticket"]):
+            loaded[("pacient", pacient["id"])] = pacient
+    session.info.setdefault(LOADED, {}).update(loaded)
+
+    events = []
+    shown = set()
+    for (kind, id), (action, changed) in rows.items():
+        if kind not in EVENT_TYPES:
+            continue
+        shown.add((kind, id))
+        if action == "delete":
+            events.append(_event(EVENT_TYPES[kind], "delete", {"id": id}, timestamp=timestamp))
+        elif (kind, id) in loaded:
+            events.append(_event(EVENT_TYPES[kind], action, loaded[(kind, id)], changed, timestamp))
+    # rows showing a changed pacient or ticket
+    for (kind, id), data in loaded.items():
+        if (kind, id) not in shown:
+            events.append(_event(EVENT_TYPES[kind], "update", data, ["pacient" if kind == "room" else "ticket"], timestamp))
+    if not events:
+        return None
+    if len(events) == 1:
+        return dumps(events[0])
+    return dumps(_event(
+        "room_update" if any(e["type"] == "room_update" for e in events) else "patient_update",
+        "batch", {"events": events}, timestamp=timestamp,
+    ))
+
+
+async def publish(session: AsyncSession) -> None:
+    """Publish what the committed transactions of the session changed."""
+    committed: list[Changes] = session.info.pop(COMMITTED, [])
+    session.info.pop(LOADED, None)
+    for changes in committed:
+        for customer_id in changes.customers():
+            rows = changes.rows.get(customer_id, {})
+            refresh = customer_id is None or customer_id in changes.refresh or len(rows) > MAX_ROWS
+            msg = None
+            if not refresh:
+                try:
+                    msg = await _message(session, customer_id, rows)
+                except Exception:
+                    refresh = True
+            if refresh:
+                msg = dumps({"type": "room_update", "action": "refresh"})
+            if msg is not None:
+                await broker.publish(customer_id, msg)
+
+
+def loaded(session: AsyncSession, model: type, id: str) -> Optional[dict[str, Any]]:
+    """A row read back for the events of the last commit, if it was."""
+    return session.info.get(LOADED, {}).get((TRACKED.get(model), str(id)))
+
+
+class ChangeTransaction(AsyncSessionTransaction):
+    """``session.begin()`` block publishing the changes once committed."""
+
+    async def commit(self) -> None:
+        await super().commit()
+        if not self.nested:
+            await publish(self.session)
+
+    async def __aexit__(self, type_: Any, value: Any, traceback: Any) -> None:
+        await super().__aexit__(type_, value, traceback)
+        if type_ is None and not self.nested:
+            await publish(self.session)
+
+
+class ChangeSession(AsyncSession):
+    """Write session publishing its changes once committed."""
+
+    sync_session_class = CapturingSession
+
+    def begin(self) -> AsyncSessionTransaction:
+        return ChangeTransaction(self)
+
+    async def commit(self) -> None:
+        await super().commit()
+        await publish(self)
+
+
+def capture(maker: async_sessionmaker) -> None:
+    """Make the sessions of ``maker`` publish their changes."""
+    maker.class_ = ChangeSession
+
+
+capture(async_session)
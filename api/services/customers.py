@@ -0,0 +1,67 @@
+"""In-process registry of the enabled customers (tenants).
+
+Every request is scoped to a customer, so validating the ``customer_id``
+cookie has to be cheap: the registry keeps all enabled customers in a dict
+and answers from it. The whole table is reloaded in one query when the
+registry is older than ``CUSTOMER_REGISTRY_TTL`` seconds, or right away
+after ``invalidate()`` (also triggered on every worker by a
+``customer_update`` event on the broker).
+"""
+
+import asyncio
+import os
+import time
+from typing import Optional
+
+import orjson
+from sqlalchemy import select
+
+from api.database.database import async_session
+from api.database.models import Customer
+from api.services.broker import broker
+
+CUSTOMER_REGISTRY_TTL = float(os.getenv("CUSTOMER_REGISTRY_TTL", "60"))
+
+
+class CustomerRegistry:
+
+    def __init__(self, ttl: float = CUSTOMER_REGISTRY_TTL) -> None:
+        self.ttl = ttl
+        # customer_id -> name
+        self._customers: dict[str, str] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < self.ttl
+        )
+
+    async def refresh(self) -> None:
+        async with self._lock:
+            # another request may have reloaded it while we waited
+            if self._fresh():
+                return
+            async with async_session() as session:
+                result = await session.execute(
+                    select(Customer.id, Customer.name).where(Customer.enabled == 1)
+                )
+                self._customers = dict(result.all())
+            self._loaded_at = time.monotonic()
+
+    async def exists(self, customer_id: str) -> bool:
+        if not self._fresh():
+            await self.refresh()
+        return customer_id in self._customers
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+
+    def on_event(self, customer_id: Optional[str], event_id: int, msg: str) -> None:
+        if orjson.loads(msg).get("type") == "customer_update":
+            self.invalidate()
+
+
+customer_registry = CustomerRegistry()
+broker.add_observer(customer_registry.on_event)
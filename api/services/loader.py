@@ -0,0 +1,278 @@
+"""Bulk import of rooms, tickets and pacients, and sample data seeding.
+
+Rows are read as a stream (CSV with a header line, or JSON Lines) and
+written in batches of ``batch_size``: for each batch, one SELECT finds the
+rows that already exist by their natural key, then the new ones go in a
+single multi-row INSERT and the existing ones in a single executemany
+UPDATE. Every batch is committed on its own, and a single "refresh" event
+is published per import so the panels and caches reload once. A batch
+breaking a constraint is rolled back and stops the import with
+``BatchRejected``, naming the batch; the ones before it stay imported.
+
+Natural keys, within a customer:
+
+- rooms: ``name``
+- tickets: ``ticket``
+- pacients: their ticket. A pacient row carries ``ticket`` (and ``type``),
+  the ticket is upserted first and the pacient is keyed by it.
+
+Nothing here runs at startup. Use the ``/import`` endpoint or the CLI::
+
+    python -m api.services.loader seed
+    python -m api.services.loader load rooms rooms.csv --customer <id>
+    python -m api.services.loader load pacients pacients.jsonl --customer <id>
+"""
+
+import argparse
+import asyncio
+import codecs
+import csv
+import uuid
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
+from typing import Any, Optional
+
+import orjson
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database.database import async_session
+from api.database.models import Customer, Pacient, Room, Ticket
+from api.responses import dumps
+from api.services.broker import broker
+
+BATCH_SIZE = 1000
+
+
+class BatchRejected(Exception):
+    """A batch broke a constraint and was rolled back; the ones before it
+    were committed."""
+
+# kind -> (model, natural key, {column: converter})
+KINDS: dict[str, tuple[Any, str, dict[str, Any]]] = {
+    "rooms": (Room, "name", {"name": str, "capacity": int, "doctor_name": str}),
+    "tickets": (Ticket, "ticket", {"ticket": str, "type": str}),
+    "pacients": (Pacient, "ticket_id", {"name": str, "age": int, "gender": str}),
+}
+# event published once an import is done, per kind
+EVENT_TYPES = {"rooms": "room_update", "tickets": "patient_update", "pacients": "patient_update"}
+
+
+async def lines_from_chunks(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream (e.g. a request body) into text lines."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def lines_from_file(path: str) -> AsyncIterator[str]:
+    with open(path, encoding="utf-8-sig") as f:
+        for line in f:
+            yield line.rstrip("\r\n")
+
+
+async def read_csv(lines: AsyncIterable[str]) -> AsyncIterator[dict[str, str]]:
+    """Rows of a CSV file whose first line is the header.
+
+    Fields can't contain line breaks.
+    """
+    header: Optional[list[str]] = None
+    async for line in lines:
+        if not line:
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        yield dict(zip(header, values))
+
+
+async def read_jsonl(lines: AsyncIterable[str]) -> AsyncIterator[dict[str, Any]]:
+    async for line in lines:
+        if line.strip():
+            yield orjson.loads(line)
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+
+
+async def batches(rows: AsyncIterable[dict], size: int) -> AsyncIterator[list[dict]]:
+    batch: list[dict] = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _clean(row: dict[str, Any], columns: dict[str, Any]) -> dict[str, Any]:
+    return {
+        name: convert(row[name]) if row[name] not in (None, "") else None
+        for name, convert in columns.items()
+        if name in row
+    }
+
+
+async def upsert(
+    session: AsyncSession, kind: str, customer_id: str, rows: Iterable[dict[str, Any]]
+) -> tuple[dict[Any, str], int, int]:
+    """Insert or update one batch of rows of a kind.
+
+    Returns the {natural key: id} of the rows, and how many were inserted
+    and updated.
+    """
+    model, key, _ = KINDS[kind]
+    by_key = {row[key]: row for row in rows}
+    if not by_key:
+        return {}, 0, 0
+    column = getattr(model, key)
+    result = await session.execute(
+        select(column, model.id).where(model.customer_id == customer_id, column.in_(by_key))
+    )
+    ids: dict[Any, str] = dict(result.all())
+    inserts = []
+    updates = []
+    for value, row in by_key.items():
+        if value in ids:
+            updates.append({**row, "id": ids[value]})
+        else:
+            ids[value] = str(uuid.uuid4())
+            inserts.append({**row, "id": ids[value], "customer_id": customer_id})
+    if inserts:
+        await session.execute(insert(model), inserts)
+    if updates:
+        await session.execute(update(model), updates)
+    return ids, len(inserts), len(updates)
+
+
+async def import_batch(
+    session: AsyncSession, kind: str, customer_id: str, batch: list[dict[str, Any]]
+) -> tuple[int, int]:
+    model, key, columns = KINDS[kind]
+    if kind != "pacients":
+        rows = [_clean(row, columns) for row in batch]
+        _, inserted, updated = await upsert(session, kind, customer_id, rows)
+        return inserted, updated
+
+    tickets = [_clean(row, KINDS["tickets"][2]) for row in batch]
+    ticket_ids, _, _ = await upsert(session, "tickets", customer_id, tickets)
+    rows = [
+        {**_clean(row, columns), "ticket_id": ticket_ids[row["ticket"]]}
+        for row in batch
+    ]
+    _, inserted, updated = await upsert(session, kind, customer_id, rows)
+    return inserted, updated
+
+
+async def import_rows(
+    kind: str,
+    customer_id: str,
+    rows: AsyncIterable[dict[str, Any]],
+    batch_size: int = BATCH_SIZE,
+) -> dict[str, int]:
+    """Stream rows of a kind into the DB, one transaction per batch."""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind: {kind}")
+    totals = {"inserted": 0, "updated": 0, "batches": 0}
+    # one refresh at the end rather than the rows of every batch
+    try:
+        async with async_session(info={"capture_changes": False}) as session:
+            async for batch in batches(rows, batch_size):
+                first = totals["batches"] * batch_size + 1
+                try:
+                    inserted, updated = await import_batch(session, kind, customer_id, batch)
+                    await session.commit()
+                except IntegrityError as err:
+                    await session.rollback()
+                    raise BatchRejected(
+                        f"Batch {totals['batches'] + 1} (rows {first}-{first + len(batch) - 1}) "
+                        f"rejected, {totals['batches']} imported before it: {err.orig}"
+                    ) from err
+                totals["inserted"] += inserted
+                totals["updated"] += updated
+                totals["batches"] += 1
+    finally:
+        # the batches committed before a failure too
+        if totals["batches"]:
+            await broker.publish(
+                customer_id, dumps({"type": EVENT_TYPES[kind], "action": "refresh"})
+            )
+    return totals
+
+
+async def _rows(items: list[dict[str, Any]]) -> AsyncIterator[dict[str, Any]]:
+    for item in items:
+        yield item
+
+
+SAMPLE_CUSTOMERS = [
+    {"name": "Rogerio", "cnpj": "20223324000104"},
+    {"name": "Gustavo", "cnpj": "50229669000128"},
+]
+SAMPLE_ROOMS = [
+    {"name": "Sala 1", "capacity": 1, "doctor_name": "Dr. Rogerio"},
+    {"name": "Sala 2", "capacity": 1, "doctor_name": "Dr. Gustavo"},
+    {"name": "Sala 3", "capacity": 1, "doctor_name": "Dr. Rogerio"},
+]
+SAMPLE_PACIENTS = [
+    {"name": "José Joaquim", "age": 70, "gender": "Masculino", "ticket": "E123", "type": "Emergência"},
+    {"name": "Paulo Henrique", "age": 99, "gender": "Masculino", "ticket": "NB456", "type": "Normal"},
+    {"name": "Jacinto Santos", "age": 101, "gender": "Masculino", "ticket": "U789", "type": "Urgencia"},
+]
+
+
+async def seed_sample_data() -> list[str]:
+    """Create the sample customers that don't exist yet, with their rooms,
+    tickets and pacients. Returns the ids of the new customers."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(Customer.name).where(Customer.name.in_([c["name"] for c in SAMPLE_CUSTOMERS]))
+        )
+        existing = set(result.scalars().all())
+        new = []
+        for c in SAMPLE_CUSTOMERS:
+            if c["name"] not in existing:
+                # a customer is its own owner (customer.customer_id references customer.id)
+                id = str(uuid.uuid4())
+                new.append({**c, "id": id, "customer_id": id})
+        if new:
+            await session.execute(insert(Customer), new)
+            await session.commit()
+    for customer in new:
+        await import_rows("rooms", customer["id"], _rows(SAMPLE_ROOMS))
+        await import_rows("pacients", customer["id"], _rows(SAMPLE_PACIENTS))
+        await broker.publish(customer["id"], dumps({"type": "customer_update", "action": "refresh"}))
+    return [customer["id"] for customer in new]
+
+
+async def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m api.services.loader")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("seed", help="create the sample customers and their data")
+    load = commands.add_parser("load", help="import a CSV or JSON Lines file")
+    load.add_argument("kind", choices=list(KINDS))
+    load.add_argument("path")
+    load.add_argument("--customer", required=True, help="customer id")
+    load.add_argument("--format", choices=list(READERS), help="defaults to the file extension")
+    load.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        print("Created customers:", await seed_sample_data())
+        return
+    format = args.format or ("csv" if args.path.endswith(".csv") else "jsonl")
+    rows = READERS[format](lines_from_file(args.path))
+    print(await import_rows(args.kind, args.customer, rows, args.batch_size))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
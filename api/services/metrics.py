@@ -0,0 +1,203 @@
+"""Prometheus-style metrics, kept in process and rendered on ``/metrics``.
+
+Collecting has to be cheap enough to leave on in production: a counter is
+a dict update, a histogram observation a ``bisect`` plus a few additions,
+and nothing is aggregated until a scrape. Values other modules already
+keep (SSE listeners, queue depths, cache and pool counters...) aren't
+copied here, they are read from their owners at scrape time (see
+``api.routers.metrics``).
+
+SQL statements are counted through engine events. The request middleware
+(``api.middleware.metrics``) puts a fresh ``RequestStats`` in a context
+variable, so every statement run while handling a request is also added to
+that request's count and time.
+"""
+
+import abc
+import time
+from bisect import bisect_left
+from collections.abc import Iterable, Iterator
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from api.database.database import async_engine, read_engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SYNTHESIS_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple[Any, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def header(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+    @abc.abstractmethod
+    def render(self) -> Iterator[str]:
+        """The metric in the Prometheus text format, header included."""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield from self.header()
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # labels -> [count per bucket..., count above the last one, sum]
+        self._series: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, *labels: Any) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> Iterator[str]:
+        yield from self.header()
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            label_text = _labels(self.label_names, labels)
+            yield f"{self.name}_sum{label_text} {_number(series[-1])}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class Collected(Metric):
+    """A metric whose samples are read from their owner at scrape time.
+
+    ``kind`` is "gauge" for live values, "counter" for totals kept by the
+    owner since startup.
+    """
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), kind: str = "gauge") -> None:
+        super().__init__(name, help, labels)
+        self.kind = kind
+
+    def render(self, samples: Optional[dict[tuple, float]] = None) -> Iterator[str]:
+        yield from self.header()
+        for labels, value in (samples or {}).items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class RequestStats:
+    __slots__ = ("statements", "sql_seconds")
+
+    def __init__(self) -> None:
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+request_latency = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request.", ("method", "route", "status")
+)
+request_statements = Histogram(
+    "http_request_db_statements", "SQL statements run per request.", ("method", "route"), COUNT_BUCKETS
+)
+request_sql_time = Histogram(
+    "http_request_db_seconds", "Time spent in SQL per request.", ("method", "route")
+)
+sql_statements = Counter("db_statements_total", "SQL statements executed.", ("engine",))
+sql_time = Counter("db_statement_seconds_total", "Time spent executing SQL.", ("engine",))
+audio_synthesis = Histogram(
+    "audio_synthesis_seconds", "Time to synthesize a phrase.", ("stage",), SYNTHESIS_BUCKETS
+)
+
+REGISTRY: list[Metric] = [
+    request_latency,
+    request_statements,
+    request_sql_time,
+    sql_statements,
+    sql_time,
+    audio_synthesis,
+]
+
+
+def instrument_engine(engine: AsyncEngine, name: str) -> None:
+    """Count the statements an engine runs and the time they take."""
+
+    def before(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        sql_statements.inc(name)
+        sql_time.inc(name, amount=elapsed)
+        stats = current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_seconds += elapsed
+
+    def failed(context) -> None:
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before)
+    event.listen(engine.sync_engine, "after_cursor_execute", after)
+    event.listen(engine.sync_engine, "handle_error", failed)
+
+
+def render(collected: Iterable[tuple[Collected, dict[tuple, float]]] = ()) -> str:
+    lines = [line for metric in REGISTRY for line in metric.render()]
+    for metric, samples in collected:
+        lines.extend(metric.render(samples))
+    return "\n".join(lines) + "\n"
+
+
+instrument_engine(async_engine, "write")
+if read_engine is not async_engine:
+    instrument_engine(read_engine, "read")
@@ -0,0 +1,146 @@
+"""Rendered room panels, kept gzipped, and their validators.
+
+The panel of a customer only changes when its rooms do, and every room
+write publishes an event whose id the room cache remembers as the
+customer's version (see ``api.services.room_cache``). The ETag is the
+customer and that version, and the version converted from microseconds is
+the Last-Modified date. A TV sending back the ETag it has gets a 304
+without the DB being queried or the template rendered, and the last
+rendering of each panel is kept both as is and gzipped, so a refresh after
+a change is rendered once per worker however many screens ask for it.
+
+Event ids are the same on every worker. A worker that hasn't seen any room
+event for a customer yet reads a version from the DB instead, once: the
+latest ``updated_at`` of its rooms and pacients, plus how many there are
+(so a deletion changes it too), which every worker reads alike.
+
+When the room cache is off (workers not seeing each other's events, see
+``api.services.room_cache``), there's no version to trust: the rooms are
+read on every request and the panel is versioned by a hash of them, with
+no Last-Modified date.
+If-Modified-Since alone doesn't say which customer the client saw, so only
+the ETag gets a 304.
+"""
+
+import gzip
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import formatdate
+from typing import NamedTuple, Optional
+
+from sqlalchemy import func, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database.models import Pacient, Room
+from api.responses import dumps
+from api.services.room_cache import room_cache
+
+PANEL_CACHE_SIZE = int(os.getenv("PANEL_CACHE_SIZE", os.getenv("ROOM_CACHE_SIZE", "1024")))
+GZIP_LEVEL = 6
+
+
+class Panel(NamedTuple):
+    version: int
+    body: bytes
+    gzipped: bytes
+
+
+async def db_version(session: AsyncSession, customer_id: str) -> int:
+    """A version of the customer's rooms and pacients read from the DB."""
+    tables = union_all(*(
+        select(func.max(model.updated_at).label("updated_at"), func.count().label("rows"))
+        .where(model.customer_id == customer_id)
+        for model in (Room, Pacient)
+    )).subquery()
+    updated_at, rows = (
+        await session.execute(select(func.max(tables.c.updated_at), func.sum(tables.c.rows)))
+    ).one()
+    if updated_at is None:
+        return 0
+    if isinstance(updated_at, str):
+        updated_at = datetime.fromisoformat(updated_at)
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    return int(updated_at.timestamp() * 1_000_000) + int(rows or 0)
+
+
+async def panel_version(session: AsyncSession, customer_id: str) -> int:
+    version = room_cache.version(customer_id)
+    if version:
+        return version
+    return await panel_cache.db_version(session, customer_id)
+
+
+def rooms_version(rooms: list[dict]) -> int:
+    """A version of the rooms read, from their content."""
+    digest = hashlib.blake2b(dumps(rooms).encode(), digest_size=7).digest()
+    return int.from_bytes(digest, "big")
+
+
+def etag(customer_id: str, version: int) -> str:
+    return f'"{customer_id}-{version}"'
+
+
+def last_modified(version: int) -> Optional[str]:
+    """The Last-Modified date of a version, None during its first second.
+
+    HTTP dates have a one second precision: the header is only sent once
+    the second of the version is over, so any later write falls in a later
+    second and is seen by If-Modified-Since.
+    """
+    if time.time_ns() // 1000 - version < 1_000_000:
+        return None
+    return formatdate(version / 1_000_000, usegmt=True)
+
+
+def not_modified(customer_id: str, version: int, if_none_match: Optional[str]) -> bool:
+    """Whether the client's copy is this customer's panel at the given version."""
+    if if_none_match is None:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag(customer_id, version) in tags
+
+
+class PanelCache:
+    """LRU map of customer_id -> last rendered panel."""
+
+    def __init__(self, max_customers: int = PANEL_CACHE_SIZE) -> None:
+        self.max_customers = max_customers
+        self._panels: OrderedDict[str, Panel] = OrderedDict()
+        # customer_id -> version read from the DB, until an event comes
+        self._db_versions: dict[str, int] = {}
+        self.hits = 0
+        self.renders = 0
+
+    async def db_version(self, session: AsyncSession, customer_id: str) -> int:
+        version = self._db_versions.get(customer_id)
+        if version is None:
+            version = self._db_versions[customer_id] = await db_version(session, customer_id)
+        return version
+
+    def get(self, customer_id: str, version: int) -> Optional[Panel]:
+        panel = self._panels.get(customer_id)
+        if panel is None or panel.version != version:
+            return None
+        self.hits += 1
+        self._panels.move_to_end(customer_id)
+        return panel
+
+    def put(self, customer_id: str, version: int, html: str) -> Panel:
+        body = html.encode()
+        panel = Panel(version, body, gzip.compress(body, GZIP_LEVEL, mtime=0))
+        self.renders += 1
+        self._panels[customer_id] = panel
+        self._panels.move_to_end(customer_id)
+        while len(self._panels) > self.max_customers:
+            self._panels.popitem(last=False)
+        return panel
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "renders": self.renders, "customers": len(self._panels)}
+
+
+panel_cache = PanelCache()
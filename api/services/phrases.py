@@ -0,0 +1,141 @@
+"""Call-out announcements assembled from pre-rendered audio fragments.
+
+A call-out ("Senha E 1 2 3, Sala 2, Dr. Gustavo") is made of a small
+vocabulary: the word "Senha", letters, digits, room names and doctor names.
+Each fragment is synthesized once through the audio cache, decoded to PCM
+and kept in memory (the ``CALLOUT_FRAGMENTS`` most recently used ones). An
+announcement is then built by copying the PCM of its fragments into a single
+preallocated buffer through ``memoryview`` slices, behind one WAV header
+written once, with silent gaps between fragments (the buffer starts filled
+with silence, so gaps cost nothing: zeros, or 0x80 for unsigned 8-bit PCM).
+
+Only fragments not in memory go to the audio cache.
+"""
+
+import io
+import os
+import string
+import struct
+import wave
+from collections import OrderedDict
+from collections.abc import Iterable
+from typing import NamedTuple, Optional
+
+from api.services.audio_cache import DEFAULT_VOICE, audio_cache
+
+CALLOUT_GAP_MS = int(os.getenv("CALLOUT_GAP_MS", "120"))
+CALLOUT_FRAGMENTS = int(os.getenv("CALLOUT_FRAGMENTS", "1024"))
+VOCABULARY = ["Senha", "Sala", *string.ascii_uppercase, *string.digits]
+
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+
+class Fragment(NamedTuple):
+    channels: int
+    sample_width: int
+    frame_rate: int
+    frames: bytes
+
+
+def decode(audio: bytes) -> Fragment:
+    with wave.open(io.BytesIO(audio), "rb") as wav:
+        return Fragment(
+            wav.getnchannels(),
+            wav.getsampwidth(),
+            wav.getframerate(),
+            wav.readframes(wav.getnframes()),
+        )
+
+
+def assemble(fragments: list[Fragment], gap_ms: int = CALLOUT_GAP_MS) -> memoryview:
+    """Concatenate PCM fragments into a single WAV file.
+
+    Raises ValueError if the fragments don't share the same format.
+    """
+    channels, sample_width, frame_rate, _ = fragments[0]
+    if any(f[:3] != (channels, sample_width, frame_rate) for f in fragments):
+        raise ValueError("Fragments have different audio formats")
+    block = channels * sample_width
+    gap = frame_rate * gap_ms // 1000 * block
+    size = sum(len(f.frames) for f in fragments) + gap * (len(fragments) - 1)
+    # WAV stores 8-bit samples unsigned, centered on 0x80
+    silence = b"\x80" if sample_width == 1 else b"\x00"
+    out = bytearray(WAV_HEADER.size) + silence * size
+    WAV_HEADER.pack_into(
+        out, 0,
+        b"RIFF", WAV_HEADER.size - 8 + size, b"WAVE",
+        b"fmt ", 16, 1, channels, frame_rate, frame_rate * block, block, sample_width * 8,
+        b"data", size,
+    )
+    view = memoryview(out)
+    pos = WAV_HEADER.size
+    for fragment in fragments:
+        end = pos + len(fragment.frames)
+        view[pos:end] = memoryview(fragment.frames)
+        pos = end + gap
+    return view
+
+
+def callout_tokens(ticket: str, room: str, doctor: Optional[str] = None) -> list[str]:
+    """Split a call-out into fragments.
+
+    ("E123", "Sala 2") -> ["Senha", "E", "1", "2", "3", "Sala 2"]
+    """
+    tokens = ["Senha", *(c.upper() for c in ticket if c.isalnum()), room]
+    if doctor:
+        tokens.append(doctor)
+    return tokens
+
+
+class PhraseEngine:
+
+    def __init__(self, max_fragments: int = CALLOUT_FRAGMENTS) -> None:
+        # (text, voice_id) -> decoded fragment, least recently used first
+        self._fragments: OrderedDict[tuple[str, str], Fragment] = OrderedDict()
+        self.max_fragments = max_fragments
+        self.rendered = 0
+
+    async def fragment(self, text: str, voice_id: str = DEFAULT_VOICE) -> Fragment:
+        key = (text, voice_id)
+        fragment = self._fragments.get(key)
+        if fragment is not None:
+            self._fragments.move_to_end(key)
+            return fragment
+        fragment = decode(await audio_cache.get(text, voice_id, "wav"))
+        self._fragments[key] = fragment
+        self.rendered += 1
+        while len(self._fragments) > self.max_fragments:
+            self._fragments.popitem(last=False)
+        return fragment
+
+    async def warm_up(self, words: Iterable[str] = VOCABULARY, voice_id: str = DEFAULT_VOICE) -> int:
+        """Render the given fragments; returns how many were new."""
+        before = self.rendered
+        for text in words:
+            await self.fragment(text, voice_id)
+        return self.rendered - before
+
+    async def callout(
+        self,
+        ticket: str,
+        room: str,
+        doctor: Optional[str] = None,
+        voice_id: str = DEFAULT_VOICE,
+    ) -> memoryview:
+        tokens = callout_tokens(ticket, room, doctor)
+        fragments = [await self.fragment(text, voice_id) for text in tokens]
+        try:
+            return assemble(fragments)
+        except ValueError:
+            # mixed formats can't be concatenated, say the whole phrase
+            audio = await audio_cache.get(", ".join(tokens), voice_id, "wav")
+            return memoryview(audio)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "fragments": len(self._fragments),
+            "pcm_bytes": sum(len(f.frames) for f in self._fragments.values()),
+        }
+
+
+phrase_engine = PhraseEngine()
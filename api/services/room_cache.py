@@ -0,0 +1,154 @@
+"""Per-customer snapshot of the rooms, served without touching Postgres.
+
+Every committed change to a room, or to a pacient or ticket a room shows,
+is published as an event through the broker (see ``api.services.changes``). The cache observes those
+events, so it is updated in place by every write, whichever worker handled
+it.
+
+Each snapshot is stamped with the id of the last event it reflects. The
+cache also remembers the last event id seen per customer, so a snapshot that
+missed an event (or that was loaded while a write was in flight) is
+detected as stale and reloaded on the next read.
+
+This only holds when every worker sees the events of the others: with the
+``memory`` broker and several workers, a snapshot would miss the writes
+handled elsewhere. ``ROOM_CACHE`` is ``auto`` (the default: snapshots are
+only kept with the ``postgres`` broker), ``on`` (e.g. a single worker with
+the ``memory`` broker) or ``off``.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import orjson
+
+from api.services.broker import broker
+
+ROOM_CACHE = os.getenv("ROOM_CACHE", "auto")  # or "on", "off"
+ROOM_CACHE_SIZE = int(os.getenv("ROOM_CACHE_SIZE", "1024"))
+# events that can change what a room looks like (rooms embed their pacient)
+ROOM_EVENT_TYPES = ("room_update", "patient_update")
+
+
+class RoomCache:
+    """LRU map of customer_id -> {room_id: serialized room}."""
+
+    def __init__(self, max_customers: int = ROOM_CACHE_SIZE, enabled: bool = True) -> None:
+        self.max_customers = max_customers
+        # False: no snapshot is kept, every read is a miss
+        self.enabled = enabled
+        # customer_id -> (version, {room_id: room})
+        self._entries: OrderedDict[str, tuple[int, dict[str, dict]]] = (
+            OrderedDict()
+        )
+        # customer_id -> id of the last event seen for that customer
+        self._versions: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, customer_id: str) -> int:
+        """Version to stamp a snapshot with, read before loading it."""
+        return self._versions.get(customer_id, 0)
+
+    def written_within(self, customer_id: str, seconds: float) -> bool:
+        """Whether the last event for the customer is less than ``seconds`` old.
+
+        Event ids are microsecond timestamps (see ``api.services.broker``).
+        """
+        return self.version(customer_id) > time.time_ns() // 1000 - seconds * 1_000_000
+
+    def _current(self, customer_id: str) -> Optional[dict[str, dict]]:
+        entry = self._entries.get(customer_id)
+        if entry is None or entry[0] != self.version(customer_id):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(customer_id)
+        return entry[1]
+
+    def get_all(self, customer_id: str) -> Optional[list[dict]]:
+        rooms = self._current(customer_id)
+        return None if rooms is None else list(rooms.values())
+
+    def get(self, customer_id: str, room_id: str) -> Optional[dict]:
+        """Return the room, or None on a miss.
+
+        A room missing from a valid snapshot is returned as an empty dict, so
+        callers can tell "doesn't exist" from "not cached".
+        """
+        rooms = self._current(customer_id)
+        return None if rooms is None else rooms.get(room_id, {})
+
+    def put(self, customer_id: str, rooms: list[dict], version: int) -> None:
+        """Store a snapshot loaded from the DB.
+
+        It is dropped if a write happened since ``version`` was read.
+        """
+        if not self.enabled or version != self.version(customer_id):
+            return
+        self._entries[customer_id] = (
+            version, {room["id"]: room for room in rooms}
+        )
+        self._entries.move_to_end(customer_id)
+        while len(self._entries) > self.max_customers:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, customer_id: str) -> None:
+        self._entries.pop(customer_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def on_event(self, customer_id: Optional[str], event_id: int, msg: str) -> None:
+        """Apply a room event to the snapshot (broker observer)."""
+        event = orjson.loads(msg)
+        if event.get("type") not in ROOM_EVENT_TYPES:
+            return
+        if customer_id is None:
+            # broadcast: we can't tell which snapshots it touches
+            self.clear()
+            return
+        previous = self.version(customer_id)
+        self._versions[customer_id] = max(previous, event_id)
+        entry = self._entries.get(customer_id)
+        if entry is None:
+            return
+        version, rooms = entry
+        parts = (
+            (event.get("data") or {}).get("events", [])
+            if event.get("action") == "batch" else [event]
+        )
+        if version != previous or not all(self._apply(rooms, part) for part in parts):
+            self.invalidate(customer_id)
+            return
+        self._entries[customer_id] = (self.version(customer_id), rooms)
+
+    @staticmethod
+    def _apply(rooms: dict[str, dict], event: dict[str, Any]) -> bool:
+        """Patch a snapshot with a delta; False if it can't be applied."""
+        data: dict[str, Any] = event.get("data") or {}
+        if not data.get("id") or event.get("action") not in ("create", "update", "delete"):
+            return False
+        if event.get("type") == "patient_update":
+            # the rooms showing the pacient come as room deltas of their own
+            # (see api.services.changes)
+            return True
+        if event.get("action") == "delete":
+            rooms.pop(data["id"], None)
+        else:
+            rooms[data["id"]] = data
+        return True
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "customers": len(self._entries),
+            "rooms": sum(len(rooms) for _, rooms in self._entries.values()),
+        }
+
+
+room_cache = RoomCache(enabled=ROOM_CACHE == "on" or (ROOM_CACHE == "auto" and broker.shared))
+broker.add_observer(room_cache.on_event)
@@ -0,0 +1,282 @@
+"""In-memory search of pacients by name or ticket, for autocomplete.
+
+Each customer has an index of its pacients' words (name and ticket),
+normalized without accents or case, so "jose" finds "José" and "conceicao"
+finds "Conceição". A query matches the pacients having, for each of its
+words, a word that contains it (so "ilva" finds "Silva"), or that starts
+with it for words of one or two letters. Pacients where every query word
+starts a word come first, by name and those whose name starts with the
+first query word first: those are found through the first
+three letters of each word, the others through a trigram index. When a
+query matches many pacients, they are looked for in name order, stopping at
+the limit, so a search costs a few milliseconds even with a single letter.
+
+The index is built from a single query at startup (``load``) and kept up
+to date from the ``patient_update`` events every write publishes (see
+``api.services.changes``), whichever worker made it. A "refresh" event
+(e.g. after a bulk import) marks the customer stale: it is reloaded on its
+next search.
+"""
+
+import heapq
+import unicodedata
+from bisect import bisect_left, insort
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Optional
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database import queries
+from api.database.models import Pacient
+from api.services.broker import broker
+
+# a query matching more than one pacient in DENSE is looked up in name order
+DENSE = 64
+EMPTY: frozenset[str] = frozenset()
+
+
+@lru_cache(maxsize=65536)
+def _normalize_word(word: str) -> str:
+    if not word.isascii():
+        word = unicodedata.normalize("NFKD", word)
+        word = "".join(c for c in word if not unicodedata.combining(c))
+    return "".join(c if c.isalnum() else " " for c in word.casefold())
+
+
+def normalize(text: Optional[str]) -> str:
+    """Lowercase, without accents, anything but letters and digits as spaces."""
+    # names share most of their words: normalize each one once
+    return " ".join(_normalize_word(word) for word in (text or "").split())
+
+
+def trigrams(word: str) -> set[str]:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def prefixes(word: str) -> set[str]:
+    return {word[:n] for n in range(1, min(len(word), 3) + 1)}
+
+
+class CustomerIndex:
+    """Words, prefixes and trigrams of the pacients of one customer."""
+
+    def __init__(self) -> None:
+        # pacient_id -> (pacient, normalized name, words)
+        self.docs: dict[str, tuple[dict[str, Any], str, tuple[str, ...]]] = {}
+        # first one to three letters of a word -> ids of the pacients having it
+        self.prefixes: defaultdict[str, set[str]] = defaultdict(set)
+        # trigram -> ids of the pacients having a word containing it
+        self.grams: defaultdict[str, set[str]] = defaultdict(set)
+        # sorted (normalized name, pacient_id)
+        self.order: list[tuple[str, str]] = []
+
+    @classmethod
+    def build(cls, pacients: Iterable[dict[str, Any]]) -> "CustomerIndex":
+        index = cls()
+        for pacient in pacients:
+            index._index(pacient)
+        index.order = sorted((name, id) for id, (_, name, _) in index.docs.items())
+        return index
+
+    def _index(self, pacient: dict[str, Any]) -> str:
+        id = pacient["id"]
+        ticket = (pacient.get("ticket") or {}).get("ticket")
+        name = " ".join(normalize(pacient.get("name")).split())
+        words = tuple(dict.fromkeys(name.split() + normalize(ticket).split()))
+        self.docs[id] = (pacient, name, words)
+        for word in words:
+            for prefix in prefixes(word):
+                self.prefixes[prefix].add(id)
+            for gram in trigrams(word):
+                self.grams[gram].add(id)
+        return name
+
+    def add(self, pacient: dict[str, Any]) -> None:
+        self.remove(pacient["id"])
+        insort(self.order, (self._index(pacient), pacient["id"]))
+
+    def remove(self, id: str) -> None:
+        doc = self.docs.pop(id, None)
+        if doc is None:
+            return
+        i = bisect_left(self.order, (doc[1], id))
+        if i < len(self.order) and self.order[i] == (doc[1], id):
+            del self.order[i]
+        for word in doc[2]:
+            for postings, keys in ((self.prefixes, prefixes(word)), (self.grams, trigrams(word))):
+                for key in keys:
+                    ids = postings.get(key)
+                    if ids is not None:
+                        ids.discard(id)
+                        if not ids:
+                            del postings[key]
+
+    def _select(self, postings: list[set[str]], accept: Callable[[str], bool], limit: int) -> list[str]:
+        """The first ``limit`` ids by name in every posting and accepted."""
+        postings.sort(key=len)
+        smallest, others = postings[0], postings[1:]
+        if len(smallest) * DENSE < len(self.docs):
+            ids = (id for id in smallest if all(id in p for p in others) and accept(id))
+            return [id for _, id in heapq.nsmallest(limit, ((self.docs[id][1], id) for id in ids))]
+        # many matches: the first ones by name come soon
+        found = []
+        for _, id in self.order:
+            if id in smallest and all(id in p for p in others) and accept(id):
+                found.append(id)
+                if len(found) == limit:
+                    break
+        return found
+
+    def _starting(self, prefix: str, postings: list[set[str]], accept: Callable[[str], bool], limit: int) -> list[str]:
+        """The first ``limit`` ids of the names starting with ``prefix``, in
+        every posting and accepted."""
+        found = []
+        i = bisect_left(self.order, (prefix, ""))
+        while i < len(self.order) and len(found) < limit:
+            name, id = self.order[i]
+            if not name.startswith(prefix):
+                break
+            if all(id in p for p in postings) and accept(id):
+                found.append(id)
+            i += 1
+        return found
+
+    def search(self, query: str, limit: int) -> list[dict[str, Any]]:
+        terms = list(dict.fromkeys(normalize(query).split()))
+        if not terms:
+            return []
+
+        def words(id: str) -> tuple[str, ...]:
+            return self.docs[id][2]
+
+        # pacients where every term starts a word (exact for terms of up to
+        # three letters), the names starting with the first one first
+        long = [term for term in terms if len(term) > 3]
+        postings = [self.prefixes.get(term[:3], EMPTY) for term in terms]
+        ids = self._starting(
+            terms[0],
+            postings[1:],
+            lambda id: all(any(w.startswith(term) for w in words(id)) for term in long),
+            limit,
+        )
+        if len(ids) < limit:
+            seen = set(ids)
+            ids += self._select(
+                postings,
+                lambda id: id not in seen and all(any(w.startswith(term) for w in words(id)) for term in long),
+                limit - len(ids),
+            )
+        if len(ids) < limit:
+            # then the ones where a term is inside a word (terms of three
+            # letters or more: shorter ones only match a word's start)
+            seen = set(ids)
+            postings = [
+                self.grams.get(gram, EMPTY)
+                for term in terms if len(term) >= 3 for gram in trigrams(term)
+            ]
+            postings += [self.prefixes.get(term, EMPTY) for term in terms if len(term) < 3]
+            ids += self._select(
+                postings,
+                lambda id: id not in seen and all(any(term in w for w in words(id)) for term in terms),
+                limit - len(ids),
+            )
+        return [self.docs[id][0] for id in ids]
+
+
+class SearchIndex:
+
+    def __init__(self) -> None:
+        self._customers: dict[str, CustomerIndex] = {}
+        # customers whose index missed a change it can't replay
+        self._stale: set[str] = set()
+        # whether every customer was loaded (False after a broadcast refresh)
+        self._complete = False
+        # customer_id -> events received while it is being reloaded
+        self._reloading: dict[str, list[dict[str, Any]]] = {}
+
+    async def load(self, session: AsyncSession, customer_id: Optional[str] = None) -> None:
+        """Build the index of a customer, or of every one, in one query."""
+        stmt = queries.PACIENTS.add_columns(Pacient.customer_id)
+        if customer_id is not None:
+            stmt = stmt.where(Pacient.customer_id == customer_id)
+            self._reloading[customer_id] = []
+            self._stale.discard(customer_id)
+        try:
+            pacients: dict[str, list[dict[str, Any]]] = {}
+            for row in await session.execute(stmt):
+                pacients.setdefault(row.customer_id, []).append(queries.pacient_from_row(row))
+            indexes = {id: CustomerIndex.build(rows) for id, rows in pacients.items()}
+        finally:
+            missed = self._reloading.pop(customer_id, []) if customer_id else []
+        if customer_id is None:
+            self._customers = indexes
+            self._stale.clear()
+            self._complete = True
+            return
+        index = self._customers[customer_id] = indexes.get(customer_id, CustomerIndex())
+        for part in missed:
+            self._apply(index, part)
+
+    async def search(
+        self, session: AsyncSession, customer_id: str, query: str, limit: int = 10
+    ) -> list[dict[str, Any]]:
+        if customer_id in self._stale or (
+            not self._complete and customer_id not in self._customers
+        ):
+            await self.load(session, customer_id)
+        index = self._customers.get(customer_id)
+        return index.search(query, limit) if index else []
+
+    @staticmethod
+    def _apply(index: CustomerIndex, event: dict[str, Any]) -> None:
+        data = event.get("data") or {}
+        if event.get("type") != "patient_update" or not data.get("id"):
+            return
+        if event.get("action") == "delete":
+            index.remove(data["id"])
+        elif event.get("action") in ("create", "update"):
+            index.add(data)
+
+    def on_event(self, customer_id: Optional[str], event_id: int, msg: str) -> None:
+        """Apply pacient changes made by any worker (broker observer)."""
+        event = orjson.loads(msg)
+        if event.get("action") == "refresh":
+            if customer_id is None:
+                self._customers.clear()
+                self._complete = False
+            else:
+                self._stale.add(customer_id)
+            return
+        if customer_id is None:
+            return
+        parts = (
+            (event.get("data") or {}).get("events", [])
+            if event.get("action") == "batch" else [event]
+        )
+        parts = [part for part in parts if part.get("type") == "patient_update"]
+        if not parts:
+            return
+        if customer_id in self._reloading:
+            self._reloading[customer_id].extend(parts)
+        index = self._customers.get(customer_id)
+        if index is None:
+            if not self._complete or customer_id in self._stale:
+                # loaded from the DB on its next search
+                return
+            # a customer without pacients at startup: the events are all it has
+            index = self._customers[customer_id] = CustomerIndex()
+        for part in parts:
+            self._apply(index, part)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "customers": len(self._customers),
+            "pacients": sum(len(index.docs) for index in self._customers.values()),
+            "stale": len(self._stale),
+        }
+
+
+search_index = SearchIndex()
+broker.add_observer(search_index.on_event)
@@ -0,0 +1,135 @@
+"""Ticket numbers: E001, U002, N003... per customer, type and day.
+
+The prefix is the first letter of the ticket type (Emergência, Urgência,
+Normal...), and each customer's numbers start over at 1 every day, in the
+clinics' ``TICKET_TIMEZONE`` (the server's when unset).
+
+Each worker reserves numbers in blocks of ``TICKET_BLOCK_SIZE`` from the
+``ticket_counter`` row of the customer, prefix and day: a single
+``UPDATE ... SET last = last + block RETURNING last`` in a transaction of
+its own, so the row is only locked for that statement. The numbers of a
+block are then handed out from memory, with no round trip, and concurrent
+check-ins on the same worker never wait for each other but while a block
+is being reserved. Numbers are unique and increasing on each worker, but
+with several workers they interleave by block, and the rest of a block is
+skipped when a worker restarts or the day ends.
+"""
+
+import asyncio
+import os
+import unicodedata
+from datetime import date, datetime
+from typing import Any, Optional
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from api.database.database import async_session
+from api.database.models import TicketCounter
+
+TIMEZONE = os.getenv("TICKET_TIMEZONE", "")
+BLOCK_SIZE = int(os.getenv("TICKET_BLOCK_SIZE", "10"))
+DEFAULT_PREFIX = "T"
+# Ticket.ticket is a String(5): the prefix and up to four digits
+MAX_NUMBER = 9999
+
+
+class TicketsExhausted(Exception):
+    """No ticket number left today for this customer and type."""
+
+
+def prefix(ticket_type: Optional[str]) -> str:
+    """The first letter of a ticket type: "Emergência" -> "E"."""
+    key = unicodedata.normalize("NFKD", ticket_type or "")
+    key = key.encode("ascii", "ignore").decode()
+    return next((c.upper() for c in key if c.isalpha()), DEFAULT_PREFIX)
+
+
+class TicketIssuer:
+
+    def __init__(
+        self, maker: async_sessionmaker = async_session, block_size: int = BLOCK_SIZE
+    ) -> None:
+        self._maker = maker
+        self.block_size = max(block_size, 1)
+        self._timezone = ZoneInfo(TIMEZONE) if TIMEZONE else None
+        self._day: Optional[date] = None
+        # (customer_id, prefix) -> [next number, last number reserved], today
+        self._blocks: dict[tuple[str, str], list[int]] = {}
+        self._locks: dict[tuple[str, str], asyncio.Lock] = {}
+        self.issued = 0
+        self.reserved = 0
+
+    def today(self) -> date:
+        return datetime.now(self._timezone).date()
+
+    async def _reserve(self, customer_id: str, prefix: str, day: date) -> list[int]:
+        """Reserve the next block of numbers in the counter row."""
+        stmt = (
+            update(TicketCounter)
+            .where(
+                TicketCounter.customer_id == customer_id,
+                TicketCounter.prefix == prefix,
+                TicketCounter.day == day,
+            )
+            .values(last=TicketCounter.last + self.block_size)
+            .returning(TicketCounter.last)
+            .execution_options(synchronize_session=False)
+        )
+        async with self._maker(info={"capture_changes": False}) as session:
+            last = (await session.execute(stmt)).scalar_one_or_none()
+            if last is None:
+                # the day's first ticket of this type
+                try:
+                    async with session.begin_nested():
+                        session.add(TicketCounter(
+                            customer_id=customer_id, prefix=prefix, day=day, last=self.block_size
+                        ))
+                    last = self.block_size
+                except IntegrityError:
+                    # another worker created it first
+                    last = (await session.execute(stmt)).scalar_one()
+            await session.commit()
+        self.reserved += 1
+        first = last - self.block_size + 1
+        if first > MAX_NUMBER:
+            raise TicketsExhausted(f"No {prefix} ticket left for {day}")
+        return [first, min(last, MAX_NUMBER)]
+
+    async def issue(self, customer_id: str, ticket_type: str) -> str:
+        """The next ticket number of this type today, e.g. "E001"."""
+        key = (customer_id, prefix(ticket_type))
+        while True:
+            day = self.today()
+            if day != self._day:
+                self._day = day
+                self._blocks.clear()
+                self._locks.clear()
+            block = self._blocks.get(key)
+            if block is not None and block[0] <= block[1]:
+                number = block[0]
+                block[0] += 1
+                self.issued += 1
+                return f"{key[1]}{number:03d}"
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                block = self._blocks.get(key)
+                if self._day == day and (block is None or block[0] > block[1]):
+                    block = await self._reserve(*key, day)
+                    # unless the day ended meanwhile
+                    if self._day == day:
+                        self._blocks[key] = block
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "day": self._day.isoformat() if self._day else None,
+            "block_size": self.block_size,
+            "issued": self.issued,
+            "blocks_reserved": self.reserved,
+            "blocks": len(self._blocks),
+        }
+
+
+ticket_issuer = TicketIssuer()
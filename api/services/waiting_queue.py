@@ -0,0 +1,224 @@
+"""Per-customer waiting queue of pacients, ordered by ticket priority.
+
+Pacients are ordered by the type of their ticket (Emergência, then
+Urgência, then Normal) and by arrival within the same type. Each customer
+has a binary heap of ``(priority, queue_seq, pacient_id)``, so enqueueing
+and calling the next pacient are O(log n).
+
+The heap is only an index: the arrival order is persisted in
+``Pacient.queue_seq`` (None once the pacient was called), so ``load``
+rebuilds every queue from a single query at startup. Changes are published
+as internal ``queue_update`` events through the broker (to the observers,
+not the client streams), which keeps the heaps of the other worker
+processes in sync. Entries removed by another worker are dropped lazily
+when they reach the top of the heap, and calling a pacient is guarded by a
+conditional UPDATE so two workers never call the same one.
+"""
+
+import heapq
+import time
+import unicodedata
+from typing import Any, Optional
+
+import orjson
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database.models import Pacient, Room, Ticket
+from api.responses import dumps
+from api.services.analytics import analytics
+from api.services.broker import broker
+
+# ticket type prefix (lowercase, without accents) -> priority, lowest first
+PRIORITIES = (("emerg", 0), ("urg", 1))
+DEFAULT_PRIORITY = 2
+
+
+def priority(ticket_type: Optional[str]) -> int:
+    """Map "Emergência", "Urgencia", "Normal"... to a heap priority."""
+    key = unicodedata.normalize("NFKD", ticket_type or "")
+    key = key.encode("ascii", "ignore").decode().lower()
+    for prefix, rank in PRIORITIES:
+        if key.startswith(prefix):
+            return rank
+    return DEFAULT_PRIORITY
+
+
+class WaitingQueue:
+
+    def __init__(self) -> None:
+        # customer_id -> heap of (priority, queue_seq, pacient_id)
+        self._heaps: dict[str, list[tuple[int, int, str]]] = {}
+        # customer_id -> {pacient_id: (priority, queue_seq)} still waiting
+        self._members: dict[str, dict[str, tuple[int, int]]] = {}
+        self._last_seq = 0
+
+    def _next_seq(self) -> int:
+        self._last_seq = max(self._last_seq + 1, time.time_ns() // 1000)
+        return self._last_seq
+
+    def push(
+        self, customer_id: str, pacient_id: str, rank: int, seq: int
+    ) -> None:
+        members = self._members.setdefault(customer_id, {})
+        if pacient_id in members:
+            return
+        members[pacient_id] = (rank, seq)
+        heapq.heappush(
+            self._heaps.setdefault(customer_id, []), (rank, seq, pacient_id)
+        )
+        self._last_seq = max(self._last_seq, seq)
+
+    def discard(self, customer_id: str, pacient_id: str) -> None:
+        """Forget a pacient; its heap entry is skipped when popped."""
+        self._members.get(customer_id, {}).pop(pacient_id, None)
+
+    def pop(self, customer_id: str) -> Optional[tuple[int, int, str]]:
+        """Take out the first ``(priority, queue_seq, pacient_id)``."""
+        heap = self._heaps.get(customer_id, [])
+        members = self._members.get(customer_id, {})
+        while heap:
+            rank, seq, pacient_id = heapq.heappop(heap)
+            if members.get(pacient_id) == (rank, seq):
+                del members[pacient_id]
+                return rank, seq, pacient_id
+        return None
+
+    def waiting(self, customer_id: str) -> list[str]:
+        """Pacient ids in the order they will be called."""
+        members = self._members.get(customer_id, {})
+        return sorted(members, key=members.__getitem__)
+
+    def depths(self) -> dict[str, int]:
+        """Number of pacients waiting, per customer."""
+        return {customer_id: len(members) for customer_id, members in self._members.items()}
+
+    def __len__(self) -> int:
+        return sum(len(members) for members in self._members.values())
+
+    async def load(self, session: AsyncSession) -> None:
+        """Rebuild every customer's queue from the DB in one query."""
+        stmt = (
+            select(
+                Pacient.customer_id, Pacient.id, Pacient.queue_seq, Ticket.type
+            )
+            .outerjoin(Ticket, Pacient.ticket_id == Ticket.id)
+            .where(Pacient.queue_seq.is_not(None))
+        )
+        self._heaps.clear()
+        self._members.clear()
+        for customer_id, pacient_id, seq, ticket_type in await session.execute(stmt):
+            rank = priority(ticket_type)
+            self._members.setdefault(customer_id, {})[pacient_id] = (rank, seq)
+            self._heaps.setdefault(customer_id, []).append((rank, seq, pacient_id))
+            self._last_seq = max(self._last_seq, seq)
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+
+    async def enqueue(
+        self, session: AsyncSession, customer_id: str, pacient_id: str
+    ) -> Optional[dict[str, Any]]:
+        """Put a pacient at the end of its priority; None if not found."""
+        stmt = (
+            select(Pacient.queue_seq, Ticket.type)
+            .outerjoin(Ticket, Pacient.ticket_id == Ticket.id)
+            .where(Pacient.customer_id == customer_id, Pacient.id == pacient_id)
+        )
+        row = (await session.execute(stmt)).one_or_none()
+        if row is None:
+            return None
+        seq, ticket_type = row
+        events = []
+        if seq is None:
+            seq = self._next_seq()
+            await session.execute(
+                update(Pacient)
+                .where(Pacient.customer_id == customer_id, Pacient.id == pacient_id)
+                .values(queue_seq=seq)
+            )
+            events.append(analytics.record(session, customer_id, "arrival", pacient_id, ticket_type=ticket_type))
+            await session.commit()
+        entry = {"id": pacient_id, "priority": priority(ticket_type), "seq": seq}
+        await self._publish(customer_id, "enqueue", entry)
+        await analytics.publish(customer_id, events)
+        return entry
+
+    async def call_next(
+        self, session: AsyncSession, customer_id: str, room: Room
+    ) -> Optional[str]:
+        """Take the first pacient out of the queue and put it in ``room``.
+
+        Both changes are committed in the same transaction, then the room
+        event is published. Returns the pacient id, or None if nobody is
+        waiting.
+        """
+        ticket_type = (
+            select(Ticket.type).where(Ticket.id == Pacient.ticket_id).scalar_subquery()
+        )
+        while True:
+            entry = self.pop(customer_id)
+            if entry is None:
+                return None
+            _, seq, pacient_id = entry
+            result = await session.execute(
+                update(Pacient)
+                .where(
+                    Pacient.customer_id == customer_id,
+                    Pacient.id == pacient_id,
+                    Pacient.queue_seq.is_not(None),
+                )
+                .values(queue_seq=None)
+                .returning(ticket_type)
+            )
+            # no row: another worker already called this pacient
+            row = result.first()
+            if row is not None:
+                break
+        room.pacient_id = pacient_id
+        events = [
+            analytics.record(session, customer_id, "called", pacient_id, room.id, row[0], since=seq),
+            *analytics.assign(session, customer_id, room.id, pacient_id, row[0]),
+        ]
+        try:
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            await self.restore(session, customer_id, pacient_id)
+            raise
+        await self._publish(customer_id, "dequeue", {"id": pacient_id})
+        await analytics.publish(customer_id, events)
+        return pacient_id
+
+    async def restore(
+        self, session: AsyncSession, customer_id: str, pacient_id: str
+    ) -> None:
+        """Put back a pacient whose call failed, at its original place."""
+        stmt = (
+            select(Pacient.queue_seq, Ticket.type)
+            .outerjoin(Ticket, Pacient.ticket_id == Ticket.id)
+            .where(Pacient.id == pacient_id)
+        )
+        row = (await session.execute(stmt)).one_or_none()
+        if row is not None and row[0] is not None:
+            self.push(customer_id, pacient_id, priority(row[1]), row[0])
+
+    async def _publish(
+        self, customer_id: str, action: str, data: dict[str, Any]
+    ) -> None:
+        msg = dumps({"type": "queue_update", "action": action, "data": data})
+        await broker.publish(customer_id, msg, internal=True)
+
+    def on_event(self, customer_id: Optional[str], event_id: int, msg: str) -> None:
+        """Apply queue changes made by any worker (broker observer)."""
+        event = orjson.loads(msg)
+        if customer_id is None or event.get("type") != "queue_update":
+            return
+        data = event.get("data") or {}
+        if event.get("action") == "enqueue":
+            self.push(customer_id, data["id"], data["priority"], data["seq"])
+        elif event.get("action") == "dequeue":
+            self.discard(customer_id, data["id"])
+
+
+waiting_queue = WaitingQueue()
+broker.add_observer(waiting_queue.on_event)
@@ -0,0 +1,24 @@
+import os
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+# the tests use SQLite databases of their own: the app's engine is created
+# at import time, don't point it at a PostgreSQL server
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+from api.database import migrations  # noqa: E402
+
+
+@pytest.fixture
+async def engine(tmp_path):
+    """A SQLite database upgraded to the latest schema."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+    await migrations.upgrade(engine)
+    yield engine
+    await engine.dispose()
+
+
+@pytest.fixture
+def maker(engine):
+    return async_sessionmaker(engine, expire_on_commit=False)
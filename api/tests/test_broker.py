@@ -0,0 +1,129 @@
+"""Broker fan-out: coalescing, slow clients and replay."""
+
+import asyncio
+
+import orjson
+
+from api.responses import dumps
+from api.services.broker import DISCONNECT, RESYNC, MemoryBroker, coalesce
+
+
+def event(action: str, id: str, changed=(), type: str = "room_update") -> str:
+    return dumps({"type": type, "action": action, "data": {"id": id}, "changed": list(changed)})
+
+
+def drain(queue: asyncio.Queue) -> list:
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def parts(msg: str) -> list[tuple[str, str, list[str]]]:
+    merged = orjson.loads(msg)
+    assert merged["action"] == "batch"
+    return [(e["action"], e["data"]["id"], e["changed"]) for e in merged["data"]["events"]]
+
+
+def test_coalesce_folds_the_deltas_of_a_row():
+    event_id, msg = coalesce([
+        (1, event("create", "a")),
+        (2, event("update", "a", ["name"])),
+        (3, event("update", "b", ["capacity"])),
+        (4, event("update", "b", ["name"])),
+        (5, event("update", "c")),
+        (6, event("delete", "c")),
+    ])
+    assert event_id == 6
+    assert parts(msg) == [
+        ("create", "a", ["name"]),
+        ("update", "b", ["capacity", "name"]),
+        ("delete", "c", []),
+    ]
+
+
+def test_coalesce_keeps_a_single_event_and_a_refresh():
+    single = (1, event("update", "a"))
+    assert coalesce([single]) == single
+    refresh = dumps({"type": "room_update", "action": "refresh"})
+    assert coalesce([single, (2, refresh), (3, event("update", "b"))]) == (3, refresh)
+
+
+async def test_events_within_the_window_are_sent_as_one():
+    broker = MemoryBroker(coalesce_window=0.01)
+    queue = broker.subscribe("c")
+    for n in range(3):
+        await broker.publish("c", event("update", str(n), ["name"]))
+    assert queue.empty()
+    await asyncio.sleep(0.05)
+    [(event_id, msg)] = drain(queue)
+    assert event_id == broker.last_id
+    assert [id for _, id, _ in parts(msg)] == ["0", "1", "2"]
+
+
+async def test_slow_client_is_resynced():
+    broker = MemoryBroker(queue_size=2, coalesce_window=0)
+    queue = broker.subscribe("c")
+    for n in range(3):
+        await broker.publish("c", event("update", str(n)))
+    assert drain(queue) == [RESYNC]
+    assert broker.dropped == 2
+    # it stays subscribed
+    await broker.publish("c", event("update", "3"))
+    assert len(drain(queue)) == 1
+
+
+async def test_slow_client_is_disconnected():
+    broker = MemoryBroker(queue_size=2, coalesce_window=0, overflow="disconnect")
+    queue = broker.subscribe("c")
+    for n in range(3):
+        await broker.publish("c", event("update", str(n)))
+    assert drain(queue) == [DISCONNECT]
+    assert broker.disconnected == 1
+    assert "c" not in broker.listeners
+
+
+async def test_reconnecting_client_gets_the_events_it_missed():
+    broker = MemoryBroker(coalesce_window=0)
+    first = broker.subscribe("c")
+    for n in range(3):
+        await broker.publish("c", event("update", str(n)))
+        await broker.publish("other", event("update", str(n)))
+    seen = drain(first)
+    queue = broker.subscribe("c", last_event_id=seen[0][0])
+    assert drain(queue) == seen[1:]
+    # up to date: nothing to replay
+    assert drain(broker.subscribe("c", last_event_id=seen[-1][0])) == []
+
+
+async def test_replay_too_far_back_is_a_resync():
+    broker = MemoryBroker(buffer_size=2, queue_size=4, coalesce_window=0)
+    ids = []
+    for n in range(4):
+        await broker.publish("c", event("update", str(n)))
+        ids.append(broker.last_id)
+    # pushed out of the buffer
+    assert drain(broker.subscribe("c", last_event_id=ids[0])) == [RESYNC]
+    assert len(drain(broker.subscribe("c", last_event_id=ids[1]))) == 2
+    # from before this process started
+    assert drain(broker.subscribe("c", last_event_id=broker.started_at - 1)) == [RESYNC]
+
+
+async def test_replay_larger_than_the_queue_is_a_resync():
+    broker = MemoryBroker(buffer_size=8, queue_size=2, coalesce_window=0)
+    start = broker.last_id
+    for n in range(3):
+        await broker.publish("c", event("update", str(n)))
+    assert drain(broker.subscribe("c", last_event_id=start)) == [RESYNC]
+
+
+async def test_internal_events_only_reach_the_observers():
+    broker = MemoryBroker(coalesce_window=0)
+    observed = []
+    broker.add_observer(lambda customer_id, event_id, msg: observed.append(msg))
+    queue = broker.subscribe("c")
+    msg = dumps({"type": "queue_update", "action": "enqueue", "data": {"id": "p"}})
+    assert await broker.publish("c", msg, internal=True) == []
+    assert observed == [msg]
+    assert queue.empty()
+    assert "c" not in broker.history
@@ -0,0 +1,108 @@
+"""Schema migrations: idempotent, and serialized by the advisory lock."""
+
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from api.database import migrations
+from api.database.models import Base
+
+# a PostgreSQL database the tests may drop every table of
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+ALL = [migration.version for migration in migrations.MIGRATIONS]
+
+
+async def schema(engine) -> dict[str, tuple]:
+    """Columns and indexes of every table."""
+
+    def read(conn):
+        inspector = inspect(conn)
+        return {
+            table: (
+                sorted((c["name"], c["nullable"]) for c in inspector.get_columns(table)),
+                sorted(i["name"] for i in inspector.get_indexes(table)),
+            )
+            for table in inspector.get_table_names()
+        }
+
+    async with engine.connect() as conn:
+        return await conn.run_sync(read)
+
+
+@pytest.fixture
+async def empty(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/empty.db")
+    yield engine
+    await engine.dispose()
+
+
+async def test_upgrade_applies_every_migration_once(empty):
+    assert await migrations.upgrade(empty) == ALL
+    assert await migrations.upgrade(empty) == []
+    assert await migrations.current_version(empty) == migrations.LATEST
+
+
+async def test_upgrade_stops_at_the_version_asked(empty):
+    assert await migrations.upgrade(empty, to=2) == [1, 2]
+    assert await migrations.current_version(empty) == 2
+    assert await migrations.upgrade(empty) == ALL[2:]
+
+
+async def test_migrations_can_run_again(engine):
+    """Every step checks what exists first, e.g. after a crash between a
+    migration and the row recording it."""
+    before = await schema(engine)
+    async with engine.begin() as conn:
+        await conn.execute(text("DELETE FROM schema_migrations"))
+    assert await migrations.upgrade(engine) == ALL
+    assert await schema(engine) == before
+
+
+async def test_database_created_without_migrations(empty, engine):
+    async with empty.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    assert await migrations.upgrade(empty) == ALL
+    assert await schema(empty) == await schema(engine)
+
+
+async def test_rooms_become_nullable_keeping_their_pacient(empty):
+    await migrations.upgrade(empty, to=1)
+    async with empty.begin() as conn:
+        for statement in (
+            "INSERT INTO customer (id, customer_id, name, cnpj, enabled) VALUES ('c', 'c', 'C', '1', 1)",
+            "INSERT INTO ticket (id, customer_id, ticket, type) VALUES ('t', 'c', 'N001', 'Normal')",
+            "INSERT INTO pacient (id, customer_id, name, age, gender, ticket_id)"
+            " VALUES ('p', 'c', 'P', 30, 'F', 't')",
+            "INSERT INTO room (id, customer_id, name, capacity, doctor_name, pacient_id)"
+            " VALUES ('r', 'c', 'R', 1, 'D', 'p')",
+        ):
+            await conn.execute(text(statement))
+    await migrations.upgrade(empty)
+    async with empty.begin() as conn:
+        assert (await conn.execute(text("SELECT pacient_id FROM room"))).scalar_one() == "p"
+        await conn.execute(text("UPDATE room SET pacient_id = NULL"))
+        assert (await conn.execute(text("SELECT queue_seq FROM pacient"))).scalar_one() is None
+
+
+@pytest.mark.skipif(not POSTGRES_URL, reason="TEST_POSTGRES_URL is not set")
+async def test_concurrent_upgrades_wait_for_each_other():
+    engines = [create_async_engine(POSTGRES_URL) for _ in range(4)]
+    try:
+        async with engines[0].begin() as conn:
+            await conn.execute(text("DROP SCHEMA public CASCADE"))
+            await conn.execute(text("CREATE SCHEMA public"))
+        applied = await asyncio.gather(*(migrations.upgrade(engine) for engine in engines))
+        # one worker applied them all, the others found them done
+        assert sorted(applied) == [[], [], [], ALL]
+        async with engines[0].connect() as conn:
+            held = await conn.execute(
+                text("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND objid = :key"),
+                {"key": migrations.LOCK_KEY},
+            )
+            assert held.scalar_one() == 0
+    finally:
+        for engine in engines:
+            await engine.dispose()
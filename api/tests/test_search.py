@@ -0,0 +1,88 @@
+"""Ranking and accent folding of the pacient search index."""
+
+import orjson
+import pytest
+
+from api.services.search import CustomerIndex, SearchIndex, normalize
+
+
+def pacient(id: str, name: str, ticket: str = "N1") -> dict:
+    return {"id": id, "name": name, "ticket": {"ticket": ticket}}
+
+
+def names(results: list[dict]) -> list[str]:
+    return [result["name"] for result in results]
+
+
+@pytest.fixture
+def index() -> CustomerIndex:
+    return CustomerIndex.build([
+        pacient("1", "Ana Silva"),
+        pacient("2", "Silvana Costa"),
+        pacient("3", "Maria Silveira"),
+        pacient("4", "Bruno Assilva"),
+        pacient("5", "José Conceição", "E123"),
+        pacient("6", "Joao Kalil"),
+        pacient("7", "Alice Souza"),
+    ])
+
+
+def test_normalize_folds_accents_case_and_punctuation():
+    assert normalize("José  CONCEIÇÃO-Araújo") == "jose conceicao araujo"
+    assert normalize(None) == ""
+
+
+@pytest.mark.parametrize("query", ["jose", "JOSÉ", "conceicao", "Conceição", "joSe conCEI"])
+def test_accents_and_case_are_ignored(index, query):
+    assert names(index.search(query, 10)) == ["José Conceição"]
+
+
+def test_accented_query_finds_unaccented_name(index):
+    assert names(index.search("João", 10)) == ["Joao Kalil"]
+
+
+def test_name_start_then_word_start_then_inside_a_word(index):
+    assert names(index.search("silv", 10)) == [
+        # the name starts with the query
+        "Silvana Costa",
+        # a word starts with it, by name
+        "Ana Silva",
+        "Maria Silveira",
+        # a word contains it
+        "Bruno Assilva",
+    ]
+
+
+def test_every_term_must_match(index):
+    assert names(index.search("silva costa", 10)) == ["Silvana Costa"]
+    assert index.search("silva souza", 10) == []
+
+
+def test_short_terms_only_match_the_start_of_a_word(index):
+    assert names(index.search("al", 10)) == ["Alice Souza"]
+    assert names(index.search("ali", 10)) == ["Alice Souza", "Joao Kalil"]
+
+
+def test_ticket_is_searchable(index):
+    assert names(index.search("e12", 10)) == ["José Conceição"]
+
+
+def test_limit(index):
+    assert names(index.search("silv", 2)) == ["Silvana Costa", "Ana Silva"]
+
+
+def test_changes_are_applied_from_the_events():
+    search_index = SearchIndex()
+    search_index._customers["c"] = CustomerIndex.build([pacient("1", "Ana Silva")])
+    search_index._complete = True
+
+    def publish(action: str, data: dict) -> None:
+        event = {"type": "patient_update", "action": action, "data": data}
+        search_index.on_event("c", 1, orjson.dumps(event).decode())
+
+    publish("create", pacient("2", "Anaí Souza"))
+    publish("update", pacient("1", "Ana Silveira"))
+    index = search_index._customers["c"]
+    assert names(index.search("ana", 10)) == ["Ana Silveira", "Anaí Souza"]
+    publish("delete", {"id": "2"})
+    assert names(index.search("anai", 10)) == []
@@ -0,0 +1,82 @@
+"""Ticket numbers reserved by block, and started over every day."""
+
+import asyncio
+from datetime import date
+
+import pytest
+from sqlalchemy import select, update
+
+from api.database.models import TicketCounter
+from api.services.tickets import MAX_NUMBER, TicketIssuer, TicketsExhausted, prefix
+
+DAY = date(2026, 3, 1)
+
+
+@pytest.fixture
+def issuer(maker):
+    issuer = TicketIssuer(maker, block_size=3)
+    issuer.today = lambda: DAY
+    return issuer
+
+
+async def counters(maker) -> dict[tuple[str, str, date], int]:
+    async with maker() as session:
+        rows = await session.execute(select(TicketCounter))
+        return {(c.customer_id, c.prefix, c.day): c.last for (c,) in rows}
+
+
+def test_prefix():
+    assert prefix("Emergência") == "E"
+    assert prefix("urgencia") == "U"
+    assert prefix("") == "T"
+
+
+async def test_numbers_per_customer_and_type(issuer):
+    assert [await issuer.issue("a", "Emergência") for _ in range(2)] == ["E001", "E002"]
+    assert await issuer.issue("a", "Normal") == "N001"
+    assert await issuer.issue("b", "Emergencia") == "E001"
+    assert await issuer.issue("a", "Emergência") == "E003"
+
+
+async def test_numbers_are_reserved_by_block(issuer, maker):
+    tickets = [await issuer.issue("a", "Normal") for _ in range(7)]
+    assert tickets == [f"N{n:03d}" for n in range(1, 8)]
+    # 1-3, 4-6 and 7-9: one counter update per block
+    assert issuer.reserved == 3
+    assert await counters(maker) == {("a", "N", DAY): 9}
+
+
+async def test_concurrent_check_ins_share_a_block(issuer):
+    tickets = await asyncio.gather(*(issuer.issue("a", "Normal") for _ in range(10)))
+    assert sorted(tickets) == [f"N{n:03d}" for n in range(1, 11)]
+    assert issuer.reserved == 4
+
+
+async def test_workers_interleave_by_block(issuer, maker):
+    other = TicketIssuer(maker, block_size=3)
+    other.today = lambda: DAY
+    assert await issuer.issue("a", "Normal") == "N001"
+    assert await other.issue("a", "Normal") == "N004"
+    assert await issuer.issue("a", "Normal") == "N002"
+    assert await other.issue("a", "Normal") == "N005"
+
+
+async def test_numbers_start_over_every_day(issuer, maker):
+    assert [await issuer.issue("a", "Normal") for _ in range(2)] == ["N001", "N002"]
+    next_day = date(2026, 3, 2)
+    issuer.today = lambda: next_day
+    # the rest of yesterday's block is dropped
+    assert await issuer.issue("a", "Normal") == "N001"
+    assert await counters(maker) == {("a", "N", DAY): 3, ("a", "N", next_day): 3}
+
+
+async def test_exhausted(issuer, maker):
+    await issuer.issue("a", "Normal")
+    async with maker() as session:
+        await session.execute(update(TicketCounter).values(last=MAX_NUMBER - 1))
+        await session.commit()
+    issuer._blocks.clear()
+    # the block is cut at the last number a ticket can hold
+    assert await issuer.issue("a", "Normal") == "N9999"
+    with pytest.raises(TicketsExhausted):
+        await issuer.issue("a", "Normal")